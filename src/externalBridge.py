@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 - 2019 Bas van Meerten and Wouter Franssen
+
+# This file is part of ssNake.
+#
+# ssNake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ssNake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ssNake. If not, see <http://www.gnu.org/licenses/>.
+
+import atexit
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import numpy as np
+import spectrum as sc
+import specIO as io
+
+
+class ExternalBridge(object):
+    """
+    Runs an external simulation program for several parameter sets at once.
+
+    In script mode, the command is run once per parameter set with the path of the script as its argument, and the first file that it writes next to the script is loaded.
+    Up to numProc commands run at the same time.
+
+    In persistent mode, the command is started once per worker and kept alive between simulations.
+    It communicates over its stdin and stdout:
+
+    - ssNake sends every request as a single line of JSON: {"script": <the script with the parameters filled in>, "parameters": {<name>: <value>}}.
+    - The program answers with a single line of JSON: {"points": <number of points>, "sw": <spectral width in Hz>, "spec": <true for a spectrum, false for an FID>},
+      followed by the complex data points as little-endian float64 pairs of real and imaginary part.
+      On a failure it answers with {"error": <message>} and no data.
+    - The program should exit when its stdin is closed.
+
+    Every worker handles one request at a time, so numProc workers simulate numProc parameter sets in parallel.
+    """
+
+    def __init__(self, numProc=None):
+        """
+        Initializes the bridge without starting any processes.
+
+        Parameters
+        ----------
+        numProc : int, optional
+            The number of simulations that are run at the same time.
+            By default the number of CPUs.
+        """
+        if numProc is None:
+            numProc = multiprocessing.cpu_count()
+        self.numProc = max(1, numProc)
+        self.command = None
+        self.workers = []
+        atexit.register(self.close)
+
+    def setNumProc(self, numProc):
+        """
+        Sets the number of simulations that are run at the same time.
+        Running persistent workers are restarted on their next use.
+
+        Parameters
+        ----------
+        numProc : int
+            The number of simulations.
+        """
+        numProc = max(1, numProc)
+        if numProc != self.numProc:
+            self.close()
+        self.numProc = numProc
+
+    def getNumProc(self):
+        """
+        Returns the number of simulations that are run at the same time.
+        The workers of the process pool run one simulation at a time, as the pool already uses all CPUs.
+
+        Returns
+        -------
+        int
+            The number of simulations.
+        """
+        if multiprocessing.current_process().daemon:
+            return 1
+        return self.numProc
+
+    def run(self, command, scripts, parameters=None, persistent=False, output=None):
+        """
+        Runs the simulations.
+
+        Parameters
+        ----------
+        command : str
+            The command that runs the simulation program.
+        scripts : list of str
+            The scripts, with the parameter values filled in, one per simulation.
+        parameters : list of dict, optional
+            The parameter values of every simulation, which are also sent to persistent workers.
+            By default no parameter values are sent.
+        persistent : bool, optional
+            If True, the persistent mode is used instead of the script mode.
+            False by default.
+        output : list, optional
+            When given, the stdout and stderr of the last simulation are written to the first two elements.
+
+        Returns
+        -------
+        list of Spectrum or None
+            The simulated data of every simulation.
+            None is returned for the simulations that failed.
+        """
+        if parameters is None:
+            parameters = [{}] * len(scripts)
+        if persistent:
+            return self.__runPersistent(command, scripts, parameters, output)
+        return self.__runScripts(command, scripts, output)
+
+    def __runScripts(self, command, scripts, output):
+        inputFileName = "script.in"
+        directory = tempfile.mkdtemp()
+        results = [None] * len(scripts)
+        running = []
+        numProc = self.getNumProc()
+        try:
+            for i, script in enumerate(scripts):
+                path = os.path.join(directory, str(i))
+                os.mkdir(path)
+                fullPath = os.path.join(path, inputFileName)
+                with open(fullPath, "w") as text_file:
+                    text_file.write(script)
+                process = subprocess.Popen(command + ' ' + fullPath, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=path)
+                running.append((i, path, process))
+                if len(running) >= numProc:
+                    self.__finishScript(running.pop(0), inputFileName, results, output)
+            while running:
+                self.__finishScript(running.pop(0), inputFileName, results, output)
+        finally:
+            for _, _, process in running:
+                process.kill()
+            shutil.rmtree(directory, ignore_errors=True)
+        return results
+
+    def __finishScript(self, job, inputFileName, results, output):
+        i, path, process = job
+        out, err = process.communicate()
+        if output:
+            output[0], output[1] = out, err
+        fileList = os.listdir(path)
+        fileList.remove(inputFileName)
+        if fileList:
+            results[i] = io.autoLoad(os.path.join(path, fileList[0]))
+
+    def __runPersistent(self, command, scripts, parameters, output):
+        results = [None] * len(scripts)
+        numProc = self.getNumProc()
+        for start in range(0, len(scripts), numProc):
+            jobs = list(range(start, min(start + numProc, len(scripts))))
+            workers = self.__getWorkers(command)
+            try:
+                for worker, i in zip(workers, jobs):
+                    request = json.dumps({'script': scripts[i], 'parameters': parameters[i]}) + '\n'
+                    worker.stdin.write(request.encode())
+                    worker.stdin.flush()
+                # Every worker is read, also after a failure, to keep the requests and answers in step
+                for worker, i in zip(workers, jobs):
+                    results[i] = self.__readAnswer(worker, output)
+            except (IOError, OSError, ValueError, KeyError):
+                # A worker stopped or broke the protocol, they are all restarted on the next request
+                self.close()
+                return [None] * len(scripts)
+        return results
+
+    def __readAnswer(self, worker, output):
+        header = worker.stdout.readline()
+        if not header:
+            raise IOError("External worker stopped")
+        header = json.loads(header.decode())
+        if 'error' in header:
+            if output:
+                output[1] = str(header['error']).encode()
+            return None
+        numPoints = int(header['points'])
+        raw = worker.stdout.read(16 * numPoints)
+        if len(raw) != 16 * numPoints:
+            raise IOError("External worker stopped")
+        data = np.frombuffer(raw, dtype='<c16').astype(complex)
+        return sc.Spectrum(data, ('', None), [0], [float(header['sw'])], [bool(header.get('spec', False))])
+
+    def __getWorkers(self, command):
+        if command != self.command or any(worker.poll() is not None for worker in self.workers):
+            self.close()
+        if not self.workers:
+            devnull = open(os.devnull, 'wb')
+            self.workers = [subprocess.Popen(command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=devnull) for _ in range(self.getNumProc())]
+            devnull.close()
+            self.command = command
+        return self.workers
+
+    def close(self):
+        """
+        Stops the persistent workers by closing their stdin.
+        Workers that do not stop are killed.
+        """
+        for worker in self.workers:
+            try:
+                worker.stdin.close()
+                worker.wait(timeout=1)
+            except Exception:
+                worker.kill()
+        self.workers = []
+        self.command = None
+
+BRIDGE = ExternalBridge()
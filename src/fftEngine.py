@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 - 2019 Bas van Meerten and Wouter Franssen
+
+# This file is part of ssNake.
+#
+# ssNake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ssNake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ssNake. If not, see <http://www.gnu.org/licenses/>.
+
+import atexit
+import collections
+import multiprocessing
+import pickle
+import numpy as np
+try:
+    import scipy.fft as scipyFft
+except ImportError:
+    scipyFft = None
+try:
+    import pyfftw
+    import pyfftw.builders
+except ImportError:
+    pyfftw = None
+
+
+class FFTEngine(object):
+    """
+    Computes the Fourier transforms of the whole program with a selectable library.
+    The numpy backend is always available.
+    The scipy backend uses multiple threads and keeps single precision data in single precision.
+    The pyfftw backend is available when pyFFTW is installed and reuses the plans of shapes that were transformed before.
+    """
+
+    def __init__(self, backend=None, numThreads=None, maxPlans=32):
+        """
+        Initializes the engine.
+
+        Parameters
+        ----------
+        backend : str or None, optional
+            The library that is used: 'numpy', 'scipy' or 'pyfftw'.
+            By default None, which selects scipy when it is available.
+        numThreads : int or None, optional
+            The number of threads used per transform.
+            By default None, which uses the number of CPUs.
+        maxPlans : int, optional
+            The maximum number of pyFFTW plans that is kept.
+            By default 32.
+        """
+        self.backend = None
+        self.numThreads = numThreads
+        self.maxPlans = maxPlans
+        self.plans = collections.OrderedDict()
+        self.wisdomFile = None
+        self.setBackend(backend)
+        atexit.register(self.saveWisdom)
+
+    def availableBackends(self):
+        """
+        Returns the backends that can be used.
+
+        Returns
+        -------
+        list of str
+            The names of the backends.
+        """
+        backends = ['numpy']
+        if scipyFft is not None:
+            backends.append('scipy')
+        if pyfftw is not None:
+            backends.append('pyfftw')
+        return backends
+
+    def setBackend(self, backend):
+        """
+        Sets the library that computes the transforms.
+
+        Parameters
+        ----------
+        backend : str or None
+            The name of the backend.
+            When the backend is not available, scipy or numpy is used instead.
+        """
+        available = self.availableBackends()
+        if backend not in available:
+            backend = 'scipy' if 'scipy' in available else 'numpy'
+        if backend != self.backend:
+            self.plans.clear()
+        self.backend = backend
+
+    def setNumThreads(self, numThreads):
+        """
+        Sets the number of threads used per transform.
+
+        Parameters
+        ----------
+        numThreads : int or None
+            The number of threads.
+            None uses the number of CPUs.
+        """
+        if numThreads != self.numThreads:
+            self.plans.clear()
+        self.numThreads = numThreads
+
+    def getNumThreads(self):
+        """
+        Returns the number of threads used per transform.
+        The workers of the process pool use a single thread, as the pool already uses all CPUs.
+
+        Returns
+        -------
+        int
+            The number of threads.
+        """
+        if multiprocessing.current_process().daemon:
+            return 1
+        if self.numThreads is None:
+            return multiprocessing.cpu_count()
+        return max(1, self.numThreads)
+
+    def setWisdomFile(self, fileName):
+        """
+        Sets the file in which the pyFFTW plans are kept between sessions and loads the plans from it.
+
+        Parameters
+        ----------
+        fileName : str or None
+            The path of the file.
+            None does not store the plans.
+        """
+        self.wisdomFile = fileName
+        if pyfftw is None or fileName is None:
+            return
+        try:
+            with open(fileName, 'rb') as f:
+                pyfftw.import_wisdom(pickle.load(f))
+        except Exception:
+            pass
+
+    def saveWisdom(self):
+        """
+        Writes the pyFFTW plans to the wisdom file.
+        """
+        if pyfftw is None or self.wisdomFile is None or self.backend != 'pyfftw':
+            return
+        try:
+            with open(self.wisdomFile, 'wb') as f:
+                pickle.dump(pyfftw.export_wisdom(), f)
+        except (IOError, OSError):
+            pass
+
+    def fft(self, data, axis=-1, overwrite=False):
+        """
+        Fourier transform along one axis.
+
+        Parameters
+        ----------
+        data : array_like
+            The data.
+        axis : int, optional
+            The axis along which the transform is taken.
+            Defaults to the last dimension.
+        overwrite : bool, optional
+            If True, the input data may be destroyed, which saves a copy for some backends.
+            By default False.
+
+        Returns
+        -------
+        ndarray
+            The transformed data.
+        """
+        return self.__transform(True, data, (axis, ), overwrite)
+
+    def ifft(self, data, axis=-1, overwrite=False):
+        """
+        Inverse Fourier transform along one axis.
+
+        Parameters
+        ----------
+        data : array_like
+            The data.
+        axis : int, optional
+            The axis along which the transform is taken.
+            Defaults to the last dimension.
+        overwrite : bool, optional
+            If True, the input data may be destroyed, which saves a copy for some backends.
+            By default False.
+
+        Returns
+        -------
+        ndarray
+            The transformed data.
+        """
+        return self.__transform(False, data, (axis, ), overwrite)
+
+    def fftn(self, data, axes=None, overwrite=False):
+        """
+        Fourier transform along several axes.
+
+        Parameters
+        ----------
+        data : array_like
+            The data.
+        axes : tuple of ints, optional
+            The axes along which the transform is taken.
+            By default all axes.
+        overwrite : bool, optional
+            If True, the input data may be destroyed, which saves a copy for some backends.
+            By default False.
+
+        Returns
+        -------
+        ndarray
+            The transformed data.
+        """
+        return self.__transform(True, data, axes, overwrite)
+
+    def ifftn(self, data, axes=None, overwrite=False):
+        """
+        Inverse Fourier transform along several axes.
+
+        Parameters
+        ----------
+        data : array_like
+            The data.
+        axes : tuple of ints, optional
+            The axes along which the transform is taken.
+            By default all axes.
+        overwrite : bool, optional
+            If True, the input data may be destroyed, which saves a copy for some backends.
+            By default False.
+
+        Returns
+        -------
+        ndarray
+            The transformed data.
+        """
+        return self.__transform(False, data, axes, overwrite)
+
+    def __transform(self, forward, data, axes, overwrite):
+        data = np.asarray(data)
+        if axes is None:
+            axes = tuple(range(data.ndim))
+        axes = tuple(axis % data.ndim for axis in axes)
+        if not axes:
+            return data if overwrite else data.copy()
+        if self.backend == 'scipy':
+            if forward:
+                return scipyFft.fftn(data, axes=axes, overwrite_x=overwrite, workers=self.getNumThreads())
+            return scipyFft.ifftn(data, axes=axes, overwrite_x=overwrite, workers=self.getNumThreads())
+        if self.backend == 'pyfftw':
+            if data.dtype not in (np.complex64, np.complex128):
+                data = data.astype(np.complex64 if data.dtype == np.float32 else np.complex128)
+            plan = self.__plan(forward, data.shape, data.dtype, axes, overwrite)
+            return plan(data, pyfftw.empty_aligned(plan.output_shape, plan.output_dtype))
+        if forward:
+            return np.fft.fftn(data, axes=axes)
+        return np.fft.ifftn(data, axes=axes)
+
+    def __plan(self, forward, shape, dtype, axes, overwrite):
+        numThreads = self.getNumThreads()
+        key = (forward, shape, np.dtype(dtype).str, axes, overwrite, numThreads)
+        plan = self.plans.pop(key, None)
+        if plan is None:
+            builder = pyfftw.builders.fftn if forward else pyfftw.builders.ifftn
+            plan = builder(pyfftw.empty_aligned(shape, dtype), axes=axes, overwrite_input=overwrite, threads=numThreads,
+                           planner_effort='FFTW_MEASURE', avoid_copy=False)
+            while len(self.plans) >= self.maxPlans:
+                self.plans.popitem(last=False)
+        self.plans[key] = plan # The most recently used plans are at the end
+        return plan
+
+ENGINE = FFTEngine()
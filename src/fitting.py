@@ -37,6 +37,8 @@ import specIO as io
 import spectrum as sc
 from ssNake import SideFrame, VERSION, QtGui, QtCore, QtWidgets, FigureCanvas
 import Czjzek
+import workerPool as wp
+import fftEngine as fe
 
 stopDict = {}  # Global dictionary with stopping commands for fits
 
@@ -63,6 +65,53 @@ class FittingException(sc.SpectrumException):
 #############################################################################################
 
 
+class FitListener(QtCore.QThread):
+    """
+    Thread that waits for the messages of a fitting process and emits them as Qt signals.
+    This allows the GUI to wait for a fit without polling.
+    """
+
+    progress = QtCore.pyqtSignal(int, float, object)
+    result = QtCore.pyqtSignal(object)
+
+    def __init__(self, queue):
+        """
+        Initializes the listener.
+
+        Parameters
+        ----------
+        queue : Queue
+            The queue on which the fitting process puts its messages.
+            Messages are tuples with as first element 'progress', 'result' or 'stop'.
+        """
+        super(FitListener, self).__init__()
+        self.queue = queue
+
+    def run(self):
+        """
+        Passes on messages until a result or stop message is received.
+        """
+        while True:
+            msg = self.queue.get()
+            if msg[0] == 'progress':
+                self.progress.emit(*msg[1:])
+            else:
+                if msg[0] == 'result':
+                    self.result.emit(msg[1])
+                return
+
+
+class FitSignals(QtCore.QObject):
+    """
+    Object that passes the results from the worker pool of fitAll to the GUI thread.
+    """
+
+    result = QtCore.pyqtSignal(int, object)
+
+
+#############################################################################################
+
+
 class TabFittingWindow(QtWidgets.QWidget):
     """
     The base widget of the fitting window.
@@ -72,6 +121,9 @@ class TabFittingWindow(QtWidgets.QWidget):
     PRECIS = 4
     MINMETHOD = 'Powell'
     NUMFEVAL = 150
+    WARMSTART = True                        # Start each slice in fitAll from the result of its neighbour
+    PROGRESS = True                         # Report the cost during a fit
+    JACOBIANSTEP = 1e-4                     # Relative step of the finite difference Jacobians
 
     def __init__(self, father, oldMainWindow, mainFitType):
         """
@@ -96,6 +148,9 @@ class TabFittingWindow(QtWidgets.QWidget):
         self.subFitWindows = []
         self.process1 = None
         self.queue = None
+        self.listener = None
+        self.waitLoop = None
+        self.runningAll = False
         self.tabs = QtWidgets.QTabWidget(self)
         self.tabs.setTabPosition(2)
         self.mainFitWindow = FittingWindow(father, oldMainWindow, self, self.mainFitType)
@@ -214,18 +269,22 @@ class TabFittingWindow(QtWidgets.QWidget):
             The results of the fit.
         """
         self.queue = multiprocessing.Queue()
-        self.process1 = multiprocessing.Process(target=mpFit, args=(xax, data1D, guess, args, self.queue, funcs, self.MINMETHOD, self.NUMFEVAL))
+        self.process1 = multiprocessing.Process(target=mpFit, args=(xax, data1D, guess, args, self.queue, funcs, self.MINMETHOD, self.NUMFEVAL, self.PROGRESS, simFunc.LINEARBINNING, (fe.ENGINE.backend, fe.ENGINE.numThreads), self.JACOBIANSTEP))
+        self.fitResult = None
+        self.listener = FitListener(self.queue)
+        self.listener.progress.connect(self.showProgress)
+        self.listener.result.connect(self.setFitResult)
+        self.waitLoop = QtCore.QEventLoop()
         self.process1.start()
+        self.listener.start()
         self.running = True
         self.mainFitWindow.paramframe.stopButton.show()
-        while self.running:
-            if not self.queue.empty():
-                self.running = False
-            QtWidgets.qApp.processEvents()
-            time.sleep(0.1)
+        if self.running:
+            self.waitLoop.exec_()
+        self.waitLoop = None
         if self.queue is None:
             return
-        fitVal = self.queue.get(timeout=2)
+        fitVal = self.fitResult
         self.stopMP()
         if fitVal is None:
             raise FittingException('Optimal parameters not found')
@@ -233,18 +292,53 @@ class TabFittingWindow(QtWidgets.QWidget):
             raise FittingException(fitVal)
         return fitVal
 
+    def setFitResult(self, fitVal):
+        """
+        Stores the result of the fitting process and stops waiting for it.
+
+        Parameters
+        ----------
+        fitVal : OptimizeResult, str or None
+            The result as returned by fitSlice.
+        """
+        self.fitResult = fitVal
+        self.running = False
+        if self.waitLoop is not None:
+            self.waitLoop.quit()
+
+    def showProgress(self, numEval, cost, params):
+        """
+        Shows the progress of the running fit in the status bar.
+
+        Parameters
+        ----------
+        numEval : int
+            The number of function evaluations so far.
+        cost : float
+            The lowest cost value so far.
+        params : ndarray
+            The parameters belonging to cost.
+        """
+        self.father.dispMsg('Fitting: evaluation ' + str(numEval) + ', cost ' + ('%#.' + str(self.PRECIS) + 'g') % cost)
+
     def stopMP(self, *args):
         """
         Stops the running fitting process.
         """
         if self.queue is not None:
             self.process1.terminate()
+            self.process1.join()
+            if self.listener.isRunning():
+                self.queue.put(('stop',))
+            self.listener.wait()
             self.queue.close()
             self.queue.join_thread()
-            self.process1.join()
         self.queue = None
         self.process1 = None
+        self.listener = None
         self.running = False
+        if self.waitLoop is not None:
+            self.waitLoop.quit()
         self.mainFitWindow.paramframe.stopButton.hide()
 
     def stopAll(self, *args):
@@ -253,36 +347,119 @@ class TabFittingWindow(QtWidgets.QWidget):
         """
         self.runningAll = False
         self.stopMP()
+        if self.waitLoop is not None:
+            self.waitLoop.quit()
         self.mainFitWindow.paramframe.stopAllButton.hide()
 
     def fitAll(self, *args):
         """
-        sequentially opens slices from an ND spectrum and runs a fit.
+        Fits all slices from an ND spectrum using the shared worker pool.
+        The slices are divided in contiguous blocks, one per process.
+        Within a block the slices are fitted in order, and when WARMSTART is set each slice starts from the result of the previous one.
+        The results are put in the parameter frames as soon as they arrive.
         """
         self.runningAll = True
         self.mainFitWindow.paramframe.stopAllButton.show()
-        tmp = np.array(self.mainFitWindow.current.data.shape())
-        tmp[self.mainFitWindow.current.axes] = 1
-        tmp2 = ()
-        for i in tmp:
-            tmp2 += (np.arange(i),)
-        grid = np.array([i.flatten() for i in np.meshgrid(*tmp2)]).T
-        for i in grid:
-            QtWidgets.qApp.processEvents()
+        try:
+            tmp = np.array(self.mainFitWindow.current.data.shape())
+            tmp[self.mainFitWindow.current.axes] = 1
+            tmp2 = ()
+            for i in tmp:
+                tmp2 += (np.arange(i),)
+            grid = np.array([i.flatten() for i in np.meshgrid(*tmp2)]).T
+            jobs = []
+            for i in grid:
+                QtWidgets.qApp.processEvents()
+                if self.runningAll is False:
+                    return
+                self.mainFitWindow.current.setSlice(self.mainFitWindow.current.axes, i)
+                job = self.getFitJob()
+                if job is None:
+                    return
+                jobs.append((self.mainFitWindow.current.getRedLocList(), job))
+            self.fitProcessAll(jobs)
             if self.runningAll is False:
-                break
-            self.mainFitWindow.current.setSlice(self.mainFitWindow.current.axes, i)
-            self.fit()
-            self.mainFitWindow.sideframe.upd()
-        self.mainFitWindow.paramframe.stopAllButton.hide()
+                return
+            for i in grid:
+                self.mainFitWindow.current.setSlice(self.mainFitWindow.current.axes, i)
+                self.mainFitWindow.sim()
+                self.mainFitWindow.sideframe.upd()
+        finally:
+            self.runningAll = False
+            self.mainFitWindow.paramframe.stopAllButton.hide()
 
-    def fit(self):
+    def fitProcessAll(self, jobs):
         """
-        Fits a spectrum on the current slice.
+        Fits a list of slices on the worker pool and sets the results per slice.
+
+        Parameters
+        ----------
+        jobs : list of tuple
+            The reduced location list and the output of getFitJob for every slice.
+        """
+        wp.POOL.setInitializer(initWorker, (simFunc.LINEARBINNING, (fe.ENGINE.backend, fe.ENGINE.numThreads), self.JACOBIANSTEP))
+        pool = wp.POOL.getPool()
+        blocks = [block for block in np.array_split(np.arange(len(jobs)), min(wp.POOL.numProc, len(jobs))) if len(block)]
+        positions = {}
+        arrived = []
+        signals = FitSignals()
+        self.waitLoop = QtCore.QEventLoop()
+
+        def receive(blockNum, fitVal):
+            arrived.append((blockNum, fitVal))
+            if self.waitLoop is not None:
+                self.waitLoop.quit()
+
+        def submit(blockNum, pos, guess=None):
+            locList, (xax, data1D, jobGuess, args, funcs, selectList) = jobs[blocks[blockNum][pos]]
+            if guess is None or len(guess) != len(jobGuess):
+                guess = jobGuess
+            positions[blockNum] = pos
+            pool.apply_async(fitSlice, (xax, np.array(data1D), guess, (selectList,) + args, funcs, self.MINMETHOD, self.NUMFEVAL),
+                             callback=lambda fitVal, blockNum=blockNum: signals.result.emit(blockNum, fitVal))
+
+        signals.result.connect(receive)
+        try:
+            for blockNum, _ in enumerate(blocks):
+                submit(blockNum, 0)
+            while positions:
+                if not arrived:
+                    self.waitLoop.exec_()
+                if self.runningAll is False:
+                    wp.POOL.close(terminate=True)
+                    return
+                while arrived:
+                    blockNum, fitVal = arrived.pop(0)
+                    pos = positions.pop(blockNum)
+                    if fitVal is None or isinstance(fitVal, str):
+                        wp.POOL.close(terminate=True)
+                        if fitVal is None:
+                            raise FittingException('Optimal parameters not found')
+                        raise FittingException(fitVal)
+                    locList, (xax, data1D, guess, args, funcs, selectList) = jobs[blocks[blockNum][pos]]
+                    self.setFitResults(fitVal['x'], selectList, args, locList)
+                    if pos + 1 < len(blocks[blockNum]):
+                        if self.WARMSTART:
+                            submit(blockNum, pos + 1, np.atleast_1d(fitVal['x']))
+                        else:
+                            submit(blockNum, pos + 1)
+        finally:
+            signals.result.disconnect()
+            self.waitLoop = None
+
+    def getFitJob(self):
+        """
+        Collects the data and fit parameters of all tabs for the current slice.
+
+        Returns
+        -------
+        tuple
+            The x-axes, data, initial guess, arguments, fit functions and the parameter slice per tab.
+            None when the parameters could not be obtained.
         """
         value = self.mainFitWindow.paramframe.getFitParams()
         if value is None:
-            return
+            return None
         xax, data1D, guess, args, out = value
         xax = [xax]
         data1D = [data1D]
@@ -299,11 +476,24 @@ class TabFittingWindow(QtWidgets.QWidget):
             for n, _ in enumerate(args):
                 new_args += (args[n] + args_tmp[n],)
             args = new_args  # tuples are immutable
-        new_args = (selectList,) + args
-        allFitVal = self.fitProcess(xax, np.array(data1D), guess, new_args, funcs)
-        if allFitVal is None:
-            return
-        allFitVal = allFitVal['x']
+        return (xax, data1D, guess, args, funcs, selectList)
+
+    def setFitResults(self, allFitVal, selectList, args, locList=None):
+        """
+        Distributes the fit results over the tabs.
+
+        Parameters
+        ----------
+        allFitVal : ndarray
+            The fitted values of all tabs.
+        selectList : list of slice
+            The part of allFitVal that belongs to each tab.
+        args : tuple
+            The arguments of the fit, as returned by getFitJob.
+        locList : tuple, optional
+            The slice of the main tab to which the results belong.
+            By default the currently displayed slice.
+        """
         fitVal = []
         for length in selectList:
             if allFitVal.ndim == 0:
@@ -313,13 +503,27 @@ class TabFittingWindow(QtWidgets.QWidget):
         args_out = []
         for n, _ in enumerate(args):
             args_out.append([args[n][0]])
-        self.mainFitWindow.paramframe.setResults(fitVal[0], args_out)
+        self.mainFitWindow.paramframe.setResults(fitVal[0], args_out, locList)
         for i, _ in enumerate(self.subFitWindows):
             args_out = []
             for n, _ in enumerate(args):
                 args_out.append([args[n][i + 1]])
             self.subFitWindows[i].paramframe.setResults(fitVal[i + 1], args_out)
 
+    def fit(self):
+        """
+        Fits a spectrum on the current slice.
+        """
+        job = self.getFitJob()
+        if job is None:
+            return
+        xax, data1D, guess, args, funcs, selectList = job
+        new_args = (selectList,) + args
+        allFitVal = self.fitProcess(xax, np.array(data1D), guess, new_args, funcs)
+        if allFitVal is None:
+            return
+        self.setFitResults(allFitVal['x'], selectList, args)
+
     def getNum(self, paramfitwindow):
         """
         Returns the index of a parameter fit window.
@@ -386,6 +590,8 @@ class TabFittingWindow(QtWidgets.QWidget):
         Closes the fitting window.
         """
         self.tabs.currentChanged.disconnect() # Prevent call for data on close
+        if self.runningAll:
+            self.stopAll()
         self.mainFitWindow.kill()
 
 ##############################################################################
@@ -799,6 +1005,8 @@ class FittingWindow(QtWidgets.QWidget):
         Closes the fitting window and restores the original workspace window.
         """
         self.tabWindow.tabs.currentChanged.disconnect() # Disconnect tabs before closing, to avoid change index signal
+        if self.tabWindow.runningAll:
+            self.tabWindow.stopAll()
         for i in reversed(range(self.grid.count())):
             self.grid.itemAt(i).widget().deleteLater()
         self.grid.deleteLater()
@@ -1290,7 +1498,7 @@ class AbstractParamFrame(QtWidgets.QWidget):
         args = ([numExp], [struc], [argu], [self.parent.data1D.freq], [self.parent.data1D.sw], [self.axMult], [self.FFT_AXES], [self.FFTSHIFT_AXES], [self.SINGLENAMES], [self.MULTINAMES])
         return (self.parent.data1D.xaxArray[-self.DIM:], self.parent.getData1D(), guess, args, out)
 
-    def setResults(self, fitVal, args):
+    def setResults(self, fitVal, args, locList=None):
         """
         Set the results in the fit parameter list based on the given fit results.
 
@@ -1300,8 +1508,15 @@ class AbstractParamFrame(QtWidgets.QWidget):
             The results of the fit.
         args : list
             The arguments to the fit.
+        locList : tuple, optional
+            The slice to which the results belong.
+            The parameters are only displayed and simulated when this is the displayed slice.
+            By default the displayed slice is used.
         """
-        locList = self.getRedLocList()
+        if locList is None:
+            locList = self.getRedLocList()
+        locList = tuple(locList)
+        self.checkFitParamList(locList)
         numExp = args[0][0]
         struc = args[1][0]
         for name in self.SINGLENAMES:
@@ -1311,11 +1526,12 @@ class AbstractParamFrame(QtWidgets.QWidget):
             for name in self.MULTINAMES:
                 if struc[name][i][0] == 1:
                     self.fitParamList[locList][name][i][0] = fitVal[struc[name][i][1]]
-        self.checkResults(numExp, struc)
-        self.dispParams()
-        self.rootwindow.sim()
+        self.checkResults(numExp, struc, locList)
+        if locList == tuple(self.getRedLocList()):
+            self.dispParams()
+            self.rootwindow.sim()
 
-    def checkResults(self, numExp, struc):
+    def checkResults(self, numExp, struc, locList=None):
         # A dummy function that is replaced by a function that checks the fit results (e.g., makes values absolute, etc)
         pass
 
@@ -1772,7 +1988,7 @@ class AbstractParamFrame(QtWidgets.QWidget):
             y = self.FITFUNC(tmpx, self.parent.data1D.freq, self.parent.data1D.sw, self.axMult, out['extra'], *inputVars)
             if y is None:
                 raise FittingException("Fitting: The fitting function didn't output anything")
-            y = np.real(np.fft.fftshift(np.fft.fftn(y, axes=self.FFT_AXES), axes=self.FFTSHIFT_AXES))
+            y = np.real(np.fft.fftshift(fe.ENGINE.fftn(y, axes=self.FFT_AXES), axes=self.FFTSHIFT_AXES))
             outCurvePart.append(offset + y)
             outCurve += y
         locList = self.getRedLocList()
@@ -1782,6 +1998,9 @@ class AbstractParamFrame(QtWidgets.QWidget):
 
 ##############################################################################
 
+# The residual based minimization methods and their Scipy least_squares method
+LSQMETHODS = {'Least squares': 'trf', 'Levenberg-Marquardt': 'lm'}
+
 def lstSqrs(dataList, *args):
     """
     Simulates spectra and calculates the least squares value with a given list of data.
@@ -1806,7 +2025,116 @@ def lstSqrs(dataList, *args):
         costValue += np.sum((dataList[i] - simData[i])**2)
     return costValue
 
-def mpFit(xax, data1D, guess, args, queue, funcs, minmethod, numfeval):
+def residuals(dataList, *args):
+    """
+    Simulates spectra and calculates the residual vector with a given list of data.
+
+    Parameters
+    ----------
+    dataList : list of arrays
+        The list of spectra to compare with the simulations.
+    *args
+        All other arguments are passed to fitFunc.
+
+    Returns
+    -------
+    ndarray
+        The differences between the simulations and the spectra, concatenated to a single vector.
+        When the simulation fails a large constant is returned for every point.
+    """
+    simData = fitFunc(*args)
+    if simData is None:
+        return np.full(sum(np.size(data) for data in dataList), 1e100)
+    return np.concatenate([np.ravel(simData[i] - dataList[i]) for i, _ in enumerate(dataList)])
+
+def fitJacobian(funcs, params, allX, args, plan=None):
+    """
+    Calculates the derivatives of the fitFunc output with respect to the fit parameters.
+
+    Parameters
+    ----------
+    funcs : list of functions
+        The list of fitting functions to execute.
+    params : tuple
+        The tuple with the function parameters generated by the optimizer.
+    allX : list of arrays
+        The list with x-axes.
+    args : tuple
+        Additional arguments for the fitting functions.
+    plan : list of tuple, optional
+        The parameter plan created by compileLinks.
+        When not given, it is created from args.
+
+    Returns
+    -------
+    ndarray
+        The Jacobian matrix, with the concatenated data points along the first axis and the fit parameters along the second axis.
+        When the simulation fails, None is returned.
+    """
+    params = np.atleast_1d(params[0])
+    if plan is None:
+        plan = compileLinks(args)
+    numParam = len(params)
+    padded = np.append(params, 0.0)
+    fullJac = []
+    for n, _ in enumerate(allX):
+        x = allX[n]
+        shape = tuple([len(item) for item in x])
+        jacFunc = np.zeros((numParam,) + shape, dtype=complex)
+        offsetJac = np.zeros(numParam)
+        extra = args[3][n][-1]
+        freq = args[4][n]
+        sw = args[5][n]
+        axMult = args[6][n]
+        fft_axes = tuple([ax + 1 for ax in args[7][n]])
+        fftshift_axes = tuple([ax + 1 for ax in args[8][n]])
+        singleNames = args[9][n]
+        names = singleNames + args[10][n]
+        gather, scale, offset = plan[n]
+        values = scale * padded[gather] + offset
+        for i, row in enumerate(values):
+            # A common offset is only added after the simulation, so it is not passed on for differentiation
+            active = [k for k, name in enumerate(names) if gather[i, k] < numParam and not (name == "Offset" and name in singleNames)]
+            if not active:
+                continue
+            derivs = simFunc.simJacobian(funcs[n], x, freq, sw, axMult, extra, list(row), active)
+            if derivs is None:
+                return None
+            for k in active:
+                if derivs[k] is not None:
+                    jacFunc[gather[i, k]] += scale[i, k] * derivs[k]
+        jacFunc = np.real(np.fft.fftshift(fe.ENGINE.fftn(jacFunc, axes=fft_axes, overwrite=True), axes=fftshift_axes))
+        if "Offset" in names and len(values):
+            k = names.index("Offset")
+            if gather[-1, k] < numParam:
+                offsetJac[gather[-1, k]] += scale[-1, k]
+        jacFunc += offsetJac.reshape((numParam,) + (1,) * len(shape))
+        fullJac.append(jacFunc.reshape(numParam, -1))
+    return np.concatenate(fullJac, axis=1).T
+
+def initWorker(linearBinning, fftSettings=None, jacobianStep=None):
+    """
+    Copies the simulation settings of the main process to a worker process.
+
+    Parameters
+    ----------
+    linearBinning : bool
+        The LINEARBINNING setting of simFunctions.
+    fftSettings : tuple, optional
+        The backend and number of threads of the FFT engine.
+        By default the settings of the worker process are not changed.
+    jacobianStep : float, optional
+        The JACOBIANSTEP setting of simFunctions.
+        By default the setting of the worker process is not changed.
+    """
+    simFunc.LINEARBINNING = linearBinning
+    if jacobianStep is not None:
+        simFunc.JACOBIANSTEP = jacobianStep
+    if fftSettings is not None:
+        fe.ENGINE.setBackend(fftSettings[0])
+        fe.ENGINE.setNumThreads(fftSettings[1])
+
+def mpFit(xax, data1D, guess, args, queue, funcs, minmethod, numfeval, progress=False, linearBinning=False, fftSettings=None, jacobianStep=None):
     """
     The minimization function running in an separate process.
 
@@ -1829,18 +2157,177 @@ def mpFit(xax, data1D, guess, args, queue, funcs, minmethod, numfeval):
         The functions to run per data in data1D.
     minmethod : str
         The minimization method of Scipy minimize to use.
+        If the method is one of the keys of LSQMETHODS, Scipy least_squares is used instead on the residual vector, using the Jacobian from fitJacobian.
     numfeval : int
         The maximum number of function evaluations.
+    progress : bool, optional
+        If True, ('progress', numEval, cost, params) messages are put on the queue when the cost improves.
+        By default False.
+    linearBinning : bool, optional
+        The LINEARBINNING setting of simFunctions to use in this process.
+        By default False.
+    fftSettings : tuple, optional
+        The backend and number of threads of the FFT engine to use in this process.
+        By default the settings are not changed.
+    jacobianStep : float, optional
+        The relative step of the finite difference Jacobians to use in this process.
+        By default the setting is not changed.
+    """
+    initWorker(linearBinning, fftSettings, jacobianStep)
+    monitor = None
+    if progress:
+        monitor = lambda numEval, cost, params: queue.put(('progress', numEval, cost, params))
+    queue.put(('result', fitSlice(xax, data1D, guess, args, funcs, minmethod, numfeval, monitor)))
+
+class FitMonitor(object):
+    """
+    Wraps a cost or residual function and reports when the cost improves.
+    """
+
+    INTERVAL = 0.1  # Minimum time between reports in seconds
+
+    def __init__(self, func, report):
+        """
+        Initializes the monitor.
+
+        Parameters
+        ----------
+        func : function
+            The cost function or residual function.
+        report : function
+            Function that is called with the number of evaluations, the lowest cost and the corresponding parameters.
+        """
+        self.func = func
+        self.report = report
+        self.numEval = 0
+        self.bestCost = np.inf
+        self.lastReport = 0.0
+
+    def __call__(self, *param):
+        value = self.func(*param)
+        self.numEval += 1
+        if np.ndim(value) == 0:
+            cost = value
+        else:
+            cost = np.sum(np.square(value))
+        if cost < self.bestCost:
+            self.bestCost = cost
+            if time.time() - self.lastReport > self.INTERVAL:
+                self.lastReport = time.time()
+                self.report(self.numEval, float(cost), np.array(param[0], copy=True))
+        return value
+
+def fitSlice(xax, data1D, guess, args, funcs, minmethod, numfeval, report=None):
+    """
+    Runs the minimization of a single fit.
+    This function is used by mpFit and by the worker pool of fitAll.
+
+    Parameters
+    ----------
+    xax : list of arrays
+        List of the x-axes of the data.
+    data1D : array or list of arrays
+        Array with the data to be fit.
+    guess : list
+        List with the initial guess values.
+    args : tuple
+        The tuple with additional values.
+    funcs : list of functions
+        The functions to run per data in data1D.
+    minmethod : str
+        The minimization method, see mpFit.
+    numfeval : int
+        The maximum number of function evaluations.
+    report : function, optional
+        When given, the cost function is wrapped in a FitMonitor that calls this function.
+
+    Returns
+    -------
+    OptimizeResult, str or None
+        The results of the fit.
+        When a SimException is raised, the error message is returned.
+        When the simulation fails otherwise, None is returned.
     """
     try:
-        fitVal = scipy.optimize.minimize(lambda *param: lstSqrs(data1D, funcs, param, xax, args), guess, method=minmethod, options={'maxfev': numfeval})
+        plan = compileLinks(args)
+        if minmethod in LSQMETHODS:
+            costFunc = lambda *param: residuals(data1D, funcs, param, xax, args, plan)
+        else:
+            costFunc = lambda *param: lstSqrs(data1D, funcs, param, xax, args, plan)
+        if report is not None:
+            costFunc = FitMonitor(costFunc, report)
+        if minmethod in LSQMETHODS:
+            fitVal = scipy.optimize.least_squares(costFunc, guess,
+                                                  jac=lambda *param: fitJacobian(funcs, param, xax, args, plan),
+                                                  method=LSQMETHODS[minmethod], x_scale='jac', max_nfev=numfeval)
+        else:
+            fitVal = scipy.optimize.minimize(costFunc, guess, method=minmethod, options={'maxfev': numfeval})
     except simFunc.SimException as e:
         fitVal = str(e)
     except Exception:
         fitVal = None
-    queue.put(fitVal)
+    return fitVal
+
+def compileLinks(args):
+    """
+    Compiles the parameter structures of all tabs into a plan of flat index and scale arrays.
+    With the plan, the values of all function arguments follow from the fit parameters in one step:
+    values = scale * params[gather] + offset, where index len(params) refers to a fixed value of zero.
 
-def fitFunc(funcs, params, allX, args):
+    Parameters
+    ----------
+    args : tuple
+        The arguments of the fit, as passed to fitFunc.
+
+    Returns
+    -------
+    list of tuple
+        Per tab the gather, scale, and offset arrays.
+        Each array has a shape of (numExp, number of single names + number of multi names).
+
+    Raises
+    ------
+    SimException
+        When a link refers to a non-existing parameter or to another linked parameter.
+    """
+    specSlices = args[0]
+    numParam = max([item.stop for item in specSlices] + [0])
+    allStruc = args[2]
+    allArgu = args[3]
+    plan = []
+    for n, struc in enumerate(allStruc):
+        numExp = args[1][n]
+        singleNames = args[9][n]
+        names = singleNames + args[10][n]
+        gather = np.full((numExp, len(names)), numParam, dtype=int)
+        scale = np.zeros((numExp, len(names)))
+        offset = np.zeros((numExp, len(names)))
+        try:
+            for i in range(numExp):
+                for j, name in enumerate(names):
+                    if j < len(singleNames):
+                        entry = struc[name][0]
+                    else:
+                        entry = struc[name][i]
+                    mult, add, tab = 1.0, 0.0, n
+                    if entry[0] == 2:
+                        altStruc = entry[1]
+                        mult, add, tab = altStruc[2], altStruc[3], altStruc[4]
+                        entry = allStruc[tab][altStruc[0]][altStruc[1]]
+                    if entry[0] == 1:
+                        gather[i, j] = specSlices[tab].start + entry[1]
+                        scale[i, j] = mult
+                        offset[i, j] = add
+                    elif entry[0] == 0:
+                        offset[i, j] = mult * allArgu[tab][entry[1]] + add
+                    else:
+                        raise simFunc.SimException("Fitting: A parameter cannot be linked to a linked parameter")
+        except KeyError:
+            raise simFunc.SimException("Fitting: One of the keywords is not correct")
+        plan.append((gather, scale, offset))
+    return plan
+
+def fitFunc(funcs, params, allX, args, plan=None):
     """
     Reconstructs all linked parameters and executes the fitting function for each set of data.
 
@@ -1854,73 +2341,50 @@ def fitFunc(funcs, params, allX, args):
         The list with x-axes.
     args : tuple
         Additional arguments for the fitting functions.
+    plan : list of tuple, optional
+        The parameter plan created by compileLinks.
+        When not given, it is created from args.
 
     Returns
     -------
     list of arrays
         A list with the simulated data.
     """
-    params = params[0]
-    specSlices = args[0]
-    allParam = []
-    for length in specSlices:
-        allParam.append(params[length])
-    allStruc = args[2]
-    allArgu = args[3]
+    if plan is None:
+        plan = compileLinks(args)
+    padded = np.append(params[0], 0.0)
     fullTestFunc = []
     for n, _ in enumerate(allX):
         x = allX[n]
         testFunc = np.zeros([len(item) for item in x], dtype=complex)
-        param = allParam[n]
-        numExp = args[1][n]
-        struc = allStruc[n]
-        argu = allArgu[n]
-        extra = argu[-1]
+        extra = args[3][n][-1]
         freq = args[4][n]
         sw = args[5][n]
         axMult = args[6][n]
         fft_axes = args[7][n]
         fftshift_axes = args[8][n]
         singleNames = args[9][n]
-        multiNames = args[10][n]
-        parameters = {}
-        try:
-            for name in singleNames:
-                if struc[name][0][0] == 1:
-                    parameters[name] = param[struc[name][0][1]]
-                elif struc[name][0][0] == 0:
-                    parameters[name] = argu[struc[name][0][1]]
-                else:
-                    altStruc = struc[name][0][1]
-                    if struc[altStruc[0]][altStruc[1]][0] == 1:
-                        parameters[name] = altStruc[2] * allParam[altStruc[4]][struc[altStruc[0]][altStruc[1]][1]] + altStruc[3]
-                    elif struc[altStruc[0]][altStruc[1]][0] == 0:
-                        parameters[name] = altStruc[2] * allArgu[altStruc[4]][struc[altStruc[0]][altStruc[1]][1]] + altStruc[3]
-            for i in range(numExp):
-                for name in multiNames:
-                    if struc[name][i][0] == 1:
-                        parameters[name] = param[struc[name][i][1]]
-                    elif struc[name][i][0] == 0:
-                        parameters[name] = argu[struc[name][i][1]]
-                    else:
-                        altStruc = struc[name][i][1]
-                        strucTarget = allStruc[altStruc[4]]
-                        if strucTarget[altStruc[0]][altStruc[1]][0] == 1:
-                            parameters[name] = altStruc[2] * allParam[altStruc[4]][strucTarget[altStruc[0]][altStruc[1]][1]] + altStruc[3]
-                        elif strucTarget[altStruc[0]][altStruc[1]][0] == 0:
-                            parameters[name] = altStruc[2] * allArgu[altStruc[4]][strucTarget[altStruc[0]][altStruc[1]][1]] + altStruc[3]
-                inputVars = [parameters[name] for name in singleNames]
-                inputVars += [parameters[name] for name in multiNames]
+        names = singleNames + args[10][n]
+        gather, scale, offset = plan[n]
+        values = scale * padded[gather] + offset
+        if funcs[n] in simFunc.MULTISITE and len(values):
+            # Evaluate all sites at once, with the site parameters as arrays
+            inputVars = list(values[0, :len(singleNames)]) + list(values[:, len(singleNames):].T)
+            output = simFunc.MULTISITE[funcs[n]](x, freq, sw, axMult, extra, *inputVars)
+            if output is None:
+                return None
+            testFunc += output
+        else:
+            for inputVars in values:
                 output = funcs[n](x, freq, sw, axMult, extra, *inputVars)
                 if output is None:
                     return None
                 #output[np.isnan(output)] = 0
                 testFunc += output
-            testFunc = np.real(np.fft.fftshift(np.fft.fftn(testFunc, axes=fft_axes), axes=fftshift_axes))
-        except KeyError:
-            raise(simFunc.SimException("Fitting: One of the keywords is not correct"))
-        if "Offset" in parameters.keys():
-            testFunc += parameters["Offset"]
+        testFunc = np.real(np.fft.fftshift(fe.ENGINE.fftn(testFunc, axes=fft_axes, overwrite=True), axes=fftshift_axes))
+        if "Offset" in names and len(values):
+            # The value of the last site is used when the offset is a site parameter
+            testFunc += values[-1, names.index("Offset")]
         fullTestFunc.append(testFunc)
     return fullTestFunc
 
@@ -1932,7 +2396,7 @@ class PrefWindow(QtWidgets.QWidget):
     Window for setting the fitting preferences.
     """
 
-    METHODLIST = ['Powell', 'Nelder-Mead']
+    METHODLIST = ['Powell', 'Nelder-Mead', 'Least squares', 'Levenberg-Marquardt']
 
     def __init__(self, parent):
         """
@@ -1965,6 +2429,15 @@ class PrefWindow(QtWidgets.QWidget):
         self.numFevalBox.setMinimum(1)
         self.numFevalBox.setValue(self.father.NUMFEVAL)
         grid.addWidget(self.numFevalBox, 2, 1)
+        self.warmStartBox = QtWidgets.QCheckBox("Fit all: start from neighbouring slice")
+        self.warmStartBox.setChecked(self.father.WARMSTART)
+        grid.addWidget(self.warmStartBox, 3, 0, 1, 2)
+        self.progressBox = QtWidgets.QCheckBox("Show fit progress")
+        self.progressBox.setChecked(self.father.PROGRESS)
+        grid.addWidget(self.progressBox, 4, 0, 1, 2)
+        grid.addWidget(wc.QLabel("Jacobian step (relative):"), 5, 0)
+        self.jacobianStepEntry = wc.QLineEdit(repr(self.father.JACOBIANSTEP))
+        grid.addWidget(self.jacobianStepEntry, 5, 1)
         cancelButton = QtWidgets.QPushButton("&Cancel")
         cancelButton.clicked.connect(self.closeEvent)
         layout.addWidget(cancelButton, 4, 0)
@@ -1986,9 +2459,15 @@ class PrefWindow(QtWidgets.QWidget):
         """
         Sets the preferences in the fitting window and closes.
         """
+        jacobianStep = safeEval(self.jacobianStepEntry.text(), Type='FI')
+        if jacobianStep is None or jacobianStep <= 0:
+            raise FittingException("Fitting: Jacobian step should be a positive number")
+        self.father.JACOBIANSTEP = float(jacobianStep)
         self.father.PRECIS = self.precisBox.value()
         self.father.MINMETHOD = self.METHODLIST[self.minmethodBox.currentIndex()]
         self.father.NUMFEVAL = self.numFevalBox.value()
+        self.father.WARMSTART = self.warmStartBox.isChecked()
+        self.father.PROGRESS = self.progressBox.isChecked()
         self.closeEvent()
 
 ##############################################################################
@@ -2098,11 +2577,12 @@ class RelaxParamFrame(AbstractParamFrame):
             x = np.linspace(minx, maxx, numCurve)
         return [x]
 
-    def checkResults(self, numExp, struc):
+    def checkResults(self, numExp, struc, locList=None):
         """
         Sets the relaxation times to absolute values.
         """
-        locList = self.getRedLocList()
+        if locList is None:
+            locList = self.getRedLocList()
         for i in range(numExp):
             if struc['T'][i][0] == 1:
                 self.fitParamList[locList]['T'][i][0] = abs(self.fitParamList[locList]['T'][i][0])
@@ -2244,11 +2724,12 @@ class DiffusionParamFrame(AbstractParamFrame):
             x = np.linspace(minx, maxx, numCurve)
         return [x]
 
-    def checkResults(self, numExp, struc):
+    def checkResults(self, numExp, struc, locList=None):
         """
         Sets the relaxation times to absolute values.
         """
-        locList = self.getRedLocList()
+        if locList is None:
+            locList = self.getRedLocList()
         for i in range(numExp):
             if struc['D'][i][0] == 1:
                 self.fitParamList[locList]['D'][i][0] = abs(self.fitParamList[locList]['D'][i][0])
@@ -2364,11 +2845,12 @@ class PeakDeconvParamFrame(AbstractParamFrame):
     def togglePick(self):
         self.parent.togglePick(self.pickTick.isChecked())
 
-    def checkResults(self, numExp, struc):
+    def checkResults(self, numExp, struc, locList=None):
         """
         Sets the Lorentzian and Gaussian broadenings to absolute values.
         """
-        locList = self.getRedLocList()
+        if locList is None:
+            locList = self.getRedLocList()
         for i in range(numExp):
             if struc["Lorentz"][i][0] == 1:
                 self.fitParamList[locList]["Lorentz"][i][0] = abs(self.fitParamList[locList]["Lorentz"][i][0])
@@ -2729,18 +3211,18 @@ class CsaDeconvParamFrame(AbstractParamFrame):
         if angle is None:
             raise FittingException("Fitting: Rotor Angle is not valid")
         cheng = safeEval(self.entries['cheng'][-1].text())
-        alpha, beta, weight = simFunc.zcw_angles(cheng, 2)
-        D2 = simFunc.D2tens(alpha, beta, np.zeros_like(alpha))
+        weight, D2, _ = simFunc.powderAverage(cheng, 2, rank4=False)
         numssb = self.entries['numssb'][0].value()
         MAStype = self.entries['spinType'][-1].currentIndex()
         out['extra'] = [shiftdef, numssb, angle, D2, weight, MAStype]
         return (out, out['extra'])
 
-    def checkResults(self, numExp, struc):
+    def checkResults(self, numExp, struc, locList=None):
         """
         Sets the Lorentzian and Gaussian broadenings to absolute values.
         """
-        locList = self.getRedLocList()
+        if locList is None:
+            locList = self.getRedLocList()
         for i in range(numExp):
             if struc["Lorentz"][i][0] == 1:
                 self.fitParamList[locList]["Lorentz"][i][0] = abs(self.fitParamList[locList]["Lorentz"][i][0])
@@ -2940,21 +3422,20 @@ class QuadDeconvParamFrame(AbstractParamFrame):
             raise FittingException("Fitting: Rotor Angle is not valid")
         I = self.entries['I'][-1].currentIndex() * 0.5 + 1
         cheng = safeEval(self.entries['cheng'][-1].text())
-        alpha, beta, weight = simFunc.zcw_angles(cheng, 2)
-        D2 = simFunc.D2tens(alpha, beta, np.zeros_like(alpha))
-        D4 = simFunc.D4tens(alpha, beta, np.zeros_like(alpha))
+        weight, D2, D4 = simFunc.powderAverage(cheng, 2)
         numssb = self.entries['numssb'][-1].value()
         MAStype = self.entries['spinType'][-1].currentIndex()
         out['extra'] = [satBool, I, numssb, angle, D2, D4, weight, MAStype]
         return (out, out['extra'])
 
-    def checkResults(self, numExp, struc):
+    def checkResults(self, numExp, struc, locList=None):
         """
         Sets the Lorentzian and Gaussian broadenings to absolute values.
         Sets eta between 0 and 1.
         Makes Cq positive.
         """
-        locList = self.getRedLocList()
+        if locList is None:
+            locList = self.getRedLocList()
         for i in range(numExp):
             if struc["Lorentz"][i][0] == 1:
                 self.fitParamList[locList]["Lorentz"][i][0] = abs(self.fitParamList[locList]["Lorentz"][i][0])
@@ -3289,19 +3770,18 @@ class QuadCSADeconvParamFrame(AbstractParamFrame):
             raise FittingException("Fitting: Rotor Angle is not valid")
         I = self.entries['I'][-1].currentIndex() * 0.5 + 0.5
         cheng = safeEval(self.entries['cheng'][-1].text())
-        alpha, beta, weight = simFunc.zcw_angles(cheng, 1)
-        D2 = simFunc.D2tens(alpha, beta, np.zeros_like(alpha))
-        D4 = simFunc.D4tens(alpha, beta, np.zeros_like(alpha))
+        weight, D2, D4 = simFunc.powderAverage(cheng, 1)
         numssb = self.entries['numssb'][-1].value()
         MAStype = self.entries['spinType'][-1].currentIndex()
         out['extra'] = [satBool, I, numssb, angle, D2, D4, weight, MAStype, shiftdef]
         return (out, out['extra'])
 
-    def checkResults(self, numExp, struc):
+    def checkResults(self, numExp, struc, locList=None):
         """
         Fixes the fit results.
         """
-        locList = self.getRedLocList()
+        if locList is None:
+            locList = self.getRedLocList()
         for i in range(numExp):
             if struc["Lorentz"][i][0] == 1:
                 self.fitParamList[locList]["Lorentz"][i][0] = abs(self.fitParamList[locList]["Lorentz"][i][0])
@@ -3843,9 +4323,7 @@ class QuadCzjzekParamFrame(AbstractParamFrame):
         Simulate the spectra for the Czjzek library.
         """
         angle = safeEval(self.angle, Type='FI')
-        alpha, beta, weight = simFunc.zcw_angles(self.cheng, 2)
-        D2 = simFunc.D2tens(alpha, beta, np.zeros_like(alpha))
-        D4 = simFunc.D4tens(alpha, beta, np.zeros_like(alpha))
+        weight, D2, D4 = simFunc.powderAverage(self.cheng, 2)
         extra = [self.satBool, self.I, self.numssb, angle, D2, D4, weight, self.mas]
         self.lib, self.cqLib, self.etaLib = simFunc.genLib(len(self.parent.xax()), self.cqmin, self.cqmax, self.etamin, self.etamax, self.cqsteps, self.etasteps, extra, self.parent.freq(), self.parent.sw(), self.spinspeed)
 
@@ -3918,11 +4396,12 @@ class QuadCzjzekParamFrame(AbstractParamFrame):
         out['extra'] = [method, d, self.lib, self.cqLib, self.etaLib]
         return (out, out['extra'])
 
-    def checkResults(self, numExp, struc):
+    def checkResults(self, numExp, struc, locList=None):
         """
         Fixes the fit results.
         """
-        locList = self.getRedLocList()
+        if locList is None:
+            locList = self.getRedLocList()
         for i in range(numExp):
             if struc["Lorentz"][i][0] == 1:
                 self.fitParamList[locList]["Lorentz"][i][0] = abs(self.fitParamList[locList]["Lorentz"][i][0])
@@ -3978,6 +4457,9 @@ class ExternalFitDeconvParamFrame(AbstractParamFrame):
         self.optframe.addWidget(wc.QLabel("Command:"), 2, 0)
         self.commandLine = wc.QLineEdit("simpson")
         self.optframe.addWidget(self.commandLine, 3, 0)
+        self.persistentCheck = QtWidgets.QCheckBox("Persistent worker")
+        self.persistentCheck.setToolTip("The command keeps running and reads the scripts from stdin, see externalBridge")
+        self.optframe.addWidget(self.persistentCheck, 4, 0)
         self.numExp = QtWidgets.QComboBox()
         self.numExp.addItems([str(x + 1) for x in range(self.FITNUM)])
         self.numExp.currentIndexChanged.connect(self.changeNum)
@@ -4057,7 +4539,7 @@ class ExternalFitDeconvParamFrame(AbstractParamFrame):
         """
         Extra parameters to export.
         """
-        extraDict = {"Command": self.commandLine.text()}
+        extraDict = {"Command": self.commandLine.text(), "Persistent": self.persistentCheck.isChecked()}
         return (extraDict, {"Script": self.script})
 
     def extraFileToParam(self, preParams, postParams):
@@ -4068,19 +4550,22 @@ class ExternalFitDeconvParamFrame(AbstractParamFrame):
             self.analyseScript(postParams["Script"])
         if "Command" in preParams.keys():
             self.commandLine.setText(preParams["Command"])
+        if "Persistent" in preParams.keys():
+            self.persistentCheck.setChecked(preParams["Persistent"] in (True, "True"))
 
     def getExtraParams(self, out):
         """
         Returns the extra parameters of the fit.
         """
-        out['extra'] = [self.MULTINAMES, self.commandLine.text(), self.script, self.txtOutput, self.parent.spec()]
+        out['extra'] = [self.MULTINAMES, self.commandLine.text(), self.script, self.txtOutput, self.parent.spec(), self.persistentCheck.isChecked()]
         return (out, out['extra'])
 
-    def checkResults(self, numExp, struc):
+    def checkResults(self, numExp, struc, locList=None):
         """
         Fixes the fit results.
         """
-        locList = self.getRedLocList()
+        if locList is None:
+            locList = self.getRedLocList()
         for i in range(numExp):
             if struc["Lorentz"][i][0] == 1:
                 self.fitParamList[locList]["Lorentz"][i][0] = abs(self.fitParamList[locList]["Lorentz"][i][0])
@@ -4524,9 +5009,7 @@ class MqmasDeconvParamFrame(AbstractParamFrame):
         if MQ > (I*2):
             raise RuntimeError("MQ cannot be larger than I")
         cheng = safeEval(self.entries['cheng'][-1].text())
-        alpha, beta, weight = simFunc.zcw_angles(cheng, 2)
-        D2 = simFunc.D2tens(alpha, beta, np.zeros_like(alpha))
-        D4 = simFunc.D4tens(alpha, beta, np.zeros_like(alpha))
+        weight, D2, D4 = simFunc.powderAverage(cheng, 2)
         numssb = self.entries['numssb'][-1].value()
         MAStype = self.entries['spinType'][-1].currentIndex()
         shear = safeEval(self.entries['shear'][-1].text())
@@ -4534,13 +5017,14 @@ class MqmasDeconvParamFrame(AbstractParamFrame):
         out['extra'] = [I, MQ, numssb, angle, D2, D4, weight, shear, scale, MAStype]
         return (out, out['extra'])
 
-    def checkResults(self, numExp, struc):
+    def checkResults(self, numExp, struc, locList=None):
         """
         Sets the Lorentzian and Gaussian broadenings to absolute values.
         Sets eta between 0 and 1.
         Makes Cq positive.
         """
-        locList = self.getRedLocList()
+        if locList is None:
+            locList = self.getRedLocList()
         for i in range(numExp):
             if struc["Lorentz1"][i][0] == 1:
                 self.fitParamList[locList]["Lorentz1"][i][0] = abs(self.fitParamList[locList]["Lorentz1"][i][0])
@@ -4726,9 +5210,7 @@ class MqmasCzjzekParamFrame(AbstractParamFrame):
         Simulate the spectra for the Czjzek library.
         """
         angle = np.arctan(np.sqrt(2))
-        alpha, beta, weight = simFunc.zcw_angles(self.cheng, 2)
-        D2 = simFunc.D2tens(alpha, beta, np.zeros_like(alpha))
-        D4 = simFunc.D4tens(alpha, beta, np.zeros_like(alpha))
+        weight, D2, D4 = simFunc.powderAverage(self.cheng, 2)
         extra = [False, self.I, 2, angle, D2, D4, weight, 2]
         self.lib, self.cqLib, self.etaLib = simFunc.genLib(len(self.parent.xax()), self.cqmin, self.cqmax, self.etamin, self.etamax, self.cqsteps, self.etasteps, extra, self.parent.freq(), self.parent.sw(), np.inf)
 
@@ -4798,11 +5280,12 @@ class MqmasCzjzekParamFrame(AbstractParamFrame):
         out['extra'] = [I, MQ, self.cqLib, self.etaLib, self.lib, shear, scale, method, d]
         return (out, out['extra'])
 
-    def checkResults(self, numExp, struc):
+    def checkResults(self, numExp, struc, locList=None):
         """
         Fixes the fit results.
         """
-        locList = self.getRedLocList()
+        if locList is None:
+            locList = self.getRedLocList()
         for i in range(numExp):
             if struc["Lorentz1"][i][0] == 1:
                 self.fitParamList[locList]["Lorentz1"][i][0] = abs(self.fitParamList[locList]["Lorentz1"][i][0])
@@ -22,6 +22,8 @@ import numpy as np
 from scipy.special import wofz
 import scipy.constants as SC
 import scipy.linalg
+import scipy.interpolate
+import scipy.optimize
 
 def apodize(t, shift=0.0, lor=None, gauss=None, cos2=[None, None], hamming=None, wholeEcho=False):
     """
@@ -353,7 +355,7 @@ def quadConversion(Values, I, Type, Q=None):
         Vzz = None
     return [[CqNew, EtaNew], [WqNew, EtaNew], [Vxx, Vyy, Vzz]]
 
-def ACMEentropy(phaseIn, data, x, firstOrder=True):
+def ACMEentropy(phaseIn, data, x, firstOrder=True, gradient=False):
     """
     Calculates the cost value for autophasing.
 
@@ -361,34 +363,295 @@ def ACMEentropy(phaseIn, data, x, firstOrder=True):
     ----------
     phaseIn : list of float
         Should contain two values, the first one is the zero order phase, and the second one the first order phase.
-    data : ndarray
-        The data to be phased.
+    data : ndarray or tuple of ndarray
+        The data to be phased, or a tuple with the real and imaginary part of the data.
     x : ndarray
         The x-axis corresponding to the first order phasing.
     firstOrder : bool, optional
         If True, the first order phasing is included.
         True by default.
+    gradient : bool, optional
+        If True, the gradient with respect to the phases is returned as well.
+        False by default.
 
     Returns
     -------
+    float
         The cost value.
+    ndarray
+        The gradient, only returned when gradient is True.
     """
-    phase0 = phaseIn[0]
     if firstOrder:
         phase1 = phaseIn[1]
     else:
         phase1 = 0.0
-    L = len(data)
-    s0 = data * np.exp(1j * (phase0 + phase1 * x))
-    s2 = np.real(s0)
-    ds1 = np.abs((s2[3:L] - s2[1:L - 2]) / 2.0)
-    p1 = ds1 / sum(ds1)
-    p1[np.where(p1 == 0)] = 1
-    h1 = -p1 * np.log(p1)
-    H1 = sum(h1)
-    Pfun = 0.0
-    as1 = s2 - np.abs(s2)
-    sumas = sum(as1)
-    if np.real(sumas) < 0:
-        Pfun = Pfun + sum(as1**2) / 4 / L**2
-    return H1 + 1000 * Pfun
+    if isinstance(data, tuple):
+        parts = (data[0][np.newaxis], data[1][np.newaxis])
+    else:
+        parts = (np.real(data)[np.newaxis], np.imag(data)[np.newaxis])
+    result = ACMEentropyAll(phaseIn[0], phase1, parts, x, gradient)
+    if not gradient:
+        return result[0]
+    return result[0][0], result[1][0, :len(phaseIn) if firstOrder else 1]
+
+def ACMEentropyAll(phase0, phase1, data, x, gradient=False):
+    """
+    Calculates the cost values for autophasing of several traces at once.
+    The value of every trace equals the value of ACMEentropy.
+    The phases are applied as a combination of the cosine and sine of the phase with the real and imaginary part of the data.
+
+    Parameters
+    ----------
+    phase0 : ndarray
+        The zero order phase of every trace.
+    phase1 : ndarray
+        The first order phase of every trace.
+    data : ndarray or tuple of ndarray
+        The traces to be phased, as a 2D array with one trace per row.
+        A tuple with the real and imaginary part of the traces avoids splitting the data on every call.
+    x : ndarray
+        The x-axis corresponding to the first order phasing.
+    gradient : bool, optional
+        If True, the gradient with respect to the phases is returned as well.
+        False by default.
+
+    Returns
+    -------
+    ndarray
+        The cost value of every trace.
+    ndarray
+        The gradient with respect to the zero and first order phase of every trace, only returned when gradient is True.
+    """
+    if isinstance(data, tuple):
+        dataReal, dataImag = data
+    else:
+        dataReal, dataImag = np.real(data), np.imag(data)
+    L = dataReal.shape[-1]
+    phase0 = np.reshape(phase0, (-1, 1))
+    phase1 = np.reshape(phase1, (-1, 1))
+    if np.any(phase1 != 0):
+        phase = phase0 + phase1 * x
+    else:
+        phase = phase0 # Only the zero order phase, which does not require a cosine and sine per point
+    cos = np.cos(phase)
+    sin = np.sin(phase)
+    s2 = dataReal * cos
+    s2 -= dataImag * sin
+    # The factor 1/2 of the derivative cancels in the normalization, so it is left out
+    diff = s2[:, 3:L] - s2[:, 1:L - 2]
+    p1 = np.abs(diff)
+    total = np.sum(p1, axis=1)
+    p1 /= total[:, np.newaxis]
+    logP = np.zeros_like(p1)
+    np.log(p1, out=logP, where=p1 > 0)
+    H1 = -np.einsum('ij,ij->i', p1, logP)
+    negative = np.minimum(s2, 0) # Half of the negative part of the spectrum
+    Pfun = np.einsum('ij,ij->i', negative, negative) / L**2
+    cost = H1 + 1000 * Pfun
+    if not gradient:
+        return cost
+    grad = np.zeros((len(cost), 2))
+    ds2 = dataReal * sin
+    ds2 += dataImag * cos
+    ds2 *= -1 # Derivative of s2 with respect to the zero order phase
+    sign = np.sign(diff)
+    for i, deriv in enumerate((ds2, ds2 * x)):
+        dds1 = deriv[:, 3:L] - deriv[:, 1:L - 2]
+        dds1 *= sign
+        dH1 = -(np.einsum('ij,ij->i', logP, dds1) + np.sum(dds1, axis=1) * H1) / total
+        dPfun = 2 * np.einsum('ij,ij->i', negative, deriv) / L**2
+        grad[:, i] = dH1 + 1000 * dPfun
+    return cost, grad
+
+def autoPhaseTraces(inp):
+    """
+    Determines the autophasing values of several traces at once.
+    The zero and first order phase can first be searched on a coarse grid.
+    Afterwards, the phases are refined with a quasi-Newton method.
+    Every trace keeps its own 2x2 inverse Hessian, which is updated with BFGS after each accepted step.
+    The steps are accepted by an Armijo backtracking line search, which halves rejected steps.
+    A trace is done when its step is smaller than the tolerance.
+    All traces are optimized together, such that the cost function is evaluated for all traces in one step.
+
+    Parameters
+    ----------
+    inp: list with parameters:
+        0: 2D ndarray with one spectrum per row
+        1: 1D ndarray with the x-axis corresponding to the first order phasing
+        2: bool, if True the first order phase is optimized as well
+        3: float, the tolerance of the phases
+        4: bool, optional, if False the coarse grid search is skipped and the refinement starts at zero phase
+
+    Returns
+    -------
+    ndarray:
+        2D array with the zero and first order phase of every trace.
+    """
+    data, x, firstOrder, xtol = inp[:4]
+    gridSearch = inp[4] if len(inp) > 4 else True
+    parts = (np.ascontiguousarray(np.real(data)), np.ascontiguousarray(np.imag(data)))
+    numTraces = len(parts[0])
+    phases = np.zeros((numTraces, 2))
+    if gridSearch:
+        grid = np.linspace(-np.pi, np.pi, 16, endpoint=False)
+        zeros = np.zeros(numTraces)
+        cost = [ACMEentropyAll(zeros + val, zeros, parts, x) for val in grid]
+        phases[:, 0] = grid[np.argmin(cost, axis=0)]
+        if firstOrder:
+            # The first order phase has half the effect at the edges of the spectrum, so a twice larger range is searched
+            cost = [ACMEentropyAll(phases[:, 0], zeros + 2 * val, parts, x) for val in grid]
+            phases[:, 1] = 2 * grid[np.argmin(cost, axis=0)]
+    cost, grad = ACMEentropyAll(phases[:, 0], phases[:, 1], parts, x, True)
+    if not firstOrder:
+        grad[:, 1] = 0
+    # Quasi-Newton with a 2x2 inverse Hessian per trace, initially steps of about 3 degrees
+    hessian = np.eye(2) * (0.05 / np.maximum(np.sqrt(np.sum(grad**2, axis=1)), 1e-12))[:, np.newaxis, np.newaxis]
+    direction = -np.einsum('nij,nj->ni', hessian, grad)
+    stepSize = np.ones(numTraces)
+    active = np.arange(numTraces)
+    for _ in range(200):
+        step = stepSize[active, np.newaxis] * direction[active]
+        newPhases = phases[active] + step
+        newCost, newGrad = ACMEentropyAll(newPhases[:, 0], newPhases[:, 1], (parts[0][active], parts[1][active]), x, True)
+        if not firstOrder:
+            newGrad[:, 1] = 0
+        better = newCost <= cost[active] + 1e-4 * np.sum(step * grad[active], axis=1)
+        stepLength = np.sqrt(np.sum(step**2, axis=1))
+        # Rejected steps are halved, accepted steps update the inverse Hessian
+        stepSize[active[~better]] /= 2
+        acc = active[better]
+        s = step[better]
+        y = newGrad[better] - grad[acc]
+        sy = np.sum(s * y, axis=1)
+        update = sy > 1e-12
+        rho = 1 / np.where(update, sy, 1)
+        Hy = np.einsum('nij,nj->ni', hessian[acc], y)
+        yHy = np.sum(y * Hy, axis=1)
+        newHessian = hessian[acc] + ((1 + rho * yHy) * rho)[:, np.newaxis, np.newaxis] * np.einsum('ni,nj->nij', s, s) \
+            - rho[:, np.newaxis, np.newaxis] * (np.einsum('ni,nj->nij', Hy, s) + np.einsum('ni,nj->nij', s, Hy))
+        hessian[acc] = np.where(update[:, np.newaxis, np.newaxis], newHessian, hessian[acc])
+        phases[acc] = newPhases[better]
+        cost[acc] = newCost[better]
+        grad[acc] = newGrad[better]
+        direction[acc] = -np.einsum('nij,nj->ni', hessian[acc], grad[acc])
+        stepSize[acc] = 1
+        active = active[stepLength >= xtol]
+        if len(active) == 0:
+            break
+    return phases
+
+def baselineSelection(length, removeList, invert=False):
+    """
+    Determines which points are used to fit a baseline.
+
+    Parameters
+    ----------
+    length : int
+        The number of points of a trace.
+    removeList : list of int
+        Pairs of indices between which the points are not used.
+    invert : bool, optional
+        If True, only the points between the pairs of indices are used.
+        False by default.
+
+    Returns
+    -------
+    ndarray
+        Boolean array which is True for the points that are used.
+    """
+    tmpAx = np.arange(length)
+    bArray = np.ones(length, dtype=bool)
+    for i in range(len(removeList) // 2):
+        minVal = min(removeList[2 * i], removeList[2 * i + 1])
+        maxVal = max(removeList[2 * i], removeList[2 * i + 1])
+        bArray = np.logical_and(bArray, np.logical_or((tmpAx < minVal), (tmpAx > maxVal)))
+    if invert:
+        bArray = np.logical_not(bArray)
+    return bArray
+
+def baselineFit(x, data, bArray, degree=3, method='poly', numKnots=8, lam=1e5, asym=0.01, numIter=10):
+    """
+    Fits the baseline of several traces at once.
+    The polynomial and spline baselines are linear least-squares fits, which are solved for all traces together.
+    The asymmetric least squares baseline is a smooth curve that is iteratively pushed below the peaks.
+
+    Parameters
+    ----------
+    x : ndarray
+        The x-axis of the traces.
+    data : ndarray
+        The traces, as a 1D array or a 2D array with one trace per row.
+    bArray : ndarray
+        Boolean array which is True for the points that are used for the fit.
+    degree : int, optional
+        The degree of the polynomial.
+        3 by default.
+    method : {'poly', 'spline', 'als'}, optional
+        The type of baseline: a polynomial, a cubic spline or an asymmetric least squares baseline.
+        'poly' by default.
+    numKnots : int, optional
+        The number of segments of the spline.
+        8 by default.
+    lam : float, optional
+        The smoothness of the asymmetric least squares baseline.
+        1e5 by default.
+    asym : float, optional
+        The weight of the points above the asymmetric least squares baseline, the points below get a weight of 1 - asym.
+        0.01 by default.
+    numIter : int, optional
+        The maximum number of iterations of the asymmetric least squares baseline.
+        10 by default.
+
+    Returns
+    -------
+    ndarray
+        The baselines with the same shape as data.
+    """
+    data = np.asarray(data)
+    traces = np.atleast_2d(data)
+    if method in ('poly', 'spline'):
+        xFit = x[bArray]
+        if method == 'poly':
+            # Scale the x-axis of the fitted points to [-1, 1] to keep the Vandermonde matrix well conditioned
+            center = (np.max(xFit) + np.min(xFit)) / 2.0
+            scale = max((np.max(xFit) - np.min(xFit)) / 2.0, np.finfo(float).tiny)
+            design = np.polynomial.polynomial.polyvander((x - center) / scale, degree)
+        else:
+            inner = np.unique(np.quantile(xFit, np.linspace(0, 1, numKnots + 1)[1:-1]))
+            inner = inner[(inner > np.min(x)) & (inner < np.max(x))]
+            knots = np.concatenate(([np.min(x)] * 4, inner, [np.max(x)] * 4))
+            design = scipy.interpolate.BSpline.design_matrix(x, knots, 3).toarray()
+        # All traces share the design matrix, so the least-squares problem is solved once for all of them
+        coeff = np.dot(traces[:, bArray], np.linalg.pinv(design[bArray]).T)
+        fit = np.dot(coeff, design.T)
+    elif method == 'als':
+        if np.iscomplexobj(traces):
+            # Fit the real and imaginary parts as separate traces
+            fit = baselineFit(x, np.concatenate((np.real(traces), np.imag(traces))), bArray, degree, method, numKnots, lam, asym, numIter)
+            fit = fit[:len(traces)] + 1j * fit[len(traces):]
+            return fit.reshape(data.shape)
+        length = traces.shape[-1]
+        # Banded upper form of lam * D.T D, with D the second difference matrix
+        penalty = np.zeros((3, length))
+        penalty[2] = 6
+        penalty[2, [0, -1]] = 1
+        penalty[2, [1, -2]] = 5
+        penalty[1, 1:] = -4
+        penalty[1, [1, -1]] = -2
+        penalty[0, 2:] = 1
+        penalty *= lam
+        fit = np.empty_like(traces, dtype=float)
+        for i, trace in enumerate(traces):
+            weights = bArray.astype(float)
+            for _ in range(numIter):
+                band = penalty.copy()
+                band[2] += weights
+                base = scipy.linalg.solveh_banded(band, weights * trace)
+                newWeights = np.where(trace > base, asym, 1 - asym) * bArray
+                if np.array_equal(newWeights, weights):
+                    break
+                weights = newWeights
+            fit[i] = base
+    else:
+        raise ValueError("Unknown baseline method: " + str(method))
+    return fit.reshape(data.shape)
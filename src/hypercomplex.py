@@ -17,8 +17,13 @@
 # You should have received a copy of the GNU General Public License
 # along with ssNake. If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import atexit
+import shutil
+import tempfile
 import warnings
 import numpy as np
+import fftEngine as fe
 
 def parity(x):
     # Find the parity of an integer
@@ -31,9 +36,146 @@ def parity(x):
     return int(parity)
 
 
+def complexType(data):
+    """
+    Returns the complex type that holds data without loss of precision.
+    Single precision data gives complex64, everything else complex128.
+
+    Parameters
+    ----------
+    data : array_like
+        The data, or a sequence of arrays.
+
+    Returns
+    -------
+    type
+        np.complex64 or np.complex128.
+    """
+    while isinstance(data, (list, tuple)) and data:
+        data = data[0]
+    dtype = getattr(data, 'dtype', None)
+    if dtype in (np.float16, np.float32, np.complex64):
+        return np.complex64
+    return np.complex128
+
+
 class HComplexException(Exception):
     pass
 
+#########################################################################
+# the scratch space for data that does not fit in memory
+
+
+class ScratchSpace(object):
+    """
+    Creates the temporary files that hold data which is too large to be kept in memory.
+    The data in these files is processed in chunks of limited size.
+    """
+
+    def __init__(self, maxSize=4 * 1024**3, chunkSize=64 * 1024**2, directory=None):
+        """
+        Initializes the scratch space.
+
+        Parameters
+        ----------
+        maxSize : int, optional
+            Data larger than this number of bytes is kept on disk.
+            A value of 0 keeps all data in memory.
+            By default 4 GB.
+        chunkSize : int, optional
+            The maximum size of the chunks in which data on disk is processed in bytes.
+            By default 64 MB.
+        directory : str or None, optional
+            The directory in which the temporary files are created.
+            By default None, which uses the temporary directory of the system.
+        """
+        self.maxSize = maxSize
+        self.chunkSize = chunkSize
+        self.directory = directory
+        self.tmpDir = None
+
+    def setMaxSize(self, maxSize):
+        """
+        Sets the size above which data is kept on disk.
+
+        Parameters
+        ----------
+        maxSize : int
+            The size in bytes.
+            A value of 0 keeps all data in memory.
+        """
+        self.maxSize = maxSize
+
+    def isLarge(self, nbytes):
+        """
+        Checks whether data should be kept on disk.
+
+        Parameters
+        ----------
+        nbytes : int
+            The size of the data in bytes.
+
+        Returns
+        -------
+        bool
+            True if the data is larger than the maximum size.
+        """
+        return self.maxSize > 0 and nbytes > self.maxSize
+
+    def empty(self, shape, dtype):
+        """
+        Creates an array that is stored in a temporary file.
+        The file is removed when the array is deleted, or when the program exits on systems that cannot remove open files.
+
+        Parameters
+        ----------
+        shape : tuple of ints
+            The shape of the array.
+        dtype : type
+            The type of the array.
+
+        Returns
+        -------
+        memmap
+            The array, which is initialized with zeros.
+        """
+        if self.tmpDir is None or not os.path.isdir(self.tmpDir):
+            self.tmpDir = tempfile.mkdtemp(prefix='ssNakeScratch', dir=self.directory)
+            atexit.register(shutil.rmtree, self.tmpDir, True)
+        handle, fileName = tempfile.mkstemp(suffix='.dat', dir=self.tmpDir)
+        os.close(handle)
+        array = np.memmap(fileName, dtype=dtype, mode='w+', shape=tuple(shape))
+        try:
+            os.remove(fileName) # The data stays available until the array is deleted
+        except (IOError, OSError):
+            pass
+        return array
+
+    def chunks(self, shape, axis, itemsize):
+        """
+        Splits an array along an axis into chunks that are not larger than the chunk size.
+
+        Parameters
+        ----------
+        shape : tuple of ints
+            The shape of the array.
+        axis : int
+            The axis along which the array is split.
+        itemsize : int
+            The number of bytes per element.
+
+        Returns
+        -------
+        list of slices
+            The index ranges along axis of the chunks.
+        """
+        length = shape[axis]
+        rowSize = int(np.prod(shape)) // max(length, 1) * itemsize
+        step = max(1, self.chunkSize // max(rowSize, 1))
+        return [slice(i, min(i + step, length)) for i in range(0, length, step)]
+
+SCRATCH = ScratchSpace()
+
 #########################################################################
 # the hyper complex data class
 
@@ -53,7 +195,7 @@ class HComplexData(object):
     self.data contains complex values, the imaginary values are from the last dimension which is always complex and is not listed in self.hyper.
     """
 
-    def __init__(self, data=None, hyper=None):
+    def __init__(self, data=None, hyper=None, dtype=None):
         """
         Initializes the HComplexData
 
@@ -67,19 +209,24 @@ class HComplexData(object):
             Is used as the hyper list of the hypercomplex data
             If hyper is None, data is assumed to be regular complex data and an additional dimension
             is added to hold the hypercomplex information.
+        dtype : type, optional
+            The complex type of the data.
+            By default single precision data is stored as complex64 and all other data as complex128.
         """
+        if dtype is None:
+            dtype = complexType(data)
         if data is None:
-            self.data = np.array([], dtype=complex)
+            self.data = np.array([], dtype=dtype)
             self.hyper = np.array([])
         else:
             if hyper is None:
                 # Data is not hypercomplex
-                self.data = np.array([data], dtype=complex)
+                self.data = np.array([data], dtype=dtype)
                 self.hyper = np.array([0])
             else:
                 if len(hyper) != len(data):
                     raise HComplexException('Length of hyper and data mismatch')
-                self.data = np.array(data, dtype=complex)
+                self.data = np.array(data, dtype=dtype)
                 self.hyper = np.array(hyper)
 
     def ndim(self):
@@ -157,7 +304,7 @@ class HComplexData(object):
         if isinstance(other, HComplexData):
             tmpHyper = np.unique(np.concatenate((self.hyper, other.hyper)))
             tmpHyper.sort()
-            tmpData = np.zeros((len(tmpHyper),) + np.broadcast(self.data[0], other.data[0]).shape, dtype=complex)
+            tmpData = np.zeros((len(tmpHyper),) + np.broadcast(self.data[0], other.data[0]).shape, dtype=np.result_type(self.data, other.data))
             for i in self.hyper:
                 tmpData[i == tmpHyper] = self.data[i == self.hyper]
             for i in other.hyper:
@@ -196,7 +343,7 @@ class HComplexData(object):
                 tmpHyper = np.concatenate((tmpHyper, xorHyper))
             tmpHyper = np.unique(tmpHyper)
             tmpHyper.sort()
-            tmpData = np.zeros((len(tmpHyper),) + np.broadcast(self.data[0], other.data[0]).shape, dtype=complex)
+            tmpData = np.zeros((len(tmpHyper),) + np.broadcast(self.data[0], other.data[0]).shape, dtype=np.result_type(self.data, other.data))
             for i, idim in enumerate(self.hyper):
                 for j, jdim in enumerate(other.hyper):
                     if parity(idim & jdim):
@@ -297,14 +444,33 @@ class HComplexData(object):
         HComplexData
             The complex conjugated data.
         """
+        return self.copy().iconj(axis)
+
+    def iconj(self, axis):
+        """
+        Compute the complex conjugate along a specific axis.
+        The operation is applied in place for efficiency.
+
+        Parameters
+        ----------
+        axis : int
+            The axis along which to calculate the complex conjugate.
+            If the axis is hypercomplex, the hypercomplex conjugate of that axis is returned.
+            Otherwise the complex conjugate of the entire data is returned.
+
+        Returns
+        -------
+        HComplexData
+            A pointer to self
+        """
         if axis < 0:
             axis = self.ndim() + axis
         if not self.isHyperComplex(axis) or axis == (self.ndim()-1):
-            return HComplexData(np.conj(self.data), np.copy(self.hyper))
-        tmpData = np.copy(self.data)
-        imagBool = np.array(self.hyper & (2**axis), dtype=bool)
-        tmpData[imagBool] = -tmpData[imagBool]
-        return HComplexData(tmpData, np.copy(self.hyper))
+            np.conjugate(self.data, out=self.data)
+            return self
+        for i in np.nonzero(self.hyper & (2**axis))[0]:
+            self.data[i] *= -1
+        return self
 
     def conjAll(self):
         """
@@ -395,6 +561,17 @@ class HComplexData(object):
             return True
         return self.isHyperComplex(axis)
 
+    def isMapped(self):
+        """
+        Test whether the data is kept in a file instead of in memory.
+
+        Returns
+        -------
+        bool
+            True means the data is a memory map.
+        """
+        return isinstance(self.data, np.memmap)
+
     def isHyperComplex(self, axis):
         """
         Test whether an axis is hypercomplex.
@@ -488,7 +665,7 @@ class HComplexData(object):
         tmpHyper = np.concatenate((self.hyper[np.logical_not(bArray)], self.hyper[bArray] - bit))
         tmpHyper = np.unique(tmpHyper)
         tmpHyper.sort()
-        tmpData = np.zeros((len(tmpHyper),) + self.data[0].shape, dtype=complex)
+        tmpData = np.zeros((len(tmpHyper),) + self.data[0].shape, dtype=self.data.dtype)
         for i, idim in enumerate(tmpHyper):
             if idim in self.hyper and (idim+bit) in self.hyper:
                 tmpData[i] += np.sqrt(np.real(self.data[idim == self.hyper][0])**2 + np.real(self.data[(idim+bit) == self.hyper][0])**2)
@@ -539,11 +716,23 @@ class HComplexData(object):
             # If the data is not complex along that axis return the data unchanged
             return self
         bit = 2**axis
+        hyperList = list(self.hyper)
+        if self.data.flags.writeable and np.iscomplexobj(self.data) and all((i ^ bit) in hyperList for i in hyperList):
+            # Every part has its partner along axis, so the reordering is a permutation of the real and imaginary components
+            for i, idim in enumerate(hyperList):
+                if idim & bit:
+                    continue
+                low = self.data[i]
+                high = self.data[hyperList.index(idim | bit)]
+                tmp = np.array(low.imag)
+                low.imag = high.real
+                high.real = tmp
+            return self
         bArray = np.array(self.hyper & bit, dtype=bool)
         tmpHyper = np.concatenate((self.hyper, self.hyper[bArray] - bit, self.hyper[np.logical_not(bArray)] + bit))
         tmpHyper = np.unique(tmpHyper)
         tmpHyper.sort()
-        tmpData = np.zeros((len(tmpHyper),) + self.data[0].shape, dtype=complex)
+        tmpData = np.zeros((len(tmpHyper),) + self.data[0].shape, dtype=self.data.dtype)
         tmpBArray = np.array(self.hyper & bit, dtype=bool)
         tmpData[np.logical_not(tmpBArray)] = np.real(self.data[np.logical_not(bArray)]) + 1j*np.real(self.data[bArray])
         tmpData[tmpBArray] = np.imag(self.data[np.logical_not(bArray)]) + 1j*np.imag(self.data[bArray])
@@ -704,6 +893,15 @@ class HComplexData(object):
         slicing1 = (slice(None), ) * (axis+1) + (slice(None, None, 2), ) + (slice(None), ) * (self.ndim() - 1 - axis)
         slicing2 = (slice(None), ) * (axis+1) + (slice(1, None, 2), ) + (slice(None), ) * (self.ndim() - 1 - axis)
         addHyper = self.hyper + 2**axis
+        if len(self.hyper) == 1:
+            # The even and odd points become the two parts along axis without copying the data
+            shape = self.data.shape
+            tmpData = self.data.reshape(shape[:axis+1] + (shape[axis+1] // 2, 2) + shape[axis+2:])
+            self.data = np.moveaxis(tmpData[0], axis+1, 0)
+            self.hyper = np.append(self.hyper, addHyper)
+            if TPPI:
+                self.data[slicing2] *= -1
+            return
         insertOrder = np.searchsorted(self.hyper, addHyper)
         tmp1 = self.data[slicing1]
         tmp2 = self.data[slicing2]
@@ -759,7 +957,8 @@ class HComplexData(object):
         """
         if axis >= 0:
             axis += 1
-        return HComplexData(np.mean(self.data, axis=axis, **kwargs), np.copy(self.hyper))
+        kwargs.setdefault('dtype', np.complex128) # Accumulate single precision data in double precision
+        return HComplexData(np.mean(self.data, axis=axis, **kwargs), np.copy(self.hyper), dtype=self.data.dtype)
 
     def sum(self, axis=-1, **kwargs):
         """
@@ -780,7 +979,8 @@ class HComplexData(object):
         """
         if axis >= 0:
             axis += 1
-        return HComplexData(np.sum(self.data, axis=axis, **kwargs), np.copy(self.hyper))
+        kwargs.setdefault('dtype', np.complex128) # Accumulate single precision data in double precision
+        return HComplexData(np.sum(self.data, axis=axis, **kwargs), np.copy(self.hyper), dtype=self.data.dtype)
 
     def max(self, axis=-1):
         """
@@ -960,7 +1160,7 @@ class HComplexData(object):
         """
         if axis >= 0:
             axis += 1
-        return HComplexData(np.cumsum(self.data, axis=axis), np.copy(self.hyper))
+        return HComplexData(np.cumsum(self.data, axis=axis, dtype=np.complex128), np.copy(self.hyper), dtype=self.data.dtype)
 
     def hilbert(self, axis=-1):
         """
@@ -1038,7 +1238,7 @@ class HComplexData(object):
             slicing2 = (slice(None), ) * axis + (slice(pos, None), )
             zeroShape = np.array(self.data.shape)
             zeroShape[axis] = size - oldSize
-            tmpData = np.concatenate((self.data[slicing1], np.zeros(zeroShape), self.data[slicing2]), axis=axis)
+            tmpData = np.concatenate((self.data[slicing1], np.zeros(zeroShape, dtype=self.data.dtype), self.data[slicing2]), axis=axis)
         else:
             difference = oldSize - size
             removeBegin = int(np.floor(difference / 2))
@@ -1084,9 +1284,8 @@ class HComplexData(object):
             raise HComplexException("Positions out of bounds in reorder")
         newShape = np.array(self.data.shape)
         newShape[axis] = newLength
-        tmpData = np.zeros(newShape, dtype=complex)
         slicing = (slice(None), ) * axis + (pos, )
-        tmpData = np.zeros(newShape, dtype=complex)
+        tmpData = np.zeros(newShape, dtype=self.data.dtype)
         tmpData[slicing] = self.data
         return HComplexData(tmpData, np.copy(self.hyper))
 
@@ -1150,7 +1349,7 @@ class HComplexData(object):
         """
         if axis >= 0:
             axis += 1
-        return HComplexData(np.fft.fft(self.data, axis=axis), np.copy(self.hyper))
+        return HComplexData(fe.ENGINE.fft(self.data, axis=axis), np.copy(self.hyper))
 
     def ifft(self, axis=-1):
         """
@@ -1169,7 +1368,7 @@ class HComplexData(object):
         """
         if axis >= 0:
             axis += 1
-        return HComplexData(np.fft.ifft(self.data, axis=axis), np.copy(self.hyper))
+        return HComplexData(fe.ENGINE.ifft(self.data, axis=axis), np.copy(self.hyper))
 
     def fftshift(self, axis=-1):
         """
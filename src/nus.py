@@ -19,7 +19,14 @@
 
 import numpy as np
 import scipy.optimize
-import scipy.signal
+try:
+    import multiprocessing.shared_memory as sharedMemory
+except ImportError:
+    sharedMemory = None
+import fftEngine as fe
+import workerPool as wp
+
+BLOCKSIZE = 1024**2  # The maximum size of the input data of a block in bytes, small blocks keep the intermediate arrays in the cache
 
 
 def ent_ffm(missingPoints, fid, posArray):
@@ -40,8 +47,8 @@ def ent_ffm(missingPoints, fid, posArray):
 
     """
     fid[posArray] = missingPoints[:len(posArray)] + 1j * missingPoints[len(posArray):]
-    spec = np.fft.fft(fid)
-    zn = np.fft.fft((np.imag(spec) + 1j * np.real(spec)) / np.abs(spec))
+    spec = fe.ENGINE.fft(fid)
+    zn = fe.ENGINE.fft((np.imag(spec) + 1j * np.real(spec)) / np.abs(spec), overwrite=True)
     return (np.sum(np.abs(spec)), np.append(np.imag(zn[posArray]), np.real(zn[posArray])))
 
 
@@ -60,15 +67,129 @@ def ffm(inp):
     ndarray:
         1D array of the corrected spectrum.
     """
-    l = len(inp[1])
-    res = scipy.optimize.minimize(ent_ffm,
-                                  np.zeros(l * 2),
-                                  method='L-BFGS-B',
-                                  args=inp,
-                                  jac=True)
-    inp[0][inp[1]] = res['x'][:l] + 1j * res['x'][l:]
-    return np.fft.fftshift(np.fft.fft(inp[0]))
+    return ffmBlock(np.array(inp[0])[np.newaxis], inp[1])[0][0]
+
+
+class FFMEntropy(object):
+    """
+    The FFM cost function of a 1D FID and its gradient.
+    The work buffers are reused between evaluations.
+    """
+
+    def __init__(self, length, posList):
+        """
+        Initializes the cost function.
+
+        Parameters
+        ----------
+        length: int
+            The number of points of the FID
+        posList: ndarray
+            1D array with the indexes of the 'bad' points of the FID
+        """
+        self.posList = np.asarray(posList, dtype=int)
+        self.fid = np.zeros(length, dtype=complex)
+        self.absSpec = np.zeros(length)
+
+    def setFid(self, fid):
+        """
+        Sets the FID of which the missing points are optimized.
+
+        Parameters
+        ----------
+        fid: ndarray
+            1D array with the 'bad' FID
+        """
+        self.fid[...] = fid
+
+    def __call__(self, missingPoints):
+        """
+        Computes the cost and its gradient, the same as ent_ffm.
 
+        Parameters
+        ----------
+        missingPoints: ndarray
+            1D array with the real parts followed by the imaginary parts of the missing points
+
+        Returns
+        -------
+        float:
+            The cost.
+        ndarray:
+            The gradient of the cost.
+        """
+        l = len(self.posList)
+        self.fid.real[self.posList] = missingPoints[:l]
+        self.fid.imag[self.posList] = missingPoints[l:]
+        spec = fe.ENGINE.fft(self.fid)
+        np.abs(spec, out=self.absSpec)
+        # (imag + 1j * real) / abs is computed in place as 1j * conj / abs
+        np.conjugate(spec, out=spec)
+        spec /= self.absSpec
+        spec *= 1j
+        zn = fe.ENGINE.fft(spec, overwrite=True)[self.posList]
+        return np.sum(self.absSpec), np.concatenate((zn.imag, zn.real))
+
+
+def ffmBlock(data, posList, tol=None, maxIter=None, warmStart=True):
+    """
+    Performs FFM NUS reconstruction of a block of FIDs.
+    Every FID is optimized separately.
+    With warmStart, the optimization of an FID starts from the solution of the previous FID when that has a lower cost than zeros.
+
+    Parameters
+    ----------
+    data: ndarray
+        2D array with the 'bad' FIDs along the last axis
+    posList: ndarray
+        1D array with the indexes of the 'bad' points of the FIDs
+    tol: float, optional
+        The relative change of the cost at which the optimization stops.
+        By default the default of L-BFGS-B.
+    maxIter: int, optional
+        The maximum number of iterations per FID.
+        By default the default of L-BFGS-B.
+    warmStart: bool, optional
+        Start from the solution of the previous FID.
+        True by default.
+
+    Returns
+    -------
+    ndarray:
+        2D array of the corrected spectra.
+    ndarray:
+        The number of iterations of every FID.
+    ndarray:
+        Boolean array which is True for the FIDs for which the optimization converged.
+    """
+    l = len(posList)
+    result = np.zeros(data.shape, dtype=complex)
+    iterations = np.zeros(len(data), dtype=int)
+    converged = np.zeros(len(data), dtype=bool)
+    options = {}
+    if tol is not None:
+        options['ftol'] = tol
+    if maxIter is not None:
+        options['maxiter'] = maxIter
+    entropy = FFMEntropy(data.shape[-1], posList)
+    previous = None
+    for i, trace in enumerate(data):
+        entropy.setFid(trace)
+        start = np.zeros(l * 2)
+        if warmStart and previous is not None and entropy(previous)[0] < entropy(start)[0]:
+            start = previous
+        res = scipy.optimize.minimize(entropy,
+                                      start,
+                                      method='L-BFGS-B',
+                                      jac=True,
+                                      options=options)
+        fid = np.array(trace, dtype=complex)
+        fid[posList] = res['x'][:l] + 1j * res['x'][l:]
+        result[i] = np.fft.fftshift(fe.ENGINE.fft(fid))
+        iterations[i] = res['nit']
+        converged[i] = res['success']
+        previous = res['x']
+    return result, iterations, converged
 
 def clean(inp):
     """
@@ -88,23 +209,62 @@ def clean(inp):
     ndarray:
         1D array of the corrected spectrum.
     """
-    residuals = inp[0]
-    mask = inp[1]
-    gamma = inp[2]
-    stopLevel = inp[3]
-    maxIter = inp[4]
-    replica = np.zeros(len(residuals), dtype=complex)
+    return cleanBlock(np.array(inp[0])[np.newaxis], *inp[1:])[0][0]
+
+
+def cleanBlock(data, mask, gamma, stopLevel, maxIter):
+    """
+    Performs CLEAN NUS reconstruction of a block of spectra.
+    All spectra are cleaned at the same time, spectra that reached the stopping limit are removed from the calculation.
+
+    Parameters
+    ----------
+    data: ndarray
+        2D array with the 'bad' spectra along the last axis
+    mask: ndarray
+        1D array of the fft of the mask
+    gamma: float
+        Gamma value of the CLEAN calculation
+    stopLevel: float
+        Stopping limit (0 < x < 1) (stop if residual intensity below this point)
+    maxIter: int
+        Maximum number of iterations
+
+    Returns
+    -------
+    ndarray:
+        2D array of the corrected spectra.
+    ndarray:
+        The number of iterations of every spectrum.
+    ndarray:
+        Boolean array which is True for the spectra that reached the stopping limit.
+    """
+    residuals = np.array(data, dtype=np.result_type(data, mask))
+    length = residuals.shape[-1]
+    result = np.zeros(residuals.shape, dtype=residuals.dtype)
+    iterations = np.full(len(residuals), maxIter, dtype=int)
+    converged = np.zeros(len(residuals), dtype=bool)
+    replica = np.zeros_like(residuals)
+    active = np.arange(len(residuals))  # The traces that are still being cleaned
+    points = np.arange(length)
     for i in range(maxIter):
-        findMax = np.argmax(np.abs(residuals))
-        maxAmp = residuals[findMax]
-        if np.abs(maxAmp) < np.abs(np.mean(residuals)) * stopLevel:
-            break
-        replica[findMax] += maxAmp * gamma
-        residuals -= maxAmp * gamma * np.roll(mask, findMax)
-    replica += residuals
-    replica = np.real(np.fft.fftshift(replica))
-    #Return 'good' spectrum
-    return replica
+        findMax = np.argmax(np.abs(residuals), axis=-1)
+        maxAmp = residuals[np.arange(len(active)), findMax]
+        stop = np.abs(maxAmp) < np.abs(np.mean(residuals, axis=-1)) * stopLevel
+        if np.any(stop):
+            result[active[stop]] = replica[stop] + residuals[stop]
+            iterations[active[stop]] = i
+            converged[active[stop]] = True
+            keep = ~stop
+            active, residuals, replica, findMax, maxAmp = active[keep], residuals[keep], replica[keep], findMax[keep], maxAmp[keep]
+            if not active.size:
+                break
+        maxAmp = maxAmp * gamma
+        replica[np.arange(len(active)), findMax] += maxAmp
+        residuals -= maxAmp[:, np.newaxis] * mask[(points - findMax[:, np.newaxis]) % length]  # The mask rolled to every maximum
+    result[active] = replica + residuals
+    #Return 'good' spectra
+    return np.real(np.fft.fftshift(result, axes=-1)), iterations, converged
 
 
 def ist(inp):  # Iterative soft thresholding
@@ -126,28 +286,350 @@ def ist(inp):  # Iterative soft thresholding
     ndarray:
         1D array of the corrected spectrum.
     """
-    data = inp[0]
-    posList = inp[1]  # data points that must be set to zero
-    threshold = inp[2]  # level at which the data is cut
-    ittnum = inp[3]
-    tracelimit = inp[4]  # stoping condition when maximum of residual is below tracelimit*2DMax
-    NDmax = inp[5]  # max of ND data. Needed for stopping limit.
-    result = np.zeros_like(data, dtype=complex)
-    data[0] = data[0] * 0.5
+    return istBlock(np.array(inp[0])[np.newaxis], *inp[1:])[0][0]
+
+
+def istBlock(data, posList, threshold, ittnum, tracelimit, NDmax):
+    """
+    Performs Iterative Soft Thresholding of a block of FIDs.
+    All FIDs are transformed and thresholded at the same time, FIDs that reached the stopping limit are removed from the calculation.
+
+    Parameters
+    ----------
+    data: ndarray
+        2D array with the FIDs (reshaped to contain the zeros) along the last axis
+    posList: ndarray
+        1D array with the 'zero' positions
+    threshold: float
+        The level (0 < x < 1) at which the data is cut every iteration
+    ittnum: int
+        Maximum number of iterations
+    tracelimit: float
+        Stopping limit (0 < x < 1) (stop if residual intensity below this point)
+    NDmax: float
+        Maxmimum of the ND data, needed for the stopping limit
+
+    Returns
+    -------
+    ndarray:
+        2D array of the corrected spectra.
+    ndarray:
+        The number of iterations of every FID.
+    ndarray:
+        Boolean array which is True for the FIDs that reached the stopping limit.
+    """
+    data = np.array(data, dtype=np.result_type(data, np.complex64))
+    length = data.shape[-1]
+    result = np.zeros(data.shape, dtype=data.real.dtype)
+    iterations = np.full(len(data), ittnum, dtype=int)
+    converged = np.zeros(len(data), dtype=bool)
+    # The Hilbert transform of a real spectrum back to a causal FID reduces to a single inverse FFT and a filter
+    causal = causalFilter(length)
+    active = np.arange(len(data))  # The traces that are still being thresholded
+    tmpResult = result
+    spectrum = np.zeros_like(result)
+    data[:, 0] *= 0.5
+    for itt in range(ittnum):
+        spectrum = np.real(fe.ENGINE.fft(data, axis=-1))
+        height = np.max(np.abs(spectrum), axis=-1)
+        stop = height < NDmax * tracelimit  # remove traces for which the lower limit is reached
+        if np.any(stop):
+            result[active[stop]] = tmpResult[stop] + spectrum[stop]
+            iterations[active[stop]] = itt
+            converged[active[stop]] = True
+            keep = ~stop
+            active, spectrum, height, tmpResult = active[keep], spectrum[keep], height[keep], tmpResult[keep]
+            if not active.size:
+                break
+        tmpspectrum = np.abs(spectrum) - threshold * height[:, np.newaxis]
+        tmpspectrum[tmpspectrum < 0] = 0  # Zero all not used parts
+        tmpspectrum *= np.sign(spectrum)
+        tmpResult = tmpResult + tmpspectrum
+        spectrum -= tmpspectrum
+        data = fe.ENGINE.ifft(spectrum, axis=-1) * causal
+        data[:, posList] = 0
+    result[active] = tmpResult + spectrum
+    return np.fft.fftshift(result, axes=-1), iterations, converged
+
+
+
+def causalFilter(length):
+    """
+    Returns the filter that turns the inverse Fourier transform of a real spectrum into a causal FID.
+
+    Parameters
+    ----------
+    length: int
+        The number of points
+
+    Returns
+    -------
+    ndarray:
+        1D array with 1 for the first point (and the Nyquist point), 2 for the other positive times and 0 for the negative times.
+    """
+    causal = np.zeros(length)
+    causal[0] = 1
+    causal[1:(length + 1) // 2] = 2
+    if length % 2 == 0:
+        causal[length // 2] = 1
+    return causal
+
+
+def jointTransforms(shape):
+    """
+    Returns the transformations of the hypercomplex parts of data that is sampled jointly over several dimensions.
+    The hypercomplex data is written as 2**(N-1) ordinary complex signals, one for every combination of signs of the imaginary units of the other dimensions.
+    The real part of the hypercomplex spectrum is the mean of the real parts of the spectra of these signals.
+
+    Parameters
+    ----------
+    shape: tuple of ints
+        The shape of the N sampled dimensions
+
+    Returns
+    -------
+    ndarray:
+        2D array with the weights of the hypercomplex parts (second index) in every signal (first index).
+    list of tuples:
+        For every signal the indices that reverse the frequency axes of the dimensions with a negative sign.
+    """
+    numParts = 2**(len(shape) - 1)
+    # Every combination of signs maps the imaginary unit of dimension k to +-i, part m is weighted with the product of the units in m
+    signs = [[-1 if q & 2**k else 1 for k in range(len(shape) - 1)] for q in range(numParts)]
+    weights = np.array([[np.prod([1j * signs[q][k] for k in range(len(shape) - 1) if m & 2**k]) for m in range(numParts)] for q in range(numParts)])
+    # A negative sign conjugates the Fourier kernel along that dimension, which reverses the frequency axis
+    reverse = [np.ix_(*[(-np.arange(n)) % n if k > 0 and signs[q][k - 1] < 0 else np.arange(n) for k, n in enumerate(shape)]) for q in range(numParts)]
+    return weights, reverse
+
+
+def jointSpectrum(signals, reverse):
+    """
+    Computes the real part of the hypercomplex spectra from the complex signals of jointTransforms.
+
+    Parameters
+    ----------
+    signals: ndarray
+        Array with the planes along the first axis, the signals along the second axis and the N sampled dimensions along the other axes.
+    reverse: list of tuples
+        The indices that reverse the frequency axes of every signal.
+
+    Returns
+    -------
+    ndarray:
+        The real N-D spectra of the planes, without fftshift.
+    """
+    transform = fe.ENGINE.fftn(signals, axes=tuple(range(2, signals.ndim)))
+    return np.mean([np.real(transform[(slice(None), q) + rev]) for q, rev in enumerate(reverse)], axis=0)
+
+
+def jointSpectrumMax(data):
+    """
+    Returns the maximum of the real hypercomplex spectra of data that is sampled jointly over several dimensions.
+
+    Parameters
+    ----------
+    data: ndarray
+        Array with the planes along the first axis, the hypercomplex parts along the second axis and the N sampled dimensions along the other axes.
+
+    Returns
+    -------
+    float:
+        The maximum absolute value.
+    """
+    weights, reverse = jointTransforms(data.shape[2:])
+    return np.max(np.abs(jointSpectrum(np.einsum('qm,nm...->nq...', weights, data), reverse)))
+
+
+def istJointBlock(data, mask, threshold, ittnum, tracelimit, NDmax):
+    """
+    Performs Iterative Soft Thresholding of a block of planes that are sampled jointly over several dimensions.
+    The planes are thresholded as N-D spectra, planes that reached the stopping limit are removed from the calculation.
+
+    The data of every plane holds the hypercomplex parts along the other dimensions, which are all complex along the first dimension.
+
+    Parameters
+    ----------
+    data: ndarray
+        Array with the planes along the first axis, the hypercomplex parts along the second axis and the N sampled dimensions along the other axes.
+        Part m holds the data that is imaginary along the other dimensions k for which bit k-1 of m is set.
+    mask: ndarray
+        Boolean N-D array which is True for the recorded points
+    threshold: float
+        The level (0 < x < 1) at which the data is cut every iteration
+    ittnum: int
+        Maximum number of iterations
+    tracelimit: float
+        Stopping limit (0 < x < 1) (stop if residual intensity below this point)
+    NDmax: float
+        Maxmimum of the ND data, needed for the stopping limit
+
+    Returns
+    -------
+    ndarray:
+        Array with the corrected real N-D spectra of the planes.
+    ndarray:
+        The number of iterations of every plane.
+    ndarray:
+        Boolean array which is True for the planes that reached the stopping limit.
+    """
+    data = np.array(data, dtype=np.result_type(data, np.complex64))
+    shape = data.shape[2:]
+    axes = tuple(range(2, data.ndim))
+    weights, reverse = jointTransforms(shape)
+    causal = np.ones(shape)
+    for k, n in enumerate(shape):
+        causal = causal * causalFilter(n).reshape((-1, ) + (1, ) * (len(shape) - k - 1))
+        data[(slice(None), slice(None)) + (slice(None), ) * k + (0, )] *= 0.5
+    signals = np.einsum('qm,nm...->nq...', weights, data)
+    result = np.zeros(data.shape[:1] + shape, dtype=data.real.dtype)
+    iterations = np.full(len(data), ittnum, dtype=int)
+    converged = np.zeros(len(data), dtype=bool)
+    active = np.arange(len(data))  # The planes that are still being thresholded
+    tmpResult = result
+    spectrum = np.zeros_like(result)
     for itt in range(ittnum):
-        spectrum = np.real(np.fft.fft(data, axis=0))
-        signmatrix = np.sign(spectrum)
-        height = np.max(np.abs(spectrum))
-        if height < NDmax * tracelimit:  # exit loop if lower limit is reached
-            break
+        spectrum = jointSpectrum(signals, reverse)
+        height = np.max(np.abs(spectrum.reshape(len(spectrum), -1)), axis=-1)
+        stop = height < NDmax * tracelimit  # remove planes for which the lower limit is reached
+        if np.any(stop):
+            result[active[stop]] = tmpResult[stop] + spectrum[stop]
+            iterations[active[stop]] = itt
+            converged[active[stop]] = True
+            keep = ~stop
+            active, spectrum, height, tmpResult = active[keep], spectrum[keep], height[keep], tmpResult[keep]
+            if not active.size:
+                break
+        height = height.reshape((-1, ) + (1, ) * len(shape))
         tmpspectrum = np.abs(spectrum) - threshold * height
         tmpspectrum[tmpspectrum < 0] = 0  # Zero all not used parts
-        tmpspectrum = signmatrix * tmpspectrum
-        result += tmpspectrum
+        tmpspectrum *= np.sign(spectrum)
+        tmpResult = tmpResult + tmpspectrum
         spectrum -= tmpspectrum
-        spectrum = np.conj(scipy.signal.hilbert(spectrum, axis=0))
-        data = np.fft.ifft(spectrum, axis=0)
-        data[posList] = 0
-    result = np.real(result + spectrum)
-    result = np.fft.fftshift(result, axes=0)
-    return result
+        signals = np.stack([spectrum[(slice(None), ) + rev] for rev in reverse], axis=1)
+        signals = fe.ENGINE.ifftn(signals, axes=axes, overwrite=True) * causal
+        signals[..., ~mask] = 0
+    result[active] = tmpResult + spectrum
+    return np.fft.fftshift(result, axes=tuple(range(1, result.ndim))), iterations, converged
+
+
+def runBlock(inp):
+    """
+    Runs a block reconstruction function for the pool.
+
+    Parameters
+    ----------
+    inp: list with parameters:
+        0: function, the block reconstruction function
+        1: ndarray with the data of the block
+        2: tuple, the other arguments of the function
+
+    Returns
+    -------
+    tuple:
+        The result of the function.
+    """
+    return inp[0](inp[1], *inp[2])
+
+
+def runSharedBlock(inp):
+    """
+    Runs a block reconstruction function for the pool on data in shared memory.
+    The result is written to shared memory, only the convergence is returned.
+
+    Parameters
+    ----------
+    inp: list with parameters:
+        0: function, the block reconstruction function
+        1: str, the name of the shared memory with the input data
+        2: str, the name of the shared memory for the result
+        3: tuple, the shape of all data
+        4: tuple, the shape of all results
+        5: str, the type of the input data
+        6: str, the type of the result
+        7: slice, the traces of the block
+        8: tuple, the other arguments of the function
+
+    Returns
+    -------
+    ndarray:
+        The number of iterations of every trace.
+    ndarray:
+        Boolean array which is True for the converged traces.
+    """
+    func, inName, outName, shape, outShape, inType, outType, block, args = inp
+    inMem = sharedMemory.SharedMemory(name=inName)
+    outMem = sharedMemory.SharedMemory(name=outName)
+    try:
+        data = np.ndarray(shape, dtype=inType, buffer=inMem.buf)
+        result, iterations, converged = func(data[block], *args)
+        np.ndarray(outShape, dtype=outType, buffer=outMem.buf)[block] = result
+        del data
+        return iterations, converged
+    finally:
+        for mem in (inMem, outMem):
+            try:
+                mem.close()
+            except BufferError:  # The arrays are still referenced by an exception, they are freed with it
+                pass
+
+
+def reconstruct(func, data, args, outType, outShape=None):
+    """
+    Runs a block reconstruction function for all traces.
+    The traces are split in blocks of at most BLOCKSIZE bytes that are run on the worker pool.
+    The data is passed to the workers through shared memory when it is available.
+
+    Parameters
+    ----------
+    func: function
+        The block reconstruction function, for example istBlock.
+    data: ndarray
+        Array with the traces along the first axis
+    args: tuple
+        The other arguments of the function
+    outType: dtype
+        The type of the result of the function
+    outShape: tuple, optional
+        The shape of the result of every trace.
+        By default the shape of the traces.
+
+    Returns
+    -------
+    ndarray:
+        Array of the reconstructed traces.
+    ndarray:
+        The number of iterations of every trace.
+    ndarray:
+        Boolean array which is True for the converged traces.
+    """
+    data = np.ascontiguousarray(data)
+    numTraces = len(data)
+    if outShape is None:
+        outShape = data.shape[1:]
+    outShape = (numTraces, ) + tuple(outShape)
+    numBlocks = 1
+    if wp.POOL.useWorkers(numTraces):
+        numBlocks = min(wp.POOL.numProc * 4, numTraces)
+    blockSize = -(-numTraces // numBlocks)
+    blockSize = max(1, min(blockSize, BLOCKSIZE // max(data[:1].nbytes, 1)))
+    blocks = [slice(i, min(i + blockSize, numTraces)) for i in range(0, numTraces, blockSize)]
+    if not wp.POOL.useWorkers(len(blocks)):
+        fit = [func(data[block], *args) for block in blocks]
+    elif sharedMemory is None:
+        fit = wp.POOL.map(runBlock, [(func, data[block], args) for block in blocks])
+    else:
+        inMem = sharedMemory.SharedMemory(create=True, size=max(data.nbytes, 1))
+        outMem = sharedMemory.SharedMemory(create=True, size=max(int(np.prod(outShape)) * np.dtype(outType).itemsize, 1))
+        try:
+            np.ndarray(data.shape, dtype=data.dtype, buffer=inMem.buf)[...] = data
+            jobs = [(func, inMem.name, outMem.name, data.shape, outShape, data.dtype.str, np.dtype(outType).str, block, args) for block in blocks]
+            stats = wp.POOL.map(runSharedBlock, jobs)
+            result = np.ndarray(outShape, dtype=outType, buffer=outMem.buf).copy()
+        finally:
+            for mem in (inMem, outMem):
+                mem.close()
+                mem.unlink()
+        return result, np.concatenate([i[0] for i in stats]), np.concatenate([i[1] for i in stats])
+    if len(fit) == 1:
+        return fit[0]
+    return np.concatenate([i[0] for i in fit]), np.concatenate([i[1] for i in fit]), np.concatenate([i[2] for i in fit])
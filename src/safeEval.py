@@ -18,10 +18,41 @@
 # along with ssNake. If not, see <http://www.gnu.org/licenses/>.
 
 import re
+import collections
 import numpy as np
 import scipy.special
+import scipy.integrate
 import hypercomplex as hc
 
+ENVIRONMENT = {}
+PARAMETERPREFIX = '_par_'
+MAXCACHE = 32
+FUNCTIONCACHE = collections.OrderedDict()
+
+def getEnvironment():
+    """
+    Returns the restricted eval environment.
+    The environment is built on first use and shared, so it should not be modified.
+
+    Returns
+    -------
+    dict
+        The global variables of the environment.
+    """
+    if not ENVIRONMENT:
+        env = vars(np).copy()
+        env.update(vars(hc).copy())
+        env.update(vars(scipy.special).copy())
+        env.update(vars(scipy.integrate).copy())
+        env["locals"] = None
+        env["globals"] = None
+        env["__name__"] = None
+        env["__file__"] = None
+        env["__builtins__"] = {'None': None, 'False': False, 'True':True} # None
+        env["slice"] = slice
+        ENVIRONMENT.update(env)
+    return ENVIRONMENT
+
 def safeEval(inp, length=None, Type='All', x=None):
     """
     Creates a more restricted eval environment.
@@ -46,16 +77,7 @@ def safeEval(inp, length=None, Type='All', x=None):
     Object
         The result of the evaluated string.
     """
-    env = vars(np).copy()
-    env.update(vars(hc).copy())
-    env.update(vars(scipy.special).copy())
-    env.update(vars(scipy.integrate).copy())
-    env["locals"] = None
-    env["globals"] = None
-    env["__name__"] = None
-    env["__file__"] = None
-    env["__builtins__"] = {'None': None, 'False': False, 'True':True} # None
-    env["slice"] = slice
+    env = getEnvironment().copy()
     if length is not None:
         env["length"] = length
     if x is not None:
@@ -77,3 +99,101 @@ def safeEval(inp, length=None, Type='All', x=None):
             return None
     except Exception:
         return None
+
+class SafeFunction(object):
+    """
+    A string expression that is compiled once in the restricted eval environment and can be evaluated many times.
+    The parameters are written between @ symbols in the expression, such as @amp@, and are passed as variables instead of being substituted as text.
+    Note that this method is still not acceptable to process strings from untrusted sources.
+    """
+
+    def __init__(self, inp, names=()):
+        """
+        Compiles the expression.
+
+        Parameters
+        ----------
+        inp : str
+            The expression.
+        names : list of str, optional
+            The names of the parameters, without the @ symbols.
+            By default no parameters are used.
+        """
+        self.inp = str(inp)
+        self.names = tuple(names)
+        if self.names:
+            pieces = re.split('(' + '|'.join(re.escape('@' + name + '@') for name in self.names) + ')', self.inp)
+        else:
+            pieces = [self.inp]
+        for i, piece in enumerate(pieces):
+            if i % 2:
+                pieces[i] = '(' + PARAMETERPREFIX + piece[1:-1] + ')'
+            else:
+                pieces[i] = re.sub('([0-9]+)[kK]', '\\g<1>*1024', piece)
+        try:
+            self.code = compile(''.join(pieces), '<expression>', 'eval')
+        except Exception:
+            self.code = None
+        self.env = getEnvironment().copy()
+
+    def __getstate__(self):
+        return {'inp': self.inp, 'names': self.names}
+
+    def __setstate__(self, state):
+        self.__init__(state['inp'], state['names'])
+
+    def __call__(self, *values, **variables):
+        """
+        Evaluates the expression.
+        The parameters can be arrays, for example column vectors to evaluate the expression for many parameter sets at once.
+
+        Parameters
+        ----------
+        *values
+            The values of the parameters, in the order of the names.
+        **variables
+            Other variables of the expression, such as x and length.
+
+        Returns
+        -------
+        Object
+            The result of the expression, or None when the expression could not be evaluated.
+        """
+        if self.code is None:
+            return None
+        for name, value in zip(self.names, values):
+            self.env[PARAMETERPREFIX + name] = value
+        self.env.update(variables)
+        try:
+            val = eval(self.code, self.env)
+        except Exception:
+            return None
+        if isinstance(val, str):
+            return None
+        return val
+
+def getSafeFunction(inp, names=()):
+    """
+    Returns the compiled version of an expression, compiling it only when it was not used recently.
+
+    Parameters
+    ----------
+    inp : str
+        The expression.
+    names : list of str, optional
+        The names of the parameters, without the @ symbols.
+        By default no parameters are used.
+
+    Returns
+    -------
+    SafeFunction
+        The compiled expression.
+    """
+    key = (str(inp), tuple(names))
+    function = FUNCTIONCACHE.pop(key, None)
+    if function is None:
+        function = SafeFunction(*key)
+        while len(FUNCTIONCACHE) >= MAXCACHE:
+            FUNCTIONCACHE.popitem(last=False)
+    FUNCTIONCACHE[key] = function # The most recently used expressions are at the end
+    return function
@@ -19,13 +19,27 @@
 
 import tempfile
 import os
-import shutil
-import subprocess
+import hashlib
+import collections
 import numpy as np
-from safeEval import safeEval
+from safeEval import getSafeFunction
 import functions as func
-import specIO as io
 import Czjzek
+import workerPool as wp
+import fftEngine as fe
+import externalBridge as eb
+try: #If numba exists, compile the binning kernels, otherwise use np.bincount
+    from numba import jit
+    COMPILED = True
+except ImportError:
+    COMPILED = False
+    def jit(*args, **kwargs):
+        return lambda func: func
+
+# Distribute the weight of a frequency linearly over the two nearest points instead of using the nearest point only
+LINEARBINNING = False
+# The relative step of the finite differences in simJacobian, it should be large compared to the precision of the simulation
+JACOBIANSTEP = 1e-4
 
 class SimException(Exception):
     pass
@@ -345,6 +359,27 @@ def relaxationFunc(x, freq, sw, axMult, extra, amp, const, coeff, T):
     x = x[-1]
     return amp * (const + coeff * np.exp(-x / abs(T)))
 
+def relaxationJac(x, freq, sw, axMult, extra, amp, const, coeff, T):
+    """
+    Analytic derivatives of relaxationFunc with respect to its parameters.
+
+    Parameters
+    ----------
+    x, freq, sw, axMult, extra, amp, const, coeff, T
+        The same as for relaxationFunc.
+
+    Returns
+    -------
+    list of ndarray
+        The derivatives of the relaxation curve to amp, const, coeff and T.
+    """
+    x = x[-1]
+    decay = np.exp(-x / abs(T))
+    return [const + coeff * decay,
+            amp * np.ones_like(x, dtype=float),
+            amp * decay,
+            amp * coeff * decay * x * np.sign(T) / T**2]
+
 def diffusionFunc(x, freq, sw, axMult, extra, amp, const, coeff, D):
     """
     Simulation function used for fitting diffusion curves.
@@ -381,10 +416,33 @@ def diffusionFunc(x, freq, sw, axMult, extra, amp, const, coeff, D):
     gamma, delta, triangle = extra
     return amp * (const + coeff * np.exp(-(abs(gamma) *1e6 * abs(delta) * x)**2 * abs(D) * (abs(triangle) - abs(delta) / 3.0)))
 
+def diffusionJac(x, freq, sw, axMult, extra, amp, const, coeff, D):
+    """
+    Analytic derivatives of diffusionFunc with respect to its parameters.
+
+    Parameters
+    ----------
+    x, freq, sw, axMult, extra, amp, const, coeff, D
+        The same as for diffusionFunc.
+
+    Returns
+    -------
+    list of ndarray
+        The derivatives of the diffusion curve to amp, const, coeff and D.
+    """
+    x = x[-1]
+    gamma, delta, triangle = extra
+    factor = (abs(gamma) *1e6 * abs(delta) * x)**2 * (abs(triangle) - abs(delta) / 3.0)
+    decay = np.exp(-factor * abs(D))
+    return [const + coeff * decay,
+            amp * np.ones_like(x, dtype=float),
+            amp * decay,
+            -amp * coeff * decay * factor * np.sign(D)]
+
 def functionRun(x, freq, sw, axMult, extra, *parameters):
     """
     Simulation function used for function fitting.
-    The words between @ symbols are replaced by the fit values and the resulting string is evaluated.
+    The words between @ symbols are the parameters of the function, which is compiled once and then evaluated with the fit values.
 
     Parameters
     ----------
@@ -410,9 +468,7 @@ def functionRun(x, freq, sw, axMult, extra, *parameters):
     """
     names, function = extra
     x = x[-1]
-    for i, elem in enumerate(names):
-        function = function.replace('@' + elem + '@', str(parameters[i]))
-    return safeEval(function, length=len(x), x=x)
+    return getSafeFunction(function, names)(*parameters, length=len(x), x=x)
 
 def externalFitRunScript(x, freq, sw, axMult, extra, bgrnd, mult, *parameters):
     """
@@ -432,8 +488,9 @@ def externalFitRunScript(x, freq, sw, axMult, extra, bgrnd, mult, *parameters):
     axMult : float
         The multiplier of the x-axis (not used).
     extra : list
-        The extra parameters of the function [names, command, script, output, spec].
+        The extra parameters of the function [names, command, script, output, spec, persistent].
         Where names is a list of strings with the names of the parameters, command is a string with the command for fitting, script is a string with the script to be modified, output is a list of two strings to which the stdout and sterr are written, and spec is a boolean which is True when the output should be a spectrum.
+        The optional persistent is a boolean which is True when the command is a persistent worker, see externalBridge.
     bgrnd : float
         The offset value added to the output curve.
     mult : float
@@ -448,37 +505,80 @@ def externalFitRunScript(x, freq, sw, axMult, extra, bgrnd, mult, *parameters):
     ndarray
         The curve result from the command.
     """
-    names, command, script, output, spec = extra
-    amp, lor, gauss = parameters[-3:]
+    outputs = externalFitRunScriptBatch(x, freq, sw, axMult, extra, [(bgrnd, mult) + tuple(parameters)])
+    if outputs is None:
+        return None
+    return outputs[0]
+
+def externalFitRunScriptBatch(x, freq, sw, axMult, extra, parameterSets):
+    """
+    Runs externalFitRunScript for several parameter sets at once.
+    The simulations are run in parallel by the external bridge.
+
+    Parameters
+    ----------
+    x, freq, sw, axMult, extra
+        The arguments of externalFitRunScript.
+    parameterSets : list of list of float
+        The parameters of every simulation, in the order of externalFitRunScript: [bgrnd, mult, *parameters].
+
+    Returns
+    -------
+    list of ndarray
+        The curve of every parameter set.
+        None is returned when any of the simulations failed.
+    """
+    names, command, script, output, spec = extra[:5]
+    persistent = len(extra) > 5 and extra[5]
     x = x[-1]
     if script is None:
         return None
-    for i, elem in enumerate(names):
-        script = script.replace('@' + elem + '@', str(parameters[i]))
-    directory_name = tempfile.mkdtemp()
-    inputFileName = "script.in"
-    fullPath = os.path.join(directory_name, inputFileName)
-    with open(fullPath, "w") as text_file:
-        text_file.write(script)
-    process = subprocess.Popen(command + ' ' + fullPath, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=directory_name)
-    if output:
-        output[0], output[1] = process.communicate()
-    else:
-        process.wait()
-    fileList = os.listdir(directory_name)
-    fileList.remove(inputFileName)
-    if not fileList:
-        shutil.rmtree(directory_name, ignore_errors=True)
+    scripts = []
+    parameters = []
+    for params in parameterSets:
+        tmpScript = script
+        for i, elem in enumerate(names):
+            tmpScript = tmpScript.replace('@' + elem + '@', str(params[i + 2]))
+        scripts.append(tmpScript)
+        parameters.append(dict(zip(names, [float(val) for val in params[2:2 + len(names)]])))
+    results = eb.BRIDGE.run(command, scripts, parameters, persistent, output)
+    outputs = []
+    for params, masterData in zip(parameterSets, results):
+        if masterData is None:
+            return None
+        mult = params[1]
+        amp, lor, gauss = params[-3:]
+        masterData.noUndo = True
+        masterData.apodize(lor, gauss, [None, None], 0, 0, 0, 0, 0)
+        if masterData.spec[0] != spec:
+            masterData.complexFourier(0)
+        masterData.regrid([x[0], x[-1]], len(x), 0)
+        outputs.append(mult * amp * np.real(masterData.getHyperData(0)))
+    return outputs
+
+def externalFitRunScriptMulti(x, freq, sw, axMult, extra, bgrnd, mult, *parameters):
+    """
+    Simulates all sites of an external fit at once, with the site parameters as arrays.
+    The sites are simulated in parallel.
+
+    Parameters
+    ----------
+    x, freq, sw, axMult, extra, bgrnd, mult
+        The arguments of externalFitRunScript.
+    *parameters
+        The parameters of externalFitRunScript, as arrays with a value per site.
+
+    Returns
+    -------
+    ndarray
+        The sum of the curves of all sites.
+    """
+    parameters = [np.atleast_1d(val) for val in parameters]
+    parameterSets = [(bgrnd, mult) + tuple(val[i] for val in parameters) for i in range(len(parameters[-1]))]
+    outputs = externalFitRunScriptBatch(x, freq, sw, axMult, extra, parameterSets)
+    if outputs is None:
         return None
-    outputFileName = fileList[0]
-    masterData = io.autoLoad(os.path.join(directory_name, outputFileName))
-    masterData.noUndo = True
-    masterData.apodize(lor, gauss, [None, None], 0, 0, 0, 0, 0)
-    if masterData.spec[0] != spec:
-        masterData.complexFourier(0)
-    masterData.regrid([x[0], x[-1]], len(x), 0)
-    shutil.rmtree(directory_name, ignore_errors=True)
-    return mult * amp * np.real(masterData.getHyperData(0))
+    return np.sum(outputs, axis=0)
 
 def fib(n):
     """
@@ -527,7 +627,7 @@ def zcw_angles(m, symm=0):
         The weights of the different orientations.
     """
     samples, fib_1, fib_2 = fib(m)
-    js = np.arange(samples, dtype='Float64') / samples
+    js = np.arange(samples, dtype=float) / samples
     if symm == 0:
         c = (1., 2., 1.)
     elif symm == 1:
@@ -540,6 +640,195 @@ def zcw_angles(m, symm=0):
     weight = np.ones(samples) / samples
     return phi, theta, weight
 
+class PowderCache(object):
+    """
+    A least-recently-used cache with a bounded size for the arrays used in powder averaging.
+    Optionally, the arrays are also stored on disk, such that later sessions can reuse them.
+    """
+
+    VERSION = 1  # Increase when the content of the cached arrays changes, to invalidate old files on disk
+
+    def __init__(self, maxSize=256 * 1024**2, directory=None):
+        """
+        Initializes the cache.
+
+        Parameters
+        ----------
+        maxSize : int, optional
+            The maximum size of the cached arrays in memory in bytes.
+            By default 256 MB.
+        directory : str or None, optional
+            The directory in which the arrays are stored on disk.
+            By default None, which disables disk storage.
+        """
+        self.items = collections.OrderedDict()
+        self.size = 0
+        self.maxSize = maxSize
+        self.directory = directory
+
+    def setMaxSize(self, maxSize):
+        """
+        Sets the maximum size of the cache and removes items when needed.
+
+        Parameters
+        ----------
+        maxSize : int
+            The maximum size in bytes.
+        """
+        self.maxSize = maxSize
+        self.__shrink()
+
+    def setDirectory(self, directory):
+        """
+        Sets the directory for disk storage.
+
+        Parameters
+        ----------
+        directory : str or None
+            The directory. None disables disk storage.
+        """
+        self.directory = directory
+
+    def clear(self):
+        """
+        Removes all items from memory.
+        """
+        self.items.clear()
+        self.size = 0
+
+    def get(self, key, create):
+        """
+        Returns the arrays belonging to a key.
+        When the key is not in memory, the arrays are loaded from disk or created.
+
+        Parameters
+        ----------
+        key : tuple
+            The key of the arrays, consisting of strings and numbers.
+        create : function
+            Function without arguments that returns a tuple of arrays for the key.
+
+        Returns
+        -------
+        tuple of ndarray
+            The read-only arrays.
+        """
+        if key in self.items:
+            value = self.items.pop(key)
+            self.items[key] = value
+            return value
+        value = self.__load(key)
+        if value is None:
+            value = tuple(np.asarray(item) for item in create())
+            self.__save(key, value)
+        for item in value:
+            item.flags.writeable = False
+        size = sum(item.nbytes for item in value)
+        if size <= self.maxSize:
+            self.items[key] = value
+            self.size += size
+            self.__shrink()
+        return value
+
+    def __shrink(self):
+        while self.size > self.maxSize and self.items:
+            _, value = self.items.popitem(last=False)
+            self.size -= sum(item.nbytes for item in value)
+
+    def __fileName(self, key):
+        name = hashlib.sha1(repr((self.VERSION,) + tuple(key)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name + '.npz')
+
+    def __load(self, key):
+        if self.directory is None:
+            return None
+        try:
+            with np.load(self.__fileName(key)) as data:
+                return tuple(data['arr_' + str(i)] for i in range(len(data.files)))
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def __save(self, key, value):
+        if self.directory is None:
+            return
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            handle, tmpName = tempfile.mkstemp(suffix='.npz', dir=self.directory)
+            with os.fdopen(handle, 'wb') as f:
+                np.savez(f, *value)
+            if os.path.exists(self.__fileName(key)):
+                os.remove(tmpName)
+            else:
+                os.rename(tmpName, self.__fileName(key))
+        except (IOError, OSError):
+            pass
+
+POWDERCACHE = PowderCache()
+
+def powderAverage(cheng, symm=0, rank4=True):
+    """
+    Returns the weights and Wigner rotation matrices for a ZCW powder average.
+    The results are cached in POWDERCACHE.
+
+    Parameters
+    ----------
+    cheng : int
+        The Cheng number, see zcw_angles.
+    symm : {0, 1, 2}, optional
+        The symmetry of the problem, see zcw_angles.
+    rank4 : bool, optional
+        If False, D4 is not calculated and None is returned instead.
+        By default True.
+
+    Returns
+    -------
+    ndarray
+        The weights of the different orientations.
+    ndarray
+        The second rank Wigner D-matrices of the orientations.
+    ndarray or None
+        The fourth rank Wigner D-matrices of the orientations.
+    """
+    alpha, beta, weight = POWDERCACHE.get(('zcw', cheng, symm), lambda: zcw_angles(cheng, symm))
+    D2 = POWDERCACHE.get(('D2', cheng, symm), lambda: (D2tens(alpha, beta, np.zeros_like(alpha)),))[0]
+    D4 = None
+    if rank4:
+        D4 = POWDERCACHE.get(('D4', cheng, symm), lambda: (D4tens(alpha, beta, np.zeros_like(alpha)),))[0]
+    return weight, D2, D4
+
+def spinningFactors(angle, numssb):
+    """
+    Returns the Wigner elements of the spinning angle and the rotation factors over the rotor period.
+    The results are cached in POWDERCACHE.
+
+    Parameters
+    ----------
+    angle : float
+        The spinning angle in radians.
+    numssb : int
+        The number of steps over the rotor period.
+
+    Returns
+    -------
+    ndarray
+        The second rank small d-elements (m, 0) of the spinning angle.
+    ndarray
+        The fourth rank small d-elements (m, 0) of the spinning angle.
+    ndarray
+        The second rank rotation factors (spinD2) with shape (5, numssb).
+    ndarray
+        The fourth rank rotation factors (spinD4) with shape (9, numssb).
+    """
+    def create():
+        d2 = d2tens(np.array([angle]))[0, :, 2]
+        d4 = d4tens(np.array([angle]))[0, :, 4]
+        gval = np.arange(numssb) * 2 * np.pi / numssb
+        spinD2 = np.exp(1j * np.arange(-2, 3)[:, np.newaxis] * gval) * d2[:, np.newaxis]
+        spinD4 = np.exp(1j * np.arange(-4, 5)[:, np.newaxis] * gval) * d4[:, np.newaxis]
+        return d2, d4, spinD2, spinD4
+    return POWDERCACHE.get(('spin', float(angle), int(numssb)), create)
+
 def peakSim(x, freq, sw, axMult, extra, bgrnd, mult, pos, amp, lor, gauss):
     """
     Simulates an FID with Lorentzian and Gaussian broadening.
@@ -586,6 +875,64 @@ def peakSim(x, freq, sw, axMult, extra, bgrnd, mult, pos, amp, lor, gauss):
     t = np.fft.fftfreq(length, sw[-1]/float(length))
     return float(mult) * float(amp) / sw[-1] * np.exp(2j * np.pi * (pos - x[length//2]) * t - np.pi * np.abs(lor * t) - ((np.pi * np.abs(gauss) * t)**2) / (4 * np.log(2)))
 
+def peakSimJac(x, freq, sw, axMult, extra, bgrnd, mult, pos, amp, lor, gauss):
+    """
+    Analytic derivatives of peakSim with respect to its parameters.
+
+    Parameters
+    ----------
+    x, freq, sw, axMult, extra, bgrnd, mult, pos, amp, lor, gauss
+        The same as for peakSim.
+
+    Returns
+    -------
+    list of ndarray or None
+        The derivatives of the FID to bgrnd, mult, pos, amp, lor and gauss.
+        None is returned for parameters on which the FID does not depend.
+    """
+    x = x[-1]
+    pos /= axMult
+    if pos < np.min(x) or pos > np.max(x):
+        return [None] * 6
+    length = len(x)
+    t = np.fft.fftfreq(length, sw[-1]/float(length))
+    shape = np.exp(2j * np.pi * (pos - x[length//2]) * t - np.pi * np.abs(lor * t) - ((np.pi * np.abs(gauss) * t)**2) / (4 * np.log(2))) / sw[-1]
+    fid = float(mult) * float(amp) * shape
+    return [None,
+            float(amp) * shape,
+            fid * 2j * np.pi * t / axMult,
+            float(mult) * shape,
+            -fid * np.pi * np.abs(t) * np.sign(lor),
+            -fid * (np.pi * t)**2 * np.abs(gauss) / (2 * np.log(2)) * np.sign(gauss)]
+
+def peakSimMulti(x, freq, sw, axMult, extra, bgrnd, mult, pos, amp, lor, gauss):
+    """
+    Calculates the summed FID of multiple peaks with peakSim in a single step.
+
+    Parameters
+    ----------
+    x, freq, sw, axMult, extra, bgrnd, mult
+        The same as for peakSim.
+    pos, amp, lor, gauss : ndarray
+        The peak parameters of peakSim with one value per peak.
+
+    Returns
+    -------
+    ndarray
+        The simulated FID
+    """
+    x = x[-1]
+    pos = np.asarray(pos, dtype=float) / axMult
+    inside = (pos >= np.min(x)) & (pos <= np.max(x))
+    pos = pos[inside, np.newaxis]
+    amp = np.asarray(amp, dtype=float)[inside, np.newaxis]
+    lor = np.abs(np.asarray(lor, dtype=float)[inside, np.newaxis])
+    gauss = np.abs(np.asarray(gauss, dtype=float)[inside, np.newaxis])
+    length = len(x)
+    t = np.fft.fftfreq(length, sw[-1]/float(length))
+    fid = amp * np.exp(2j * np.pi * (pos - x[length//2]) * t - np.pi * np.abs(lor * t) - ((np.pi * gauss * t)**2) / (4 * np.log(2)))
+    return float(mult) / sw[-1] * np.sum(fid, axis=0)
+
 def makeSpectrum(x, sw, v, gauss, lor, weight):
     """
     Creates an FID from a list of frequencies with corresponding weights.
@@ -612,14 +959,235 @@ def makeSpectrum(x, sw, v, gauss, lor, weight):
     ndarray
         The FID. Has the same length as x[-1].
     """
+    return spectrumToFid(x, sw, binFrequencies(x, v, weight), gauss, lor)
+
+def binFrequencies(x, v, weight, out=None, linear=None):
+    """
+    Sorts a list of frequencies with corresponding weights into the points of a spectrum.
+
+    Parameters
+    ----------
+    x : ndarray
+        The frequency axis of the spectrum.
+        The axis should be equidistant and increasing.
+    v : ndarray
+        The list of frequencies.
+    weight : ndarray
+        The weights corresponding to the frequencies. Should have the same shape as v.
+    out : ndarray, optional
+        The spectrum to which the weights are added.
+        When not given, a new spectrum is created.
+    linear : bool, optional
+        When True, every weight is distributed over the two nearest points, with a linear interpolation between them.
+        When False, every weight is added to the nearest point.
+        By default the LINEARBINNING setting is used.
+
+    Returns
+    -------
+    ndarray
+        The spectrum. Has the same length as x.
+    """
+    return binFrequencies2D([x], [v], weight, out, linear)
+
+def binFrequencies2D(x, v, weight, out=None, linear=None):
+    """
+    Sorts a list of frequencies with corresponding weights into the points of a 1D or 2D spectrum.
+
+    Parameters
+    ----------
+    x : list of ndarray
+        The frequency axes of the spectrum, one or two equidistant and increasing axes.
+    v : list of ndarray
+        The list of frequencies per axis. All arrays should have the same shape.
+    weight : ndarray
+        The weights corresponding to the frequencies. Should have the same shape as the arrays in v.
+    out : ndarray, optional
+        The spectrum to which the weights are added.
+        When not given, a new spectrum is created.
+    linear : bool, optional
+        When True, every weight is distributed over the nearest points, with a linear interpolation between them.
+        When False, every weight is added to the nearest point.
+        By default the LINEARBINNING setting is used.
+
+    Returns
+    -------
+    ndarray
+        The spectrum. Has a shape of (len(x[0]), ..., len(x[-1])).
+    """
+    if linear is None:
+        linear = LINEARBINNING
+    shape = tuple([len(ax) for ax in x])
+    weight = np.ravel(weight)
+    if out is None:
+        out = np.zeros(shape, dtype=np.result_type(weight, float))
+    useKernel = COMPILED and out.flags.c_contiguous and np.result_type(out, weight) == out.dtype
+    if not linear and not useKernel:
+        ranges = [[ax[0] - (ax[1] - ax[0]) * 0.5, ax[-1] + (ax[1] - ax[0]) * 0.5] for ax in x]
+        if len(x) == 1:
+            out += np.histogram(np.ravel(v[0]), shape[0], range=ranges[0], weights=weight)[0]
+        else:
+            out += np.histogram2d(np.ravel(v[0]), np.ravel(v[1]), shape, range=ranges, weights=weight)[0]
+        return out
+    # Positions in units of points, to which the weights are added
+    pos = [(np.ravel(v[i]) - x[i][0]) / (x[i][1] - x[i][0]) for i in range(len(x))]
+    if useKernel:
+        if len(pos) == 1:
+            binKernel1D(pos[0], weight.astype(out.dtype, copy=False), bool(linear), out)
+        else:
+            binKernel2D(pos[0], pos[1], weight.astype(out.dtype, copy=False), bool(linear), out.reshape(shape[0], -1))
+        return out
+    # Every point that receives part of a weight, as (flat index, fraction, valid) for all combinations over the axes
+    parts = [(0, 1.0, True)]
+    for i, ax in enumerate(pos):
+        low = np.floor(ax)
+        frac = ax - low
+        low = low.astype(int)
+        parts = [(index * shape[i] + point, factor * part, valid & (point >= 0) & (point < shape[i])) for index, factor, valid in parts for point, part in ((low, 1 - frac), (low + 1, frac))]
+    size = int(np.prod(shape))
+    for index, factor, valid in parts:
+        binWeight = (weight * factor)[valid]
+        index = index[valid]
+        if np.iscomplexobj(binWeight):
+            binned = np.bincount(index, np.real(binWeight), size) + 1j * np.bincount(index, np.imag(binWeight), size)
+        else:
+            binned = np.bincount(index, binWeight, size)
+        out += binned.reshape(shape)
+    return out
+
+@jit(nopython=True)
+def binKernel1D(pos, weight, linear, out):
+    """
+    Compiled kernel for binFrequencies2D with one axis.
+
+    Parameters
+    ----------
+    pos : ndarray
+        The positions of the frequencies in units of points.
+    weight : ndarray
+        The weights corresponding to the positions.
+    linear : bool
+        Distribute the weights linearly over the two nearest points.
+    out : ndarray
+        The spectrum to which the weights are added.
+    """
+    length = out.shape[0]
+    for k in range(pos.shape[0]):
+        if linear:
+            low = int(np.floor(pos[k]))
+            frac = pos[k] - low
+            if 0 <= low < length:
+                out[low] += (1 - frac) * weight[k]
+            if -1 <= low < length - 1:
+                out[low + 1] += frac * weight[k]
+        else:
+            near = int(np.floor(pos[k] + 0.5))
+            if near == length and pos[k] + 0.5 == length:
+                near = length - 1
+            if 0 <= near < length:
+                out[near] += weight[k]
+
+@jit(nopython=True)
+def binKernel2D(pos1, pos2, weight, linear, out):
+    """
+    Compiled kernel for binFrequencies2D with two axes.
+
+    Parameters
+    ----------
+    pos1 : ndarray
+        The positions of the frequencies along the first axis in units of points.
+    pos2 : ndarray
+        The positions of the frequencies along the second axis in units of points.
+    weight : ndarray
+        The weights corresponding to the positions.
+    linear : bool
+        Distribute the weights linearly over the four nearest points.
+    out : 2-D ndarray
+        The spectrum to which the weights are added.
+    """
+    length1, length2 = out.shape
+    for k in range(pos1.shape[0]):
+        if linear:
+            low1 = int(np.floor(pos1[k]))
+            frac1 = pos1[k] - low1
+            low2 = int(np.floor(pos2[k]))
+            frac2 = pos2[k] - low2
+            for i in range(2):
+                index1 = low1 + i
+                if index1 < 0 or index1 >= length1:
+                    continue
+                part1 = frac1 if i else 1 - frac1
+                for j in range(2):
+                    index2 = low2 + j
+                    if 0 <= index2 < length2:
+                        out[index1, index2] += part1 * (frac2 if j else 1 - frac2) * weight[k]
+        else:
+            near1 = int(np.floor(pos1[k] + 0.5))
+            if near1 == length1 and pos1[k] + 0.5 == length1:
+                near1 = length1 - 1
+            near2 = int(np.floor(pos2[k] + 0.5))
+            if near2 == length2 and pos2[k] + 0.5 == length2:
+                near2 = length2 - 1
+            if 0 <= near1 < length1 and 0 <= near2 < length2:
+                out[near1, near2] += weight[k]
+
+# The absolute time axes of the FIDs, stored per number of points and spectral width
+TIMEAXES = {}
+
+def timeAxis(length, sw):
+    """
+    Returns the absolute time axis for the apodization of an FID, reusing earlier results.
+
+    Parameters
+    ----------
+    length : int
+        The number of points.
+    sw : float
+        The spectral width in Hz.
+
+    Returns
+    -------
+    ndarray
+        The absolute time values in the order of an unshifted FFT.
+    """
+    key = (length, float(sw))
+    if key not in TIMEAXES:
+        if len(TIMEAXES) > 64:
+            TIMEAXES.clear()
+        t = np.abs(np.fft.fftfreq(length, sw / float(length)))
+        t.flags.writeable = False
+        TIMEAXES[key] = t
+    return TIMEAXES[key]
+
+def spectrumToFid(x, sw, spectrum, gauss, lor):
+    """
+    Converts one or more spectra created by binFrequencies to FIDs.
+    Also applies Lorentzian and Gaussian broadening.
+
+    Parameters
+    ----------
+    x : ndarray
+        The frequency axis of the spectrum.
+    sw : float
+        The spectral width in Hz.
+    spectrum : ndarray
+        The spectrum. When multidimensional, the last axis should have the same length as x and the spectra are converted in one step.
+    gauss : float or ndarray
+        Gaussian broadening in Hz, a single value or one value per spectrum.
+    lor : float or ndarray
+        Lorentzian broadening in Hz, a single value or one value per spectrum.
+
+    Returns
+    -------
+    ndarray
+        The FIDs. Has the same shape as spectrum.
+    """
     length = len(x)
-    t = np.abs(np.fft.fftfreq(length, sw / float(length)))
-    diff = (x[1] - x[0]) * 0.5
-    final, _ = np.histogram(v, length, range=[x[0]-diff, x[-1]+diff], weights=weight)
-    apod = np.exp(-np.pi * np.abs(lor) * t - ((np.pi * np.abs(gauss) * t)**2) / (4 * np.log(2)))
-    inten = np.fft.ifft(final) * apod
-    inten *= len(inten)  / sw
-    return inten
+    t = timeAxis(length, sw)
+    lor = np.abs(np.asarray(lor, dtype=float))[..., np.newaxis]
+    gauss = np.abs(np.asarray(gauss, dtype=float))[..., np.newaxis]
+    fid = fe.ENGINE.ifft(spectrum, axis=-1)
+    fid *= np.exp(-np.pi * lor * t - ((np.pi * gauss * t)**2) / (4 * np.log(2))) * (length / float(sw))
+    return fid
 
 def makeMQMASSpectrum(x, sw, v, gauss, lor, weight):
     """
@@ -651,16 +1219,12 @@ def makeMQMASSpectrum(x, sw, v, gauss, lor, weight):
         The 2D FID. Has a shape of (len(x[-2]), len(x[-1])).
     """
     length1 = len(x[-2])
-    t1 = np.fft.fftfreq(length1, sw[-2]/float(length1))
-    diff1 = (x[-2][1] - x[-2][0])*0.5
     length2 = len(x[-1])
-    t2 = np.fft.fftfreq(length2, sw[-1]/float(length2))
-    diff2 = (x[-1][1] - x[-1][0])*0.5
-    t1 = t1[:, np.newaxis]
-    final, _, _ = np.histogram2d(v[0], v[1], [length1, length2], range=[[x[-2][0]-diff1, x[-2][-1]+diff1], [x[-1][0]-diff2, x[-1][-1]+diff2]], weights=weight)
-    final = np.fft.ifftn(final)
-    apod2 = np.exp(-np.pi * np.abs(lor[1] * t2) - ((np.pi * np.abs(gauss[1]) * t2)**2) / (4 * np.log(2)))
-    apod1 = np.exp(-np.pi * np.abs(lor[0] * t1) - ((np.pi * np.abs(gauss[0]) * t1)**2) / (4 * np.log(2)))
+    t1 = timeAxis(length1, sw[-2])[:, np.newaxis]
+    t2 = timeAxis(length2, sw[-1])
+    final = fe.ENGINE.ifftn(binFrequencies2D([x[-2], x[-1]], v, weight), overwrite=True)
+    apod2 = np.exp(-np.pi * np.abs(lor[1]) * t2 - ((np.pi * np.abs(gauss[1]) * t2)**2) / (4 * np.log(2)))
+    apod1 = np.exp(-np.pi * np.abs(lor[0]) * t1 - ((np.pi * np.abs(gauss[0]) * t1)**2) / (4 * np.log(2)))
     final *= apod1 * apod2 * length1 / sw[-2] * length2 / sw[-1]
     return final
 
@@ -689,7 +1253,7 @@ def carouselAveraging(spinspeed, v, weight, vConstant):
     numssb = v.shape[1]
     dt = 1.0 / spinspeed / numssb
     prod = np.exp(1j * np.cumsum(v * dt * 2 * np.pi, axis=1))
-    tot = np.fft.fft(prod, axis=1)
+    tot = fe.ENGINE.fft(prod, axis=1, overwrite=True)
     tot *= np.conj(tot)
     weight2 = weight[:, np.newaxis] / numssb**2
     tot *= weight2
@@ -721,7 +1285,7 @@ def csaFreqBase(angle, tensor, D2, spinspeed, numssb):
     float
         The isotropic frequency.
     """
-    d2 = d2tens(np.array([angle]))[0, :, 2]
+    d2, _, spinD2, _ = spinningFactors(angle, numssb)
     A0, A2 = csaSpace(tensor)
     T0, T2 = csaSpin()
     dat0 = A0 * T0
@@ -734,10 +1298,7 @@ def csaFreqBase(angle, tensor, D2, spinspeed, numssb):
     elif spinspeed == 0.0:
         v = np.real(dat2[:, 2] + dat0)
     else:
-        gammastep = 2 * np.pi / numssb
-        gval = np.arange(numssb) * gammastep
-        spinD2 = np.exp(1j * np.arange(-2, 3)[:, np.newaxis] * gval) * d2[:, np.newaxis]
-        vConstant = np.real(dat0 + dat2[:, 2] * factor2) 
+        vConstant = np.real(dat0 + dat2[:, 2] * factor2)
         dat2[:, 2] = 0
         v = np.matmul(dat2, spinD2)
     return v, vConstant
@@ -758,6 +1319,24 @@ def quadFunc(x, freq, sw, axMult, extra, bgrnd, mult, spinspeed, pos, cq, eta, a
     extra = [satBool, I, numssb, angle, D2, D4, weight, MAStype, 0]
     return quadCSAFunc(x, freq, sw, axMult, extra, bgrnd, mult, spinspeed, pos, pos, pos, cq, eta, 0.0, 0.0, 0.0, amp, lor, gauss)
 
+def csaFuncMulti(x, freq, sw, axMult, extra, bgrnd, mult, spinspeed, t11, t22, t33, amp, lor, gauss):
+    """
+    Uses the quadCSAFuncMulti function for the specific case where the quadrupole interaction is zero.
+    """
+    shiftdef, numssb, angle, D2, weight, MAStype = extra
+    extra = [False, 0.5, numssb, angle, D2, None, weight, MAStype, shiftdef]
+    zeros = np.zeros(len(t11))
+    return quadCSAFuncMulti(x, freq, sw, axMult, extra, bgrnd, mult, spinspeed, t11, t22, t33, zeros, zeros, zeros, zeros, zeros, amp, lor, gauss)
+
+def quadFuncMulti(x, freq, sw, axMult, extra, bgrnd, mult, spinspeed, pos, cq, eta, amp, lor, gauss):
+    """
+    Uses the quadCSAFuncMulti function for the specific case where the CSA interaction is zero.
+    """
+    satBool, I, numssb, angle, D2, D4, weight, MAStype = extra
+    extra = [satBool, I, numssb, angle, D2, D4, weight, MAStype, 0]
+    zeros = np.zeros(len(pos))
+    return quadCSAFuncMulti(x, freq, sw, axMult, extra, bgrnd, mult, spinspeed, pos, pos, pos, cq, eta, zeros, zeros, zeros, amp, lor, gauss)
+
 def quadFreqBase(I, m1, m2, cq, eta, freq, angle, D2, D4, numssb, spinspeed):
     """
     Calculates the quadrupole frequencies for given alpha and beta angles and over a full circle over gamma.
@@ -804,8 +1383,7 @@ def quadFreqBase(I, m1, m2, cq, eta, freq, angle, D2, D4, numssb, spinspeed):
     secA0 *= pre2
     secA2 *= pre2
     secA4 *= pre2
-    d2 = d2tens(np.array([angle]))[0, :, 2]
-    d4 = d4tens(np.array([angle]))[0, :, 4]
+    d2, d4, spinD2, spinD4 = spinningFactors(angle, numssb)
     factor2 = d2[2]
     factor4 = d4[4]
     firstspin2 = firstQuadSpin(I, m1, m2)
@@ -821,10 +1399,6 @@ def quadFreqBase(I, m1, m2, cq, eta, freq, angle, D2, D4, numssb, spinspeed):
     elif spinspeed == 0.0:
         v = np.real(dat4[:, 4]  + dat2[:, 2] + dat0)
     else:
-        gammastep = 2 * np.pi / numssb
-        gval = np.arange(numssb) * gammastep
-        spinD2 = np.exp(1j * np.arange(-2, 3)[:, np.newaxis] * gval) * d2[:, np.newaxis]
-        spinD4 = np.exp(1j * np.arange(-4, 5)[:, np.newaxis] * gval) * d4[:, np.newaxis]
         vConstant = np.real(dat0 + dat2[:, 2] * factor2 + dat4[:, 4] * factor4)
         dat4[:, 4] = 0
         dat2[:, 2] = 0
@@ -884,17 +1458,34 @@ def quadCSAFunc(x, freq, sw, axMult, extra, bgrnd, mult, spinspeed, t11, t22, t3
     ndarray
         The simulated FID
     """
+    spectrum = quadCSASpectrum(x, freq, axMult, extra, spinspeed, t11, t22, t33, cq, eta, alphaCSA, betaCSA, gammaCSA)
+    return mult * amp * spectrumToFid(x[-1], sw[-1], spectrum, gauss, lor)
+
+def quadCSASpectrum(x, freq, axMult, extra, spinspeed, t11, t22, t33, cq, eta, alphaCSA, betaCSA, gammaCSA):
+    """
+    Calculates the binned spectrum, without broadening, of a single site for quadCSAFunc.
+    All transitions are summed before the conversion to an FID, as they share the same broadening.
+
+    Parameters
+    ----------
+    x, freq, axMult, extra, spinspeed, t11, t22, t33, cq, eta, alphaCSA, betaCSA, gammaCSA
+        The same as for quadCSAFunc.
+
+    Returns
+    -------
+    ndarray
+        The spectrum as created by binFrequencies. Has the same length as x[-1].
+    """
     alphaCSA *= np.pi / 180.0   # Degrees to radians
     betaCSA *= np.pi / 180.0    # Degrees to radians
     gammaCSA *= np.pi / 180.0   # Degrees to radians
-    x = x[-1]
     satBool, I, numssb, angle, D2, D4, weight, MAStype, shiftdef = extra
     if MAStype == 0:
         spinspeed = 0.0
     elif MAStype == 2:
         spinspeed = np.inf
     if not satBool and (I % 1) == 0.0:
-        return np.zeros_like(x)          # Integer spins have no central transition
+        return np.zeros(len(x[-1]))      # Integer spins have no central transition
     if shiftdef == 2:                    # If heaberlen, make eta continuous, and between 0--1
         t33 = 1 - abs(abs(t33) % 2 - 1)
     elif shiftdef == 3:                  # For Hertzfeld-Berger
@@ -905,12 +1496,11 @@ def quadCSAFunc(x, freq, sw, axMult, extra, bgrnd, mult, spinspeed, t11, t22, t3
     eta = 1 - abs(abs(eta) % 2 - 1)      # Force eta to 0--1 in a continuous way: 0.9 == 1.1, 0 == 2
     spinspeed *= 1e3
     freq = freq[-1]
-    sw = sw[-1]
     mList = np.arange(-I, I)
     totalEff = len(mList) * (I**2 + I) - np.sum(mList * (mList + 1))
     if not satBool:
         mList = [-0.5]
-    spectrum = np.zeros(len(x), dtype=complex)
+    spectrum = np.zeros(len(x[-1]), dtype=complex)
     relativeD2 = D2tens(np.array([alphaCSA]), np.array([betaCSA]), np.array([gammaCSA]))
     vCSA, vConstantCSA = csaFreqBase(angle, tensor, np.matmul(relativeD2, D2), spinspeed, numssb)
     for m in mList:
@@ -926,8 +1516,29 @@ def quadCSAFunc(x, freq, sw, axMult, extra, bgrnd, mult, spinspeed, t11, t22, t3
         tot = weight
         if spinspeed not in (0.0, np.inf):
             v, tot = carouselAveraging(spinspeed, v, weight, vConstant)
-        spectrum += eff * makeSpectrum(x, sw, v, gauss, lor, tot)
-    return mult * amp * spectrum
+        binFrequencies(x[-1], v, eff * tot, out=spectrum)
+    return spectrum
+
+def quadCSAFuncMulti(x, freq, sw, axMult, extra, bgrnd, mult, spinspeed, t11, t22, t33, cq, eta, alphaCSA, betaCSA, gammaCSA, amp, lor, gauss):
+    """
+    Calculates the summed FID of multiple sites with quadCSAFunc.
+    The spectra of all sites are converted to FIDs in a single step.
+
+    Parameters
+    ----------
+    x, freq, sw, axMult, extra, bgrnd, mult, spinspeed
+        The same as for quadCSAFunc.
+    t11, t22, t33, cq, eta, alphaCSA, betaCSA, gammaCSA, amp, lor, gauss : ndarray
+        The site parameters of quadCSAFunc with one value per site.
+
+    Returns
+    -------
+    ndarray
+        The simulated FID
+    """
+    spectra = np.array([quadCSASpectrum(x, freq, axMult, extra, spinspeed, *site) for site in zip(t11, t22, t33, cq, eta, alphaCSA, betaCSA, gammaCSA)])
+    spectra *= np.asarray(amp, dtype=float)[:, np.newaxis]
+    return mult * np.sum(spectrumToFid(x[-1], sw[-1], spectra, gauss, lor), axis=0)
 
 def quadCzjzekFunc(x, freq, sw, axMult, extra, bgrnd, mult, pos, sigma, cq0, eta0, amp, lor, gauss):
     """
@@ -991,6 +1602,39 @@ def quadCzjzekFunc(x, freq, sw, axMult, extra, bgrnd, mult, pos, sigma, cq0, eta
     apod = np.exp(2j * np.pi * pos * t - np.pi * np.abs(lor) * np.abs(t) - ((np.pi * np.abs(gauss) * t)**2) / (4 * np.log(2)))
     return mult * amp * fid * apod
 
+def quadCzjzekFuncMulti(x, freq, sw, axMult, extra, bgrnd, mult, pos, sigma, cq0, eta0, amp, lor, gauss):
+    """
+    Calculates the summed FID of multiple sites with quadCzjzekFunc.
+    The distributions of all sites are combined with the library in a single matrix product.
+
+    Parameters
+    ----------
+    x, freq, sw, axMult, extra, bgrnd, mult
+        The same as for quadCzjzekFunc.
+    pos, sigma, cq0, eta0, amp, lor, gauss : ndarray
+        The site parameters of quadCzjzekFunc with one value per site.
+
+    Returns
+    -------
+    ndarray
+        The simulated FID
+    """
+    x = x[-1]
+    sw = sw[-1]
+    method, d, lib, cq, eta = extra
+    if method == 0:
+        cq0 = np.zeros(len(pos))
+        eta0 = np.zeros(len(pos))
+    czjzek = np.array([Czjzek.czjzekIntensities(abs(sigmai) * 1e6, d, cq, eta, cq0i * 1e6, eta0i) for sigmai, cq0i, eta0i in zip(sigma, cq0, eta0)])
+    fid = np.dot(czjzek, lib)
+    length = len(x)
+    t = np.fft.fftfreq(length, sw/float(length))
+    pos = np.asarray(pos, dtype=float)[:, np.newaxis] / axMult - x[len(x)//2]
+    lor = np.asarray(lor, dtype=float)[:, np.newaxis]
+    gauss = np.asarray(gauss, dtype=float)[:, np.newaxis]
+    apod = np.exp(2j * np.pi * pos * t - np.pi * np.abs(lor) * np.abs(t) - ((np.pi * np.abs(gauss) * t)**2) / (4 * np.log(2)))
+    return mult * np.sum(np.asarray(amp, dtype=float)[:, np.newaxis] * fid * apod, axis=0)
+
 def mqmasFunc(x, freq, sw, axMult, extra, bgrnd, mult, spinspeed, pos, cq, eta, amp, lor2, gauss2, lor1, gauss1):
     """
     Calculates a 2-D FID of an MQMAS spectrum.
@@ -1162,18 +1806,144 @@ def mqmasCzjzekFunc(x, freq, sw, axMult, extra, bgrnd, mult, pos, sigma, sigmaCS
     fid = np.zeros((length1, length2), dtype=complex)
     for i, _ in enumerate(ind):
         fid[ind[i]-1] += newLib[i]
-    fid = np.fft.ifft(fid, axis=0)
+    fid = fe.ENGINE.ifft(fid, axis=0, overwrite=True)
     posIndirect = pos * (mq - shearFactor) * scale
     offsetMat = np.exp(2j * np.pi * (posIndirect * t1 + (pos - x[-1][length2//2])*t2))
     shiftGauss = np.exp(-((np.pi * np.abs(sigmaCS) * (t2 + t1*(mq-shearFactor)*scale))**2) / (4 * np.log(2)))
     fid *= offsetMat * apod1 * apod2 * shiftGauss
     shearMat = np.exp((shearFactor-shear) * 2j * np.pi * t1 * x[-1])
-    fid = np.fft.fft(fid, axis=1) * shearMat
+    fid = fe.ENGINE.fft(fid, axis=1, overwrite=True) * shearMat
     return mult * amp * fid * length1 / length2
 
+class LibraryStore(object):
+    """
+    Stores generated Czjzek libraries on disk, under a hash of the parameters that generated them.
+    Stored libraries are opened as memory maps, such that they are only read from disk when used.
+    """
+
+    VERSION = 1  # Increase when the simulation of the libraries changes, to invalidate old files on disk
+
+    def __init__(self, directory=None):
+        """
+        Initializes the store.
+
+        Parameters
+        ----------
+        directory : str or None, optional
+            The directory in which the libraries are stored.
+            By default None, which disables the store.
+        """
+        self.directory = directory
+
+    def setDirectory(self, directory):
+        """
+        Sets the directory of the store.
+
+        Parameters
+        ----------
+        directory : str or None
+            The directory. None disables the store.
+        """
+        self.directory = directory
+
+    def key(self, *parameters):
+        """
+        Creates the key of a library from its generating parameters.
+
+        Parameters
+        ----------
+        *parameters
+            The parameters, which can be numbers, strings, None, arrays, or lists and tuples of these.
+            Arrays are included by their content.
+
+        Returns
+        -------
+        str
+            The key.
+        """
+        digest = hashlib.sha1(repr(self.VERSION).encode('utf-8'))
+        self.__update(digest, parameters)
+        return digest.hexdigest()
+
+    def __update(self, digest, item):
+        if isinstance(item, (list, tuple)):
+            digest.update(('%s%d' % (type(item).__name__, len(item))).encode('utf-8'))
+            for part in item:
+                self.__update(digest, part)
+        elif item is None or isinstance(item, (str, type(u''))):
+            digest.update(repr(item).encode('utf-8'))
+        else:
+            item = np.ascontiguousarray(item)
+            digest.update((item.dtype.str + repr(item.shape)).encode('utf-8'))
+            digest.update(item.tobytes())
+
+    def __fileName(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def load(self, key):
+        """
+        Opens a stored library.
+
+        Parameters
+        ----------
+        key : str
+            The key of the library.
+
+        Returns
+        -------
+        memmap or None
+            The read-only library, or None when it is not stored.
+        """
+        if self.directory is None:
+            return None
+        try:
+            return np.load(self.__fileName(key), mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, key, lib):
+        """
+        Stores a library.
+
+        Parameters
+        ----------
+        key : str
+            The key of the library.
+        lib : ndarray
+            The library.
+
+        Returns
+        -------
+        ndarray
+            The stored library opened as read-only memory map.
+            When the library could not be stored, the input library is returned.
+        """
+        if self.directory is None:
+            return lib
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            handle, tmpName = tempfile.mkstemp(suffix='.npy', dir=self.directory)
+            with os.fdopen(handle, 'wb') as f:
+                np.save(f, lib)
+            if os.path.exists(self.__fileName(key)):
+                os.remove(tmpName)
+            else:
+                os.rename(tmpName, self.__fileName(key))
+        except (IOError, OSError):
+            return lib
+        stored = self.load(key)
+        if stored is None:
+            return lib
+        return stored
+
+LIBRARYSTORE = LibraryStore()
+
 def genLib(length, minCq, maxCq, minEta, maxEta, numCq, numEta, extra, freq, sw, spinspeed):
     """
     Generate a library of FIDs for Czjzek distribution fitting.
+    The FIDs are generated in blocks on the shared worker pool.
+    When LIBRARYSTORE has a directory, libraries are loaded from and saved to the store.
 
     Parameters
     ----------
@@ -1204,8 +1974,116 @@ def genLib(length, minCq, maxCq, minEta, maxEta, numCq, numEta, extra, freq, sw,
     cq, eta = np.meshgrid(np.linspace(minCq, maxCq, numCq), np.linspace(minEta, maxEta, numEta))
     cq = cq.flatten()
     eta = eta.flatten()
+    key = None
+    if LIBRARYSTORE.directory is not None:
+        key = LIBRARYSTORE.key(length, cq, eta, extra, freq, sw, spinspeed, LINEARBINNING)
+        lib = LIBRARYSTORE.load(key)
+        if lib is not None:
+            return lib, cq*1e6, eta
     x = np.fft.fftshift(np.fft.fftfreq(length, 1/float(sw)))
-    lib = np.zeros((len(cq), length), dtype=complex)
+    numBlocks = max(1, min(wp.POOL.numProc, len(cq)))
+    parts = [(x, freq, sw, extra, spinspeed, LINEARBINNING, cqPart, etaPart) for cqPart, etaPart in zip(np.array_split(cq, numBlocks), np.array_split(eta, numBlocks))]
+    lib = np.concatenate(wp.POOL.map(genLibPart, parts))
+    if key is not None:
+        lib = LIBRARYSTORE.save(key, lib)
+    return lib, cq*1e6, eta
+
+def genLibPart(inp):
+    """
+    Generates a part of a Czjzek library, used by genLib.
+
+    Parameters
+    ----------
+    inp : tuple
+        The input as (x, freq, sw, extra, spinspeed, linearBinning, cq, eta).
+        The cq (in MHz) and eta arrays contain the values for which FIDs are generated.
+
+    Returns
+    -------
+    ndarray
+        The FIDs with shape (len(cq), len(x)).
+    """
+    global LINEARBINNING
+    x, freq, sw, extra, spinspeed, linearBinning, cq, eta = inp
+    LINEARBINNING = linearBinning   # Worker processes use the setting of the main process
+    lib = np.zeros((len(cq), len(x)), dtype=complex)
     for i, (cqi, etai) in enumerate(zip(cq, eta)):
         lib[i] = quadFunc([x], [freq], [sw], 1.0, extra, 0.0, 1.0, spinspeed, 0.0, cqi, etai, 1.0, 0.0, 0.0)
-    return lib, cq*1e6, eta
+    return lib
+
+MULTISITE = {peakSim: peakSimMulti,
+             quadCSAFunc: quadCSAFuncMulti,
+             csaFunc: csaFuncMulti,
+             quadFunc: quadFuncMulti,
+             quadCzjzekFunc: quadCzjzekFuncMulti,
+             externalFitRunScript: externalFitRunScriptMulti}
+
+# Functions that simulate a list of parameter sets at once, which are used for the finite differences
+BATCH = {externalFitRunScript: externalFitRunScriptBatch}
+
+JACOBIANS = {relaxationFunc: relaxationJac,
+             diffusionFunc: diffusionJac,
+             peakSim: peakSimJac}
+
+def simJacobian(func, x, freq, sw, axMult, extra, params, active=None):
+    """
+    Calculates the derivatives of a simulation function with respect to its parameters.
+    Analytic derivatives are used when they are available in JACOBIANS.
+    Otherwise forward finite differences are used, for which the unperturbed simulation is shared by all parameters.
+    The step is JACOBIANSTEP times the parameter value (or times 1 for values smaller than 1).
+    The finite differences are simulated with linear binning, as the nearest point binning does not change for steps smaller than a point.
+    Functions in BATCH simulate all shifted parameter sets at once.
+
+    Parameters
+    ----------
+    func : function
+        The simulation function.
+    x, freq, sw, axMult, extra
+        The arguments passed to func.
+    params : list of float
+        The parameter values passed to func.
+    active : list of int, optional
+        The indices of the parameters for which the derivative is required.
+        By default the derivatives of all parameters are calculated.
+
+    Returns
+    -------
+    list of ndarray or None
+        The derivative per parameter.
+        None is returned for parameters that are not active or on which the result does not depend.
+        If the simulation fails, None is returned instead of a list.
+    """
+    params = list(params)
+    if active is None:
+        active = range(len(params))
+    if func in JACOBIANS:
+        derivs = JACOBIANS[func](x, freq, sw, axMult, extra, *params)
+        return [derivs[i] if i in active else None for i in range(len(params))]
+    global LINEARBINNING
+    steps = {}
+    parameterSets = [params]
+    for i in active:
+        steps[i] = JACOBIANSTEP * max(abs(params[i]), 1.0)
+        shifted = list(params)
+        shifted[i] += steps[i]
+        parameterSets.append(shifted)
+    linearBinning = LINEARBINNING
+    LINEARBINNING = True
+    try:
+        if func in BATCH:
+            outputs = BATCH[func](x, freq, sw, axMult, extra, parameterSets)
+            if outputs is None:
+                return None
+        else:
+            outputs = []
+            for shifted in parameterSets:
+                output = func(x, freq, sw, axMult, extra, *shifted)
+                if output is None:
+                    return None
+                outputs.append(output)
+    finally:
+        LINEARBINNING = linearBinning
+    derivs = [None] * len(params)
+    for i, output in zip(active, outputs[1:]):
+        derivs[i] = (output - outputs[0]) / steps[i]
+    return derivs
@@ -27,7 +27,7 @@ import hypercomplex as hc
 class LoadException(sc.SpectrumException):
     pass
 
-def autoLoad(filePathList, asciiInfoList=None):
+def autoLoad(filePathList, asciiInfoList=None, singlePrecision=False):
     """
     Loads and combines a list of files using the automatic routine.
     All data file should have the same shape in order for merging to work.
@@ -50,6 +50,8 @@ def autoLoad(filePathList, asciiInfoList=None):
         sw: float
             Spectral width in kHz
         If no info needs to be given 'None' should be passed
+    singlePrecision: bool (optional)
+        If True, the data is stored in single precision (complex64)
     Returns
     -------
     SpectrumClass:
@@ -59,7 +61,7 @@ def autoLoad(filePathList, asciiInfoList=None):
         filePathList = [filePathList]
     if asciiInfoList is None:
         asciiInfoList = [None] * len(filePathList)
-    masterData = autoLoadSingle(filePathList[0], asciiInfoList[0])
+    masterData = autoLoadSingle(filePathList[0], asciiInfoList[0], singlePrecision)
     if isinstance(masterData, int) and len(filePathList) > 1:
         raise LoadException("ASCII data cannot be combined")
     if len(filePathList) == 1:
@@ -67,7 +69,7 @@ def autoLoad(filePathList, asciiInfoList=None):
     shapeRequired = masterData.shape()
     masterData.split(1, -1)
     for i in range(len(filePathList)-1):
-        addData = autoLoad(filePathList[i+1], asciiInfoList[i+1])
+        addData = autoLoad(filePathList[i+1], asciiInfoList[i+1], singlePrecision)
         if addData is None:
             continue
         if addData.shape() != shapeRequired:
@@ -76,7 +78,7 @@ def autoLoad(filePathList, asciiInfoList=None):
     masterData.filePath = (filePathList, asciiInfoList)
     return masterData
 
-def autoLoadSingle(filePath, asciiInfo=None):
+def autoLoadSingle(filePath, asciiInfo=None, singlePrecision=False):
     """
     Loads a single file using the automatic routine.
 
@@ -97,6 +99,8 @@ def autoLoadSingle(filePath, asciiInfo=None):
             Delimiter ('Tab','Space','Comma')
         sw: float
             Spectral width in kHz
+    singlePrecision: bool (optional)
+        If True, the data is stored in single precision (complex64)
     Returns
     -------
     SpectrumClass:
@@ -110,18 +114,18 @@ def autoLoadSingle(filePath, asciiInfo=None):
             temp_dir = tempfile.mkdtemp()
             zipfile.ZipFile(filePath).extractall(temp_dir)
             for i in os.listdir(temp_dir):
-                tmpSpec = loadFile(os.path.join(temp_dir, i), realpath=filePath, asciiInfo=asciiInfo)
+                tmpSpec = loadFile(os.path.join(temp_dir, i), realpath=filePath, asciiInfo=asciiInfo, singlePrecision=singlePrecision)
                 if tmpSpec:
                     break
         finally:
             shutil.rmtree(temp_dir)
     else:
-        tmpSpec = loadFile(filePath, asciiInfo=asciiInfo)
+        tmpSpec = loadFile(filePath, asciiInfo=asciiInfo, singlePrecision=singlePrecision)
     if isinstance(tmpSpec, sc.Spectrum):
         tmpSpec.filePath = ([filePath], [asciiInfo])
     return tmpSpec
 
-def loadFile(filePath, realpath=False, asciiInfo=None):
+def loadFile(filePath, realpath=False, asciiInfo=None, singlePrecision=False):
     """
     Loads file from filePath using the correct routine.
 
@@ -144,6 +148,8 @@ def loadFile(filePath, realpath=False, asciiInfo=None):
             Delimiter ('Tab','Space','Comma')
         sw: float
             Spectral width in kHz
+    singlePrecision: bool (optional)
+        If True, the data is stored in single precision (complex64)
     Returns
     -------
     SpectrumClass:
@@ -157,15 +163,15 @@ def loadFile(filePath, realpath=False, asciiInfo=None):
     if num is None:
         return
     if num == 0:
-        masterData = loadVarianFile(filePath)
+        masterData = loadVarianFile(filePath, singlePrecision)
     elif num == 1:
-        masterData = loadBrukerTopspin(filePath)
+        masterData = loadBrukerTopspin(filePath, singlePrecision)
     elif num == 2:
         masterData = loadChemFile(filePath)
     elif num == 3:
         masterData = loadMagritek(filePath)
     elif num == 4:
-        masterData = loadSimpsonFile(filePath)
+        masterData = loadSimpsonFile(filePath, singlePrecision)
     elif num == 5:
         masterData = loadJSONFile(filePath)
     elif num == 6:
@@ -173,7 +179,7 @@ def loadFile(filePath, realpath=False, asciiInfo=None):
     elif num == 7:
         masterData = loadBrukerSpectrum(filePath)
     elif num == 8:
-        masterData = loadPipe(filePath)
+        masterData = loadPipe(filePath, singlePrecision)
     elif num == 9:
         masterData = loadJEOLDelta(filePath)
     elif num == 10:
@@ -194,6 +200,7 @@ def loadFile(filePath, realpath=False, asciiInfo=None):
         masterData = loadMestreC(filePath)
     elif num == 17:
         masterData = loadBrukerImaging(filePath)
+    masterData.setSinglePrecision(singlePrecision)
     masterData.rename(name)
     return masterData
 
@@ -274,6 +281,29 @@ def fileTypeCheck(filePath):
         return 11, filePath
     return None, filePath
 
+def loadNusList(filePath):
+    """
+    Loads a non-uniform sampling schedule (nuslist).
+    Every line holds the indices of one recorded point, with one column per sampled dimension.
+    Lines starting with '#' are ignored.
+
+    Parameters
+    ----------
+    filePath: string
+        Path to the file that should be loaded
+
+    Returns
+    -------
+    ndarray
+        2D integer array with the coordinates of the recorded points, with one row per point
+    """
+    with open(filePath, 'r') as f:
+        lines = [line.split('#')[0].replace(',', ' ').split() for line in f]
+    lines = [line for line in lines if line]
+    if not lines:
+        return np.zeros((0, 1), dtype=int)
+    return np.array(lines, dtype=float).astype(int)
+
 def varianGetPars(procpar):
     """
     Loads all parameters from Varian procpar file.
@@ -323,7 +353,7 @@ def varianGetPars(procpar):
         pars[name] = val
     return pars
 
-def loadVarianFile(filePath):
+def loadVarianFile(filePath, singlePrecision=False):
     """
     Loads a Varian/Agilent file.
 
@@ -331,6 +361,8 @@ def loadVarianFile(filePath):
     ----------
     filePath: string
         Path to the file that should be loaded
+    singlePrecision: bool (optional)
+        If True, the data is loaded in single precision (complex64)
 
     Returns
     -------
@@ -382,7 +414,7 @@ def loadVarianFile(filePath):
             else:
                 bitType = ['>h', np.int16, 14]
         totalpoints = (ntraces * npoints + nbheaders**2 * bitType[2])*nblocks
-        fid = np.fromfile(f, bitType[1], totalpoints).newbyteorder(bitType[0]).astype(np.complex128)
+        fid = np.fromfile(f, bitType[1], totalpoints).newbyteorder(bitType[0]).astype(np.complex64 if singlePrecision else np.complex128)
         if not spec or (spec and not hypercomplex):
             fid = fid.reshape(nblocks, int(totalpoints / nblocks))
             fid = fid[:, bitType[2]::] # Cut off block headers
@@ -393,14 +425,14 @@ def loadVarianFile(filePath):
             if flipped:
                 fid = np.fliplr(fid)
     if spec == 0:
-        fid = fid * np.exp((rp + phfid) / 180 * np.pi * 1j)  # apply zero order phase
+        fid *= np.exp((rp + phfid) / 180 * np.pi * 1j)  # apply zero order phase
     if SizeTD1 == 1:
         fid = fid[0][:]
         if spec:  # flip if spectrum
             fid = np.flipud(fid)
-        masterData = sc.Spectrum(fid, (filePath, None), [freq], [sw], [bool(int(spec))], ref=[reffreq])
+        masterData = sc.Spectrum(fid, (filePath, None), [freq], [sw], [bool(int(spec))], ref=[reffreq], singlePrecision=singlePrecision)
     else:
-        masterData = sc.Spectrum(fid, (filePath, None), [freq1, freq], [sw1, sw], [bool(int(spec))] * 2, ref=[reffreq1, reffreq])
+        masterData = sc.Spectrum(fid, (filePath, None), [freq1, freq], [sw1, sw], [bool(int(spec))] * 2, ref=[reffreq1, reffreq], singlePrecision=singlePrecision)
     masterData.addHistory("Varian data loaded from " + filePath)
     try:
         masterData.metaData['# Scans'] = str(pars['nt'])
@@ -415,7 +447,7 @@ def loadVarianFile(filePath):
         pass
     return masterData
 
-def loadPipe(filePath):
+def loadPipe(filePath, singlePrecision=False):
     """
     Loads a NMRpipe file.
 
@@ -423,6 +455,8 @@ def loadPipe(filePath):
     ----------
     filePath: string
         Path to the file that should be loaded
+    singlePrecision: bool (optional)
+        If True, the data is loaded in single precision (complex64)
 
     Returns
     -------
@@ -498,7 +532,7 @@ def loadPipe(filePath):
         for i in range(NDIM):
             if spec[-1 - i] == 1:
                 data[k] = np.flip(data[k], NDIM -1 - i)
-    masterData = sc.Spectrum(hc.HComplexData(data, hyper), (filePath, None), freq[4 - NDIM:4], sw[4 - NDIM:4], spec[4 - NDIM:4], ref=ref[4 - NDIM:4])
+    masterData = sc.Spectrum(hc.HComplexData(data, hyper, dtype=np.complex64 if singlePrecision else np.complex128), (filePath, None), freq[4 - NDIM:4], sw[4 - NDIM:4], spec[4 - NDIM:4], ref=ref[4 - NDIM:4], singlePrecision=singlePrecision)
     masterData.addHistory("NMRpipe data loaded from " + filePath)
     return masterData
 
@@ -1072,7 +1106,7 @@ def getBrukerFilter(pars):
         return None
 
 
-def loadBrukerTopspin(filePath):
+def loadBrukerTopspin(filePath, singlePrecision=False):
     """
     Loads Bruker Topspin/Xwinnmr data (i.e. time-domain data).
 
@@ -1080,6 +1114,8 @@ def loadBrukerTopspin(filePath):
     ----------
     filePath: string
         Path to the file that should be loaded
+    singlePrecision: bool (optional)
+        If True, the data is loaded in single precision (complex64)
 
     Returns
     -------
@@ -1098,7 +1134,7 @@ def loadBrukerTopspin(filePath):
     FREQ = [x['SFO1'] * 1e6 for x in pars]
     SW = [x['SW_h'] for x in pars]
     REF = [x['O1'] for x in pars]
-    ByteOrder = ['l', 'b'][pars[0]['BYTORDA']] #The byte orders that is used
+    ByteOrder = ['<', '>'][pars[0]['BYTORDA']] #The byte orders that is used
     REF = list(- np.array(REF) + np.array(FREQ))
     dFilter = getBrukerFilter(pars[0])
     totsize = np.prod(SIZE)
@@ -1109,19 +1145,29 @@ def loadBrukerTopspin(filePath):
         if os.path.exists(Dir + os.path.sep + file):
             if file == 'ser':
                 totsize = int(totsize / SIZE[0]) * directSize #Always load full 1024 byte blocks (256 data points) for >1D
-            with open(Dir + os.path.sep + file, "rb") as f:
-                raw = np.fromfile(f, np.int32, totsize)
-            raw = raw.newbyteorder(ByteOrder) #Load with right byte order
-    ComplexData = np.array(raw[0:len(raw):2]) + 1j * np.array(raw[1:len(raw):2])
+            fileName = Dir + os.path.sep + file
+    count = min(totsize, os.path.getsize(fileName) // 4)
+    raw = np.memmap(fileName, dtype=np.dtype(ByteOrder + 'i4'), mode='r', shape=(count, )) #The file is only read when the data is converted
     if dim >= 2:
-        newSize = list(SIZE)
-        newSize[0] = int(directSize / 2)
-        ComplexData = ComplexData.reshape(*newSize[-1::-1])
-    if dim == 2:
-        ComplexData = ComplexData[:, 0:int(SIZE[0]/2)] #Cut off placeholder data
-    elif dim == 3:
-        ComplexData = ComplexData[:, :, 0:int(SIZE[0]/2)] #Cut off placeholder data
-    masterData = sc.Spectrum(ComplexData, (filePath, None), FREQ[-1::-1], SW[-1::-1], [False] * dim, ref = REF[-1::-1], dFilter=dFilter)
+        raw = raw.reshape(-1, directSize)
+        points = int(SIZE[0] / 2) #Cut off placeholder data
+    else:
+        raw = raw.reshape(1, -1)
+        points = count // 2
+    dtype = np.complex64 if singlePrecision else np.complex128
+    shape = (1, raw.shape[0], points)
+    if hc.SCRATCH.isLarge(np.prod(shape) * np.dtype(dtype).itemsize):
+        ComplexData = hc.SCRATCH.empty(shape, dtype)
+    else:
+        ComplexData = np.empty(shape, dtype)
+    for chunk in hc.SCRATCH.chunks(raw.shape, 0, raw.itemsize): #Convert in chunks, so the raw data is never loaded completely
+        ComplexData.real[0, chunk] = raw[chunk, 0:2 * points:2]
+        ComplexData.imag[0, chunk] = raw[chunk, 1:2 * points:2]
+    del raw
+    data = hc.HComplexData()
+    data.data = ComplexData.reshape((1, ) + tuple(SIZE[-1:0:-1]) + (points, ))
+    data.hyper = np.array([0])
+    masterData = sc.Spectrum(data, (filePath, None), FREQ[-1::-1], SW[-1::-1], [False] * dim, ref = REF[-1::-1], dFilter=dFilter, singlePrecision=singlePrecision)
     # TODO: Inserting metadata should be made more generic
     try:
         masterData.metaData['# Scans'] = str(pars[0]['NS'])
@@ -1567,7 +1613,7 @@ def saveSimpsonFile(filePath, spectrum):
                     f.write(str(data[i][j].real) + ' ' + str(data[i][j].imag) + '\n')
         f.write('END')
 
-def loadSimpsonFile(filePath):
+def loadSimpsonFile(filePath, singlePrecision=False):
     """
     Loads SIMPSON file. Both ASCII and binary data are supported. As well
     as 1D and 2D data.
@@ -1576,6 +1622,8 @@ def loadSimpsonFile(filePath):
     ----------
     filePath: string
         Path to the file that should be loaded
+    singlePrecision: bool (optional)
+        If True, the data is loaded in single precision (complex64)
 
     Returns
     -------
@@ -1602,7 +1650,7 @@ def loadSimpsonFile(filePath):
             FORMAT = re.sub('FORMAT=', '', Lines[s])
     if 'Normal' in FORMAT:
         length = DataEnd - DataStart - 1
-        data = np.zeros(length, dtype=complex)
+        data = np.zeros(length, dtype=np.complex64 if singlePrecision else np.complex128)
         for i in range(length):
             temp = Lines[DataStart + 1 + i].split()
             data[i] = float(temp[0]) + 1j * float(temp[1])
@@ -1645,9 +1693,9 @@ def loadSimpsonFile(filePath):
     elif 'SPE' in TYPE:
         spec = [True]
     if NI == 1:
-        masterData = sc.Spectrum(data, (filePath, None), [0], [SW], spec)
+        masterData = sc.Spectrum(data, (filePath, None), [0], [SW], spec, singlePrecision=singlePrecision)
     else:
-        masterData = sc.Spectrum(data, (filePath, None), [0, 0], [SW1, SW], spec * 2)
+        masterData = sc.Spectrum(data, (filePath, None), [0, 0], [SW1, SW], spec * 2, singlePrecision=singlePrecision)
     masterData.addHistory("SIMPSON data loaded from " + filePath)
     return masterData
 
@@ -18,11 +18,17 @@
 # along with ssNake. If not, see <http://www.gnu.org/licenses/>.
 
 import copy
-import multiprocessing
 import itertools
-import scipy.optimize
+import os
+import shutil
+import tempfile
+import atexit
+import collections
+import weakref
 import numpy as np
 import nus
+import workerPool as wp
+import fftEngine as fe
 import functions as func
 import hypercomplex as hc
 
@@ -33,6 +39,245 @@ class SpectrumException(Exception):
     pass
 
 
+#########################################################################
+# the undo journal
+
+
+class UndoJournal(object):
+    """
+    Keeps the arrays needed to undo processing steps within a memory budget.
+    When the budget is exceeded, the oldest arrays are moved to temporary files.
+    Arrays that are larger than the budget are written to disk directly, without a copy in memory.
+    """
+
+    def __init__(self, maxSize=1024 * 1024**2, directory=None):
+        """
+        Initializes the journal.
+
+        Parameters
+        ----------
+        maxSize : int, optional
+            The maximum size of the arrays kept in memory in bytes.
+            By default 1 GB.
+        directory : str or None, optional
+            The directory in which the temporary files are created.
+            By default None, which uses the temporary directory of the system.
+        """
+        self.maxSize = maxSize
+        self.directory = directory
+        self.tmpDir = None
+        self.entries = collections.OrderedDict()
+
+    def setMaxSize(self, maxSize):
+        """
+        Sets the memory budget and moves arrays to disk when needed.
+
+        Parameters
+        ----------
+        maxSize : int
+            The maximum size in bytes.
+        """
+        self.maxSize = maxSize
+        self.__shrink()
+
+    def store(self, array):
+        """
+        Stores a copy of an array.
+
+        Parameters
+        ----------
+        array : ndarray
+            The array to store.
+            It is copied, so it can be changed afterwards.
+
+        Returns
+        -------
+        JournalEntry
+            The entry from which the array can be obtained.
+            The array is removed from the journal when the entry is deleted.
+        """
+        entry = JournalEntry()
+        if array.nbytes > self.maxSize and entry.spill(self.__tmpDir(), array):
+            return entry
+        entry.array = np.array(array, copy=True)
+        self.entries[id(entry)] = weakref.ref(entry, lambda ref, key=id(entry): self.entries.pop(key, None))
+        self.__shrink()
+        return entry
+
+    def __tmpDir(self):
+        if self.tmpDir is None or not os.path.isdir(self.tmpDir):
+            try:
+                self.tmpDir = tempfile.mkdtemp(prefix='ssNakeUndo', dir=self.directory)
+            except (IOError, OSError):
+                return None
+            atexit.register(shutil.rmtree, self.tmpDir, True)
+        return self.tmpDir
+
+    def __shrink(self):
+        entries = [ref() for ref in list(self.entries.values())]
+        entries = [entry for entry in entries if entry is not None and entry.array is not None]
+        size = sum(entry.array.nbytes for entry in entries)
+        for entry in entries:
+            if size <= self.maxSize:
+                break
+            nbytes = entry.array.nbytes
+            if not entry.spill(self.__tmpDir()):
+                break
+            self.entries.pop(id(entry), None)
+            size -= nbytes
+
+JOURNAL = UndoJournal()
+
+
+class JournalEntry(object):
+    """
+    An array stored in the undo journal, either in memory or in a temporary file.
+    """
+
+    def __init__(self):
+        self.array = None
+        self.fileName = None
+
+    def spill(self, directory, array=None):
+        """
+        Moves the array to a temporary file.
+
+        Parameters
+        ----------
+        directory : str or None
+            The directory of the file.
+        array : ndarray, optional
+            The array to write.
+            By default the array of the entry is used.
+
+        Returns
+        -------
+        bool
+            True if the array was written to disk.
+        """
+        if directory is None:
+            return False
+        if array is None:
+            array = self.array
+        try:
+            handle, fileName = tempfile.mkstemp(suffix='.npy', dir=directory)
+            with os.fdopen(handle, 'wb') as f:
+                np.save(f, array)
+        except (IOError, OSError):
+            return False
+        self.fileName = fileName
+        self.array = None
+        return True
+
+    def get(self):
+        """
+        Returns the stored array.
+
+        Returns
+        -------
+        ndarray
+            The array, which is read from disk when it was moved there.
+            Arrays that are too large to be kept in memory are mapped from the file instead.
+        """
+        if self.array is not None:
+            return self.array
+        array = np.load(self.fileName, mmap_mode='c')
+        if hc.SCRATCH.isLarge(array.nbytes):
+            return array
+        return np.array(array)
+
+    def __del__(self):
+        if self.fileName is not None:
+            try:
+                os.remove(self.fileName)
+            except (IOError, OSError, TypeError):
+                pass
+
+
+class UndoSnapshot(object):
+    """
+    The state of a Spectrum before a processing step, used to undo that step.
+    The data is kept in the undo journal, either completely or only the selected region that the step changes.
+    For a Spectrum with deferred operations, the data before those operations and the operations themselves are kept instead.
+    """
+
+    def __init__(self, spec, select=None):
+        """
+        Stores the state of a spectrum.
+
+        Parameters
+        ----------
+        spec : Spectrum
+            The spectrum.
+        select : Slice or tuple, optional
+            The region of the data that is changed by the processing step.
+            When given, the processing step should not change the shape and hyper of the data.
+            By default the complete data is stored.
+        """
+        self.freq = copy.deepcopy(spec.freq)
+        self.filePath = copy.deepcopy(spec.filePath)
+        self.sw = copy.deepcopy(spec.sw)
+        self.spec = copy.deepcopy(spec.spec)
+        self.wholeEcho = copy.deepcopy(spec.wholeEcho)
+        self.xaxArray = copy.deepcopy(spec.xaxArray)
+        self.ref = copy.deepcopy(spec.ref)
+        self.deferredState = None
+        self.entry = None
+        if spec.pendingOps:
+            # The data before the deferred operations is never changed in place, so it does not need to be copied
+            self.deferredState = spec.getDeferredState()
+            self.select = None
+            return
+        self.hyper = np.array(spec.data.hyper)
+        if select is not None:
+            if not isinstance(select, tuple):
+                try:
+                    select = tuple(select)
+                except TypeError:
+                    select = (select, )
+            select = (slice(None), ) + select
+            if spec.data.data[select].size == spec.data.data.size:
+                select = None
+        self.select = select
+        if select is None:
+            self.entry = JOURNAL.store(spec.data.data)
+        else:
+            self.entry = JOURNAL.store(spec.data.data[select])
+
+    @property
+    def data(self):
+        """
+        The complete stored data as HComplexData.
+        """
+        data = hc.HComplexData()
+        data.data = self.entry.get()
+        data.hyper = np.array(self.hyper)
+        return data
+
+    def restore(self, spec):
+        """
+        Restores the state of a spectrum.
+
+        Parameters
+        ----------
+        spec : Spectrum
+            The spectrum.
+        """
+        if self.deferredState is not None:
+            spec.setDeferredState(self.deferredState)
+        elif self.select is None:
+            spec.data = self.data
+        else:
+            spec.data.data[self.select] = self.entry.get()
+        spec.freq = self.freq
+        spec.filePath = self.filePath
+        spec.sw = self.sw
+        spec.spec = self.spec
+        spec.wholeEcho = self.wholeEcho
+        spec.xaxArray = self.xaxArray
+        spec.ref = self.ref
+
+
 #########################################################################
 # the generic spectrum class
 
@@ -43,7 +288,7 @@ class Spectrum(object):
     The functions for processing are methods of this object.
     """
 
-    def __init__(self, data, filePath, freq, sw, spec=None, wholeEcho=None, ref=None, xaxArray=None, history=None, metaData=None, name='', dFilter=None):
+    def __init__(self, data, filePath, freq, sw, spec=None, wholeEcho=None, ref=None, xaxArray=None, history=None, metaData=None, name='', dFilter=None, singlePrecision=False):
         """
         Initializes the Spectrum object.
 
@@ -88,12 +333,19 @@ class Spectrum(object):
         dFilter : float or None, optional
             For a (Bruker) digital filter this value contains the first order phase correction required to correct for the digital filter.
             By default this parameter is set to None.
+        singlePrecision : bool, optional
+            When True, the data is stored in single precision (complex64) instead of double precision (complex128).
+            By default False.
         """
         self.name = name
+        self.deferred = False
+        self.pendingOps = []
+        self.pendingShape = None
+        self.singlePrecision = bool(singlePrecision)
         if isinstance(data, hc.HComplexData):
             self.data = data
         else:
-            self.data = hc.HComplexData(data)
+            self.data = hc.HComplexData(data, dtype=self.dtype())
         self.filePath = filePath
         self.freq = np.array(freq)  # array of center frequency (length is dim, MHz)
         self.sw = np.array(sw, dtype=float)  # array of sweepwidths
@@ -128,10 +380,45 @@ class Spectrum(object):
         else:
             self.metaData = metaData
 
+    @property
+    def data(self):
+        """
+        The NMR data as HComplexData.
+        Deferred operations are applied before the data is returned.
+        """
+        if self.pendingOps:
+            self.__evaluate()
+        return self.__data
+
+    @data.setter
+    def data(self, value):
+        if value.data.dtype != self.dtype():
+            value = hc.HComplexData(value.data, value.hyper, dtype=self.dtype())
+        self.__data = value
+        self.pendingOps = []
+        self.pendingShape = None
+
+    def dtype(self):
+        """
+        Returns the type in which the data is stored.
+
+        Returns
+        -------
+        type
+            np.complex64 in single precision mode, otherwise np.complex128.
+        """
+        if self.singlePrecision:
+            return np.complex64
+        return np.complex128
+
     def ndim(self):
+        if self.pendingOps:
+            return len(self.pendingShape)
         return self.data.ndim()
 
     def shape(self):
+        if self.pendingOps:
+            return self.pendingShape
         return self.data.shape()
 
     def getData(self): # Returns a copy of the data
@@ -204,6 +491,245 @@ class Spectrum(object):
             self.undoList = []
             self.redoList = []
 
+    def setSinglePrecision(self, val):
+        """
+        Sets the precision of the data.
+        In single precision mode the data is stored as complex64, which halves the memory use and speeds up processing of large data.
+        Sums and averages are still accumulated in double precision.
+
+        Parameters
+        ----------
+        val : bool
+            When True, the data is converted to single precision.
+            When False, the data is converted back to double precision, which does not restore the digits that were lost.
+        """
+        self.singlePrecision = bool(val)
+        self.data = self.data
+
+    def setDeferred(self, val):
+        """
+        Sets the deferred mode of the data.
+        In this mode apodization, zero filling, complex Fourier transforms, phasing and baseline corrections of the entire data are recorded instead of applied.
+        The recorded operations are applied together when the data is used, fusing the multiplications along each dimension into single passes and dropping Fourier transforms that cancel.
+
+        Parameters
+        ----------
+        val : bool
+            When False, the recorded operations are applied and the deferred mode is turned off.
+        """
+        self.deferred = bool(val)
+        if not self.deferred:
+            self.evaluate()
+
+    def evaluate(self):
+        """
+        Applies all deferred operations to the data.
+        """
+        if self.pendingOps:
+            self.__evaluate()
+
+    def getDeferredState(self):
+        """
+        Returns the data without the deferred operations, together with those operations.
+
+        Returns
+        -------
+        tuple
+            The data, the list of deferred operations and the shape after these operations.
+        """
+        return (self.__data, list(self.pendingOps), self.pendingShape)
+
+    def setDeferredState(self, state):
+        """
+        Sets the data and deferred operations, as returned by getDeferredState.
+
+        Parameters
+        ----------
+        state : tuple
+            The data, the list of deferred operations and the shape after these operations.
+        """
+        self.data = state[0]
+        self.pendingOps = list(state[1])
+        self.pendingShape = state[2]
+
+    def __canDefer(self, select=slice(None)):
+        if not isinstance(select, slice) or select != slice(None):
+            return False
+        # Operations on data on disk are always recorded, so they can be applied in a single pass over the file
+        return self.deferred or bool(self.pendingOps) or self.data.isMapped()
+
+    def __record(self, axis, *op):
+        if not self.pendingOps:
+            self.pendingShape = self.data.shape()
+        self.pendingOps.append((axis, ) + op)
+        if op[0] == 'resize':
+            shape = list(self.pendingShape)
+            shape[axis] = op[1]
+            self.pendingShape = tuple(shape)
+
+    def __evaluate(self):
+        ops = self.pendingOps
+        self.pendingOps = []
+        self.pendingShape = None
+        data = hc.HComplexData()
+        data.data = self.__data.data
+        data.hyper = self.__data.hyper
+        owned = False # The input data is never changed in place, as it can be used by undo snapshots
+        groups = []
+        for op in ops:
+            for group in groups:
+                if group[0] == op[0]:
+                    break
+            else:
+                group = (op[0], [])
+                groups.append(group)
+            group[1].append(op[1:])
+            if op[1] == 'baseline':
+                # Operations along different dimensions commute, except for a baseline correction
+                groups.remove(group)
+                groups.append(group)
+                for axis, axisOps in groups:
+                    owned = self.__evaluateGroup(data, axis, axisOps, owned)
+                groups = []
+        for axis, axisOps in groups:
+            owned = self.__evaluateGroup(data, axis, axisOps, owned)
+        if not owned:
+            data = data.copy()
+        self.__data = data
+
+    def __evaluateGroup(self, data, axis, ops, owned):
+        if not data.isMapped() or data.ndim() < 2:
+            return self.__evaluateAxis(data, axis, ops, owned)
+        # Data on disk is processed in chunks along another axis and written to a new file
+        chunkAxis = 1 if axis == 0 else 0
+        outData = None
+        for chunk in hc.SCRATCH.chunks(data.data.shape, chunkAxis + 1, data.data.itemsize):
+            slicing = (slice(None), ) * (chunkAxis + 1) + (chunk, )
+            chunkData = hc.HComplexData()
+            chunkData.data = data.data[slicing]
+            chunkData.hyper = data.hyper
+            self.__evaluateAxis(chunkData, axis, ops, False)
+            if outData is None:
+                shape = list(chunkData.data.shape)
+                shape[chunkAxis + 1] = data.data.shape[chunkAxis + 1]
+                if hc.SCRATCH.isLarge(np.prod(shape) * chunkData.data.itemsize):
+                    outData = hc.SCRATCH.empty(shape, chunkData.data.dtype)
+                else:
+                    outData = np.empty(shape, chunkData.data.dtype)
+            outData[slicing] = chunkData.data
+        data.data = outData
+        data.hyper = chunkData.hyper
+        return True
+
+    def __evaluateAxis(self, data, axis, ops, owned):
+        transforms = ('fourier', 'invFourier')
+        fused = []
+        for op in ops:
+            if fused and op[0] in transforms and fused[-1][0] in transforms and op[0] != fused[-1][0]:
+                fused.pop() # A Fourier transform directly followed by its inverse
+            else:
+                fused.append(op)
+        if not fused:
+            return owned
+        hyperComplex = data.isHyperComplex(axis)
+        if hyperComplex:
+            if not owned:
+                data.data = np.array(data.data)
+                owned = True
+            data.icomplexReorder(axis)
+        vector = None
+        for op in fused:
+            if op[0] == 'multiply':
+                vector = op[1] if vector is None else vector * op[1]
+            elif op[0] == 'fourier':
+                # The fftshift is applied as a modulation in the time domain
+                shiftVector = self.__shiftVector(data.shape()[axis])
+                vector = shiftVector if vector is None else vector * shiftVector
+                data.data = fe.ENGINE.fft(data.data * self.__expand(vector, data, axis), axis=axis+1, overwrite=True)
+                vector = None
+                owned = True
+            elif op[0] == 'invFourier':
+                owned = self.__applyVector(data, vector, axis, owned)
+                data.data = fe.ENGINE.ifft(data.data, axis=axis+1, overwrite=owned)
+                vector = np.conj(self.__shiftVector(data.shape()[axis]))
+                owned = True
+            elif op[0] == 'resize':
+                data.data = self.__resizeArray(data.data, vector, axis, op[1], op[2])
+                vector = None
+                owned = True
+            elif op[0] == 'baseline':
+                owned = self.__applyVector(data, vector, axis, owned)
+                vector = None
+                if hyperComplex:
+                    data.icomplexReorder(axis)
+                if not owned:
+                    data.data = np.array(data.data)
+                    owned = True
+                data.data[0] -= self.__expand(op[1], data, axis)
+                if hyperComplex:
+                    data.icomplexReorder(axis)
+        owned = self.__applyVector(data, vector, axis, owned)
+        if hyperComplex:
+            data.icomplexReorder(axis)
+        return owned
+
+    def __castVector(self, vector, array):
+        if array.dtype == np.complex64: # Keep single precision data in single precision
+            return vector.astype(np.complex64 if np.iscomplexobj(vector) else np.float32)
+        return vector
+
+    def __expand(self, vector, data, axis):
+        vector = self.__castVector(vector, data.data)
+        return vector.reshape(vector.shape + (1, )*(data.ndim()-axis-1))
+
+    def __applyVector(self, data, vector, axis, owned):
+        if vector is None:
+            return owned
+        if owned:
+            data.data *= self.__expand(vector, data, axis)
+        else:
+            data.data = data.data * self.__expand(vector, data, axis)
+        return True
+
+    def __shiftVector(self, length):
+        if length % 2 == 0:
+            return np.where(np.arange(length) % 2, -1.0, 1.0)
+        return np.exp(2j * np.pi * np.arange(length) * (length // 2) / length)
+
+    def __resizeArray(self, array, vector, axis, size, pos):
+        # Same result as HComplexData.resize, with the multiplication by vector applied while copying
+        axis += 1
+        if vector is not None:
+            vector = self.__castVector(vector, array)
+        oldSize = array.shape[axis]
+        newShape = list(array.shape)
+        newShape[axis] = size
+        if size > oldSize:
+            pos = slice(None, pos).indices(oldSize)[1]
+            tmpData = np.zeros(newShape, dtype=array.dtype)
+            blocks = [(0, pos, 0), (pos, oldSize, pos + size - oldSize)]
+        else:
+            tmpData = np.empty(newShape, dtype=array.dtype)
+            difference = oldSize - size
+            removeBegin = int(np.floor(difference / 2))
+            removeEnd = difference - removeBegin
+            if pos < removeBegin:
+                blocks = [(difference, oldSize, 0)]
+            elif oldSize - pos < removeEnd:
+                blocks = [(0, size, 0)]
+            else:
+                blocks = [(0, pos - removeBegin, 0), (pos + removeEnd, oldSize, pos - removeBegin)]
+        for begin, end, dest in blocks:
+            if end <= begin:
+                continue
+            source = array[(slice(None), ) * axis + (slice(begin, end), )]
+            target = tmpData[(slice(None), ) * axis + (slice(dest, dest + end - begin), )]
+            if vector is None:
+                target[...] = source
+            else:
+                np.multiply(source, vector[begin:end].reshape((end - begin, ) + (1, )*(array.ndim-axis-1)), out=target)
+        return tmpData
+
     def undo(self):
         """
         Undoes the last operation and puts it in the redo list.
@@ -257,7 +783,7 @@ class Spectrum(object):
         Reloads the data based on the filePath of this spectrum.
         """
         import specIO as io
-        loadData = io.autoLoad(*self.filePath)
+        loadData = io.autoLoad(*self.filePath, singlePrecision=self.singlePrecision)
         self.restoreData(loadData, None)
 
     def checkAxis(self, axis):
@@ -359,7 +885,7 @@ class Spectrum(object):
             if self.data.hyper == data.hyper: # If both sets have same hyper: easy undo can be used
                 returnValue = lambda self: self.delete(range(pos, pos + data.shape()[axis]), axis)
             else: # Otherwise: do a deep copy of the class
-                copyData = copy.deepcopy(self)
+                copyData = UndoSnapshot(self)
                 returnValue = lambda self: self.restoreData(copyData, lambda self: self.insert(data, pos, axis))
         axis = self.checkAxis(axis)
         # Check for a change in dimensions
@@ -389,7 +915,7 @@ class Spectrum(object):
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         tmpData = self.data.delete(pos, axis)
         if 0 in tmpData.shape():
             raise SpectrumException('Cannot delete all data')
@@ -447,7 +973,7 @@ class Spectrum(object):
             elif self.data.hyper == data.hyper: # If both sets have same hyper: easy subtract can be used for undo
                 returnValue = lambda self: self.subtract(data, axis, select=select)
             else: # Otherwise: do a deep copy of the class
-                copyData = copy.deepcopy(self)
+                copyData = UndoSnapshot(self)
                 returnValue = lambda self: self.restoreData(copyData, lambda self: self.add(data, axis, select))
         self.data[select] += data
         if isinstance(data, (float, int)):
@@ -501,7 +1027,7 @@ class Spectrum(object):
             elif self.data.hyper == data.hyper: #If both sets have same hyper: easy subtract can be used for undo
                 returnValue = lambda self: self.add(data, axis, select=select)
             else: # Otherwise: do a deep copy of the class
-                copyData = copy.deepcopy(self)
+                copyData = UndoSnapshot(self)
                 returnValue = lambda self: self.restoreData(copyData, lambda self: self.subtract(data, axis, select))
         self.data[select] -= data
         if isinstance(data, (float, int)):
@@ -555,7 +1081,7 @@ class Spectrum(object):
             elif self.data.hyper == data.hyper: # If both sets have same hyper: easy subtract can be used for undo
                 returnValue = lambda self: self.divide(data, axis, select=select)
             else: # Otherwise: do a deep copy of the class
-                copyData = copy.deepcopy(self)
+                copyData = UndoSnapshot(self)
                 returnValue = lambda self: self.restoreData(copyData, lambda self: self.multiply(data, axis, select))
         self.data[select] *= data
         if isinstance(data, (float, int)):
@@ -608,7 +1134,7 @@ class Spectrum(object):
             elif self.data.hyper == data.hyper: #If both sets have same hyper: easy subtract can be used for undo
                 returnValue = lambda self: self.multiply(data, axis, select=select)
             else: # Otherwise: do a deep copy of the class
-                copyData = copy.deepcopy(self)
+                copyData = UndoSnapshot(self)
                 returnValue = lambda self: self.restoreData(copyData, lambda self: self.divide(data, axis, select))
         self.data[select] /= data
         if isinstance(data, (float, int)):
@@ -678,7 +1204,10 @@ class Spectrum(object):
         """
         axis = self.checkAxis(axis)
         baselinetmp = baseline.reshape((self.shape()[axis], ) + (1, ) * (self.ndim() - axis - 1))
-        self.data[select] -= baselinetmp
+        if self.__canDefer(select):
+            self.__record(axis, 'baseline', baselinetmp.reshape(-1))
+        else:
+            self.data[select] -= baselinetmp
         Message = "Baseline corrected dimension " + str(axis + 1)
         if not isinstance(select, slice):
             Message = Message + " with slice " + str(select)
@@ -689,6 +1218,66 @@ class Spectrum(object):
         if not self.noUndo:
             self.undoList.append(lambda self: self.baselineCorrection(-baseline, axis, select=select))
 
+    def baselineCorrectionAll(self, degree, removeList, axis=-1, invert=False, part='real', method='poly', numKnots=8, lam=1e5, asym=0.01):
+        """
+        Fits and subtracts a baseline for every trace along a given dimension separately.
+
+        Parameters
+        ----------
+        degree : int
+            The degree of the polynomial.
+        removeList : list of int
+            Pairs of indices between which the points are not used for the fit.
+        axis : int, optional
+            The dimension along which the baseline correction is performed.
+            By default the last dimension is used.
+        invert : bool, optional
+            If True, only the points between the pairs of indices are used for the fit.
+            False by default.
+        part : {'real', 'imag', 'abs'}, optional
+            The representation of the data to which the baseline is fitted.
+            'real' by default.
+        method : {'poly', 'spline', 'als'}, optional
+            The type of baseline: a polynomial, a cubic spline or an asymmetric least squares baseline.
+            'poly' by default.
+        numKnots : int, optional
+            The number of segments of the spline.
+            8 by default.
+        lam : float, optional
+            The smoothness of the asymmetric least squares baseline.
+            1e5 by default.
+        asym : float, optional
+            The asymmetry of the asymmetric least squares baseline.
+            0.01 by default.
+
+        Raises
+        ------
+        SpectrumException
+            When the part or method is unknown.
+        """
+        axis = self.checkAxis(axis)
+        partFuncs = {'real': np.real, 'imag': np.imag, 'abs': np.abs}
+        if part not in partFuncs:
+            raise SpectrumException("Unknown data part: " + str(part))
+        if method not in ('poly', 'spline', 'als'):
+            raise SpectrumException("Unknown baseline method: " + str(method))
+        bArray = func.baselineSelection(self.shape()[axis], removeList, invert)
+        traces = np.moveaxis(partFuncs[part](self.data.getHyperData(0)), axis, -1)
+        shape = traces.shape
+        baseline = func.baselineFit(self.xaxArray[axis], traces.reshape(-1, shape[-1]), bArray, degree, method, numKnots, lam, asym)
+        baseline = np.moveaxis(baseline.reshape(shape), -1, axis)
+        self.data -= baseline
+        if method == 'poly':
+            Message = "Baseline corrected dimension " + str(axis + 1) + " per trace with a polynomial of degree " + str(degree)
+        elif method == 'spline':
+            Message = "Baseline corrected dimension " + str(axis + 1) + " per trace with a spline of " + str(numKnots) + " segments"
+        else:
+            Message = "Baseline corrected dimension " + str(axis + 1) + " per trace with asymmetric least squares"
+        self.addHistory(Message)
+        self.redoList = []
+        if not self.noUndo:
+            self.undoList.append(lambda self: self.add(baseline))
+
     def concatenate(self, axis=-1):
         """
         Concatenates the data along a given dimension.
@@ -704,7 +1293,7 @@ class Spectrum(object):
         copyData = None
         if self.data.isComplex(axis):
             if not self.noUndo:
-                copyData = copy.deepcopy(self)
+                copyData = UndoSnapshot(self)
             self.data = self.data.real(axis)
         invAxis = self.ndim() - axis
         self.data = self.data.concatenate(axis)
@@ -764,7 +1353,7 @@ class Spectrum(object):
             By default the last dimension is used.
         """
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         axis = self.checkAxis(axis)
         self.data = self.data.real(axis)
         self.addHistory("Real along dimension " + str(axis+1))
@@ -783,7 +1372,7 @@ class Spectrum(object):
             By default the last dimension is used.
         """
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         axis = self.checkAxis(axis)
         self.data = self.data.imag(axis)
         self.addHistory("Imaginary along dimension " + str(axis+1))
@@ -802,7 +1391,7 @@ class Spectrum(object):
             By default the last dimension is used.
         """
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         axis = self.checkAxis(axis)
         self.data = self.data.abs(axis)
         self.addHistory("Absolute along dimension " + str(axis+1))
@@ -820,7 +1409,7 @@ class Spectrum(object):
             The dimension.
             By default the last dimension is used.
         """
-        self.data = self.data.conj(axis)
+        self.data.iconj(axis)
         self.addHistory("Complex conjugate along" + str(axis+1))
         self.redoList = []
         if not self.noUndo:
@@ -838,7 +1427,7 @@ class Spectrum(object):
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         self.data.states(axis)
         self.resetXax(axis)
         self.addHistory("States conversion on dimension " + str(axis + 1))
@@ -858,7 +1447,7 @@ class Spectrum(object):
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         self.data.states(axis, TPPI=True)
         self.resetXax(axis)
         self.addHistory("States-TPPI conversion on dimension " + str(axis + 1))
@@ -878,7 +1467,7 @@ class Spectrum(object):
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         self.data.echoAntiEcho(axis)
         self.resetXax(axis)
         self.addHistory("Echo-antiecho conversion on dimension " + str(axis + 1))
@@ -1043,7 +1632,7 @@ class Spectrum(object):
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         self.matrixManip(pos1, pos2, axis, which=0)
         self.redoList = []
         if not self.noUndo:
@@ -1069,7 +1658,7 @@ class Spectrum(object):
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         self.matrixManip(pos1, pos2, axis, which=1)
         self.redoList = []
         if not self.noUndo:
@@ -1095,7 +1684,7 @@ class Spectrum(object):
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         self.matrixManip(pos1, pos2, axis, which=2)
         self.redoList = []
         if not self.noUndo:
@@ -1121,7 +1710,7 @@ class Spectrum(object):
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         self.matrixManip(pos1, pos2, axis, which=3)
         self.redoList = []
         if not self.noUndo:
@@ -1147,7 +1736,7 @@ class Spectrum(object):
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         self.matrixManip(pos1, pos2, axis, which=4)
         self.redoList = []
         if not self.noUndo:
@@ -1173,7 +1762,7 @@ class Spectrum(object):
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         self.matrixManip(pos1, pos2, axis, which=5)
         self.redoList = []
         if not self.noUndo:
@@ -1199,7 +1788,7 @@ class Spectrum(object):
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         self.matrixManip(pos1, pos2, axis, which=6)
         self.redoList = []
         if not self.noUndo:
@@ -1228,7 +1817,7 @@ class Spectrum(object):
         if pos2 is None:
             pos2 = self.shape()[axis]
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         minPos = min(pos1, pos2)
         maxPos = max(pos1, pos2)
         slicing = (slice(None), ) * axis + (slice(minPos, maxPos), )
@@ -1272,10 +1861,10 @@ class Spectrum(object):
         if len(refSpec) != axLen:
             raise SpectrumException("Reference FID does not have the correct length")
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         tmpSpec = np.fft.ifftshift(np.real(refSpec))
         pos = np.argmax(tmpSpec)
-        refFid = np.fft.ifft(tmpSpec)
+        refFid = fe.ENGINE.ifft(tmpSpec)
         if self.spec[axis] > 0:
             self.__invFourier(axis, tmp=True)
         t = np.arange(axLen) / self.sw[axis]
@@ -1311,7 +1900,7 @@ class Spectrum(object):
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         self.data = self.data.diff(axis=axis)
         self.resetXax(axis)
         self.addHistory("Differences over dimension " + str(axis + 1))
@@ -1331,7 +1920,7 @@ class Spectrum(object):
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         self.data = self.data.cumsum(axis=axis)
         self.addHistory("Cumulative sum over dimension " + str(axis + 1))
         self.redoList = []
@@ -1368,7 +1957,7 @@ class Spectrum(object):
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         self.data.icomplexReorder(axis)
         self.data = self.data.hilbert(axis=axis)
         self.data.icomplexReorder(axis)
@@ -1393,14 +1982,29 @@ class Spectrum(object):
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
-        shape = self.data.shape()
-        shape = np.delete(shape, axis)
-        rangeList = [range(i) for i in shape]
-        for i in itertools.product(*rangeList):
-            locList = np.insert(i, axis, 0)
-            selectList = np.insert(np.array(i, dtype=object), axis, slice(None))
-            self.autoPhase(phaseNum, axis, locList, False, selectList)
+            copyData = UndoSnapshot(self)
+        self.data.icomplexReorder(axis)
+        if self.spec[axis] == 0:
+            self.__fourier(axis, tmp=True)
+        traces = np.moveaxis(self.data.getHyperData(0), axis, -1)
+        shape = traces.shape
+        traces = np.asarray(traces, dtype=complex).reshape(-1, shape[-1])   # only optimize on the hyper real data, in double precision
+        x = np.fft.fftshift(np.fft.fftfreq(shape[-1], 1.0 / self.sw[axis])) / self.sw[axis]
+        numJobs = max(1, min(wp.POOL.numProc * 4, len(traces)))
+        jobs = [(block, x, phaseNum == 1, AUTOPHASETOL) for block in np.array_split(traces, numJobs)]
+        phases = np.concatenate(wp.POOL.map(func.autoPhaseTraces, jobs))
+        del traces
+        if self.ref[axis] is None:
+            offset = 0
+        else:
+            offset = self.freq[axis] - self.ref[axis]
+        vector = np.fft.fftshift(np.fft.fftfreq(shape[-1], 1.0 / self.sw[axis]) + offset) / self.sw[axis]
+        phase0 = phases[:, 0].reshape(shape[:-1] + (1, ))
+        phase1 = phases[:, 1].reshape(shape[:-1] + (1, ))
+        self.data.data *= np.moveaxis(np.exp(1j * (phase0 + phase1 * vector)), -1, axis)
+        if self.spec[axis] == 0:
+            self.__invFourier(axis, tmp=True)
+        self.data.icomplexReorder(axis)
         if phaseNum == 1:
             self.addHistory("Autophased per trace for 0 + 1 order along axis " + str(axis + 1))
         else:
@@ -1450,16 +2054,9 @@ class Spectrum(object):
         if self.spec[axis] == 0:
             self.__fourier(axis, tmp=True)
         tmp = self.data[locList]
-        tmp = tmp.getHyperData(0)   # only optimize on the hyper real data
+        tmp = np.asarray(tmp.getHyperData(0), dtype=complex)   # only optimize on the hyper real data, in double precision
         x = np.fft.fftshift(np.fft.fftfreq(len(tmp), 1.0 / self.sw[axis])) / self.sw[axis]
-        if phaseNum == 0:
-            phases = scipy.optimize.minimize(func.ACMEentropy, [0], (tmp, x, False), method='Powell', options={'xtol': AUTOPHASETOL})
-            phase0 = phases['x']
-            phase1 = 0.0
-        elif phaseNum == 1:
-            phases = scipy.optimize.minimize(func.ACMEentropy, [0, 0], (tmp, x), method='Powell', options={'xtol': AUTOPHASETOL})
-            phase0 = phases['x'][0]
-            phase1 = phases['x'][1]
+        phase0, phase1 = func.autoPhaseTraces((tmp[np.newaxis], x, phaseNum == 1, AUTOPHASETOL))[0]
         if self.ref[axis] is None:
             offset = 0
         else:
@@ -1474,8 +2071,8 @@ class Spectrum(object):
         self.addHistory(Message)
         if returnPhases:
             if phaseNum == 0:
-                return [phases['x']]
-            return phases['x']
+                return [phase0]
+            return [phase0, phase1]
         self.redoList = []
         if not self.noUndo:
             self.undoList.append(lambda self: self.phase(-phase0, -phase1, axis))
@@ -1484,13 +2081,21 @@ class Spectrum(object):
         vector = np.exp(np.fft.fftshift(np.fft.fftfreq(self.shape()[axis], 1.0 / self.sw[axis]) + offset) / self.sw[axis] * phase1 * 1j)
         if self.spec[axis] == 0:
             self.__fourier(axis, tmp=True)
-        vector = vector.reshape(vector.shape + (1, )*(self.ndim()-axis-1))
-        self.data.icomplexReorder(axis)
-        self.data[select] *= np.exp(phase0 * 1j) * vector
-        self.data.icomplexReorder(axis)
+        self.__multiply(np.exp(phase0 * 1j) * vector, axis, select, reorder=True)
         if self.spec[axis] == 0:
             self.__invFourier(axis, tmp=True)
 
+    def __multiply(self, vector, axis, select=slice(None), reorder=False):
+        if self.__canDefer(select) and (reorder or np.isrealobj(vector)):
+            self.__record(axis, 'multiply', vector)
+            return
+        vector = vector.reshape(vector.shape + (1, )*(self.ndim()-axis-1))
+        if reorder:
+            self.data.icomplexReorder(axis)
+        self.data[select] *= vector
+        if reorder:
+            self.data.icomplexReorder(axis)
+
     def phase(self, phase0=0.0, phase1=0.0, axis=-1, select=slice(None)):
         """
         Phases a spectrum along a given dimension.
@@ -1593,7 +2198,7 @@ class Spectrum(object):
             shiftingAxis = 0
             shifting = 0.0
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self, select)
         axLen = self.shape()[axis]
         t = np.arange(0, axLen) / self.sw[axis]
         if shifting != 0.0:
@@ -1624,7 +2229,7 @@ class Spectrum(object):
                 previewData = [x] * int(np.prod(self.data.shape()) / self.data.shape()[axis])
             if self.spec[axis] > 0:
                 self.__invFourier(axis, tmp=True)
-            self.data[select] *= x.reshape(x.shape + (1, )*(self.ndim()-axis-1))
+            self.__multiply(x, axis, select)
             if self.spec[axis] > 0:
                 self.__fourier(axis, tmp=True)
         # Create the history message based on the input values.
@@ -1753,7 +2358,7 @@ class Spectrum(object):
             By default the last dimension is used.
         """
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         newSw = (limits[1] - limits[0]) / (numPoints - 1) * numPoints
         newAxis = np.fft.fftshift(np.fft.fftfreq(numPoints, 1.0 / newSw))
         newAxis = newAxis - (newAxis[0] + newAxis[-1]) / 2 + (limits[0] + limits[-1]) / 2  # Axis with correct min/max
@@ -1808,10 +2413,13 @@ class Spectrum(object):
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         if self.spec[axis]:
             self.__invFourier(axis, tmp=True)
-        self.data = self.data.resize(size, pos, axis=axis)
+        if self.__canDefer():
+            self.__record(axis, 'resize', size, pos)
+        else:
+            self.data = self.data.resize(size, pos, axis=axis)
         if self.spec[axis]:
             self.__fourier(axis, tmp=True)
         self.resetXax(axis)
@@ -1849,7 +2457,7 @@ class Spectrum(object):
         failed = False
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         self.data.icomplexReorder(axis)
         if self.spec[axis]:
             self.__invFourier(axis, tmp=True)
@@ -1935,7 +2543,7 @@ class Spectrum(object):
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self, select)
         if self.spec[axis] > 0:
             self.__invFourier(axis, tmp=True)
         mask = np.ones(self.shape()[axis])
@@ -2016,7 +2624,7 @@ class Spectrum(object):
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         if pos1 is None:
             pos1 = 0
         if pos2 is None:
@@ -2048,34 +2656,49 @@ class Spectrum(object):
         axis = self.checkAxis(axis)
         if reorder is None:
             reorder = [True, True]
-        if reorder[0]:
-            self.data.icomplexReorder(axis)
-        if not self.wholeEcho[axis] and not tmp:
-            slicing = (slice(None), ) * axis + (0, )
-            self.data[slicing] = self.data[slicing] * 0.5
-        self.data = self.data.fft(axis).fftshift(axis)
+        if self.__canDefer() and all(reorder):
+            if not self.wholeEcho[axis] and not tmp:
+                self.__record(axis, 'multiply', self.__firstPointVector(axis, 0.5))
+            self.__record(axis, 'fourier')
+        else:
+            if reorder[0]:
+                self.data.icomplexReorder(axis)
+            if not self.wholeEcho[axis] and not tmp:
+                slicing = (slice(None), ) * axis + (0, )
+                self.data[slicing] = self.data[slicing] * 0.5
+            self.data = self.data.fft(axis).fftshift(axis)
+            if reorder[1]:
+                self.data.icomplexReorder(axis)
         if not tmp:
             self.spec[axis] = 1
-        if reorder[1]:
-            self.data.icomplexReorder(axis)
         self.resetXax(axis)
 
     def __invFourier(self, axis, tmp=False, reorder=None):
         axis = self.checkAxis(axis)
         if reorder is None:
             reorder = [True, True]
-        if reorder[0]:
-            self.data.icomplexReorder(axis)
-        self.data = self.data.ifftshift(axis).ifft(axis)
-        if not self.wholeEcho[axis] and not tmp:
-            slicing = (slice(None), ) * axis + (0, )
-            self.data[slicing] *= 2.0
+        if self.__canDefer() and all(reorder):
+            self.__record(axis, 'invFourier')
+            if not self.wholeEcho[axis] and not tmp:
+                self.__record(axis, 'multiply', self.__firstPointVector(axis, 2.0))
+        else:
+            if reorder[0]:
+                self.data.icomplexReorder(axis)
+            self.data = self.data.ifftshift(axis).ifft(axis)
+            if not self.wholeEcho[axis] and not tmp:
+                slicing = (slice(None), ) * axis + (0, )
+                self.data[slicing] *= 2.0
+            if reorder[1]:
+                self.data.icomplexReorder(axis)
         if not tmp:
             self.spec[axis] = 0
-        if reorder[1]:
-            self.data.icomplexReorder(axis)
         self.resetXax(axis)
 
+    def __firstPointVector(self, axis, scale):
+        vector = np.ones(self.shape()[axis])
+        vector[0] = scale
+        return vector
+
     def complexFourier(self, axis=-1):
         """
         Perform a complex Fourier transform along a given dimension.
@@ -2107,7 +2730,7 @@ class Spectrum(object):
             By default the last dimension is used.
         """
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         axis = self.checkAxis(axis)
         self.data = self.data.real(axis)
         if self.spec[axis] == 0:
@@ -2219,7 +2842,7 @@ class Spectrum(object):
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         self.data = self.data.reorder(pos, newLength, axis)
         self.resetXax(axis)
         self.addHistory("Reorder dimension " + str(axis + 1) + " to obtain a new length of " + str(newLength) + " with positions " + str(pos))
@@ -2227,7 +2850,7 @@ class Spectrum(object):
         if not self.noUndo:
             self.undoList.append(lambda self: self.restoreData(copyData, lambda self: self.reorder(pos, newLength, axis)))
 
-    def ffm(self, pos, typeVal, axis=-1):
+    def ffm(self, pos, typeVal, axis=-1, tol=None, maxIter=None, warmStart=True):
         """
         Uses the fast forward maximum entropy algorithm to reconstruct non-uniform sampled data.
 
@@ -2242,10 +2865,26 @@ class Spectrum(object):
         axis : int, optional
             The axis along which the data is reconstructed.
             By default the last dimension is used.
+        tol : float, optional
+            The relative change of the entropy at which the optimization of a trace stops.
+            By default the default of L-BFGS-B is used.
+        maxIter : int, optional
+            The maximum number of iterations per trace.
+            By default the default of L-BFGS-B is used.
+        warmStart : bool, optional
+            If True, the optimization of every trace starts from the solution of the neighbouring trace.
+            True by default.
+
+        Returns
+        -------
+        ndarray
+            The number of iterations of every trace, with the shape of the data without the reconstructed axis.
+        ndarray
+            Boolean array which is True for the traces that converged, with the same shape.
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         posList = np.delete(range(self.shape()[axis]), pos)  # pos contains the values of fixed points which not to be translated to missing points
         if typeVal == 1:  # type is States or States-TPPI, the positions need to be divided by 2
             posList = np.array(np.floor(posList / 2), dtype=int)
@@ -2257,17 +2896,18 @@ class Spectrum(object):
         tmpData = np.rollaxis(tmpData, axis, tmpData.ndim)
         tmpShape = tmpData.shape
         tmpData = tmpData.reshape((int(tmpData.size / tmpShape[-1]), tmpShape[-1]))
-        pool = multiprocessing.Pool(multiprocessing.cpu_count())
-        fit = pool.map_async(nus.ffm, [(i, posList) for i in tmpData])
-        pool.close()
-        pool.join()
-        tmpData = np.rollaxis(np.array(fit.get()).reshape(tmpShape), -1, axis)
+        fit, iterations, converged = nus.reconstruct(nus.ffmBlock, tmpData, (posList, tol, maxIter, warmStart), tmpData.dtype)
+        tmpData = np.rollaxis(fit.reshape(tmpShape), -1, axis)
         self.data = hc.HComplexData(tmpData)
         self.__invFourier(axis, tmp=True)  # Transform back to FID
-        self.addHistory("Fast Forward Maximum Entropy reconstruction of dimension " + str(axis + 1) + " at positions " + str(pos))
+        settings = ""
+        if tol is not None or maxIter is not None:
+            settings = " (tolerance = " + str(tol) + " , maxIter = " + str(maxIter) + ")"
+        self.addHistory("Fast Forward Maximum Entropy reconstruction" + settings + " of dimension " + str(axis + 1) + " at positions " + str(pos) + self.__convergenceText(converged))
         self.redoList = []
         if not self.noUndo:
             self.undoList.append(lambda self: self.restoreData(copyData, None))
+        return iterations.reshape(tmpShape[:-1]), converged.reshape(tmpShape[:-1])
 
     def clean(self, pos, typeVal, axis, gamma, threshold, maxIter):
         """
@@ -2289,10 +2929,17 @@ class Spectrum(object):
             Stopping limit (0 < x < 1) (stop if residual intensity below this point).
         maxIter : int
             Maximum number of iterations.
+
+        Returns
+        -------
+        ndarray
+            The number of iterations of every trace, with the shape of the data without the reconstructed axis.
+        ndarray
+            Boolean array which is True for the traces that converged, with the same shape.
         """
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         posList = np.delete(range(self.shape()[axis]), pos)  # pos contains the values of fixed points which not to be translated to missing points
         if typeVal == 1:  # type is States or States-TPPI, the positions need to be divided by 2
             posList = np.array(np.floor(posList / 2), dtype=int)
@@ -2301,23 +2948,21 @@ class Spectrum(object):
         posList = np.unique(posList)
         self.data.icomplexReorder(axis)
         tmpData = self.data.getHyperData(0)
-        tmpData = np.rollaxis(np.fft.fft(tmpData, axis=axis), axis, tmpData.ndim)
+        tmpData = np.rollaxis(fe.ENGINE.fft(tmpData, axis=axis), axis, tmpData.ndim)
         tmpShape = tmpData.shape
         tmpData = tmpData.reshape((int(tmpData.size / tmpShape[-1]), tmpShape[-1]))
         mask = np.ones(tmpShape[-1]) / float(tmpShape[-1])
         mask[posList] = 0.0
-        mask = np.fft.fft(mask) # abs or real???
-        pool = multiprocessing.Pool(multiprocessing.cpu_count())
-        fit = pool.map_async(nus.clean, [(i, mask, gamma, threshold, maxIter) for i in tmpData])
-        pool.close()
-        pool.join()
-        tmpData = np.rollaxis(np.array(fit.get()).reshape(tmpShape), -1, axis)
+        mask = fe.ENGINE.fft(mask, overwrite=True) # abs or real???
+        fit, iterations, converged = nus.reconstruct(nus.cleanBlock, tmpData, (mask, gamma, threshold, maxIter), tmpData.real.dtype)
+        tmpData = np.rollaxis(fit.reshape(tmpShape), -1, axis)
         self.data = hc.HComplexData(tmpData)
         self.__invFourier(axis, tmp=True)  # Transform back to FID
-        self.addHistory("CLEAN reconstruction (gamma = " + str(gamma) + " , threshold = " + str(threshold) + " , maxIter = " + str(maxIter) + ") " + "of dimension " + str(axis + 1) + " at positions " + str(pos))
+        self.addHistory("CLEAN reconstruction (gamma = " + str(gamma) + " , threshold = " + str(threshold) + " , maxIter = " + str(maxIter) + ") " + "of dimension " + str(axis + 1) + " at positions " + str(pos) + self.__convergenceText(converged))
         self.redoList = []
         if not self.noUndo:
             self.undoList.append(lambda self: self.restoreData(copyData, None))
+        return iterations.reshape(tmpShape[:-1]), converged.reshape(tmpShape[:-1])
 
     def ist(self, pos, typeVal, axis, threshold, maxIter, tracelimit):
         """
@@ -2328,21 +2973,32 @@ class Spectrum(object):
         pos : array_like
             A list of indices that are recorded datapoints.
             All other datapoints will be reconstructed.
+            When several axes are given, a list with the coordinates of every recorded datapoint, with one column per axis (as in a nuslist schedule).
         typeVal : {0, 1, 2}
             The type of data to be reconstructed.
             0=complex, 1=States or States-TPPI, 2=TPPI.
-        axis : int
+        axis : int or list of ints
             The axis along which the data is reconstructed.
+            When a list of axes is given, these axes are reconstructed jointly, with N-D thresholding of every plane.
         threshold : float
             threshold. The level (0 < x < 1) at which the data is cut every iteration.
         maxIter : int
             Maximum number of iterations.
         tracelimit : float
             Stopping limit (0 < x < 1) (stop if residual intensity below this point).
+
+        Returns
+        -------
+        ndarray
+            The number of iterations of every trace, with the shape of the data without the reconstructed axes.
+        ndarray
+            Boolean array which is True for the traces that converged, with the same shape.
         """
+        if isinstance(axis, (list, tuple, np.ndarray)):
+            return self.__istJoint(pos, typeVal, axis, threshold, maxIter, tracelimit)
         axis = self.checkAxis(axis)
         if not self.noUndo:
-            copyData = copy.deepcopy(self)
+            copyData = UndoSnapshot(self)
         self.data.icomplexReorder(axis)
         tmpData = self.data.getHyperData(0)
         posList = np.delete(range(tmpData.shape[axis]), pos)  # pos contains the values of fixed points which not to be translated to missing points
@@ -2350,21 +3006,65 @@ class Spectrum(object):
             posList = np.array(np.floor(posList / 2), dtype=int)
         elif typeVal == 2:  # type is TPPI, for now handle the same as Complex
             pass
-        NDmax = np.max(np.max(np.abs(np.real(np.fft.fft(tmpData, axis=axis))))) #Get max of ND matrix
+        NDmax = np.max(np.max(np.abs(np.real(fe.ENGINE.fft(tmpData, axis=axis))))) #Get max of ND matrix
         tmpData = np.rollaxis(tmpData, axis, tmpData.ndim)
         tmpShape = tmpData.shape
         tmpData = tmpData.reshape((int(tmpData.size / tmpShape[-1]), tmpShape[-1]))
-        pool = multiprocessing.Pool(multiprocessing.cpu_count())
-        fit = pool.map_async(nus.ist, [(i, posList, threshold, maxIter, tracelimit, NDmax) for i in tmpData])
-        pool.close()
-        pool.join()
-        tmpData = np.rollaxis(np.array(fit.get()).reshape(tmpShape), -1, axis)
+        fit, iterations, converged = nus.reconstruct(nus.istBlock, tmpData, (posList, threshold, maxIter, tracelimit, NDmax), tmpData.real.dtype)
+        tmpData = np.rollaxis(fit.reshape(tmpShape), -1, axis)
         self.data = hc.HComplexData(tmpData)
         self.__invFourier(axis, tmp=True)  # Transform back to FID
-        self.addHistory("IST reconstruction (threshold = " + str(threshold) + " , maxIter = " + str(maxIter) + " , tracelimit = " + str(tracelimit*100) + ") " + "of dimension " + str(axis + 1) + " at positions " + str(pos))
+        self.addHistory("IST reconstruction (threshold = " + str(threshold) + " , maxIter = " + str(maxIter) + " , tracelimit = " + str(tracelimit*100) + ") " + "of dimension " + str(axis + 1) + " at positions " + str(pos) + self.__convergenceText(converged))
         self.redoList = []
         if not self.noUndo:
             self.undoList.append(lambda self: self.restoreData(copyData, None))
+        return iterations.reshape(tmpShape[:-1]), converged.reshape(tmpShape[:-1])
+
+    def __istJoint(self, pos, typeVal, axes, threshold, maxIter, tracelimit):
+        axes = [self.checkAxis(axis) for axis in axes]
+        posText = str(np.array(pos).tolist())
+        if len(set(axes)) != len(axes):
+            raise SpectrumException("IST: the joint axes should be different")
+        pos = np.array(pos, dtype=int).reshape(-1, len(axes))
+        order = np.argsort(axes)
+        axes = [axes[i] for i in order]
+        pos = pos[:, order]  # The columns of pos in the order of the axes
+        if typeVal == 1:  # type is States or States-TPPI, the positions are given per real increment
+            pos = pos // 2
+        shape = [self.shape()[axis] for axis in axes]
+        if np.any(pos < 0) or np.any(pos >= shape):
+            raise SpectrumException("IST: positions outside of the data")
+        mask = np.zeros(shape, dtype=bool)
+        mask[tuple(pos.T)] = True
+        if not self.noUndo:
+            copyData = UndoSnapshot(self)
+        self.data.icomplexReorder(axes[0])
+        # The parts that are imaginary along the other axes, with bit k-1 of the index for the kth axis
+        parts = []
+        for m in range(2**(len(axes) - 1)):
+            hyperVal = sum(2**axis for k, axis in enumerate(axes[1:]) if m & 2**k)
+            if hyperVal in self.data.hyper:
+                parts.append(self.data.getHyperData(hyperVal))
+            else:  # not hypercomplex along this axis, the imaginary part is taken as zero
+                parts.append(np.zeros_like(self.data.getHyperData(0)))
+        tmpData = np.array(parts)
+        tmpData = np.moveaxis(tmpData, [0] + [axis + 1 for axis in axes], list(range(-len(axes) - 1, 0)))
+        tmpShape = tmpData.shape
+        tmpData = tmpData.reshape((-1, len(parts)) + tuple(shape))
+        NDmax = nus.jointSpectrumMax(tmpData)
+        fit, iterations, converged = nus.reconstruct(nus.istJointBlock, tmpData, (mask, threshold, maxIter, tracelimit, NDmax), tmpData.real.dtype, shape)
+        tmpData = np.moveaxis(fit.reshape(tmpShape[:-len(axes) - 1] + tuple(shape)), list(range(-len(axes), 0)), axes)
+        self.data = hc.HComplexData(tmpData)
+        for axis in axes:
+            self.__invFourier(axis, tmp=True)  # Transform back to FID
+        self.addHistory("Joint IST reconstruction (threshold = " + str(threshold) + " , maxIter = " + str(maxIter) + " , tracelimit = " + str(tracelimit*100) + ") " + "of dimensions " + ", ".join(str(axis + 1) for axis in axes) + " at positions " + posText + self.__convergenceText(converged))
+        self.redoList = []
+        if not self.noUndo:
+            self.undoList.append(lambda self: self.restoreData(copyData, None))
+        return iterations.reshape(tmpShape[:-len(axes) - 1]), converged.reshape(tmpShape[:-len(axes) - 1])
+
+    def __convergenceText(self, converged):
+        return ", converged for " + str(np.count_nonzero(converged)) + " of " + str(converged.size) + " traces"
 
     def getSlice(self, axes, locList, stack=None):
         """
@@ -2383,8 +3083,9 @@ class Spectrum(object):
 
         Returns
         -------
-        Spectrum
+        SpectrumSlice
             The subset spectrum.
+            Its data is a view on the data of this object, which is copied when the subset is changed.
         """
         locList = np.array(locList, dtype=object)
         if stack is None:
@@ -2392,22 +3093,17 @@ class Spectrum(object):
         for i, axis in enumerate(axes):
             axes[i] = self.checkAxis(axis)
         locList[axes] = stack
-        sliceData = self.data[locList].copy()
-        sliceData.icomplexReorder(axes[-1])
-        orderInd = np.argsort(axes)
-        sliceData = sliceData.moveaxis(np.arange(sliceData.ndim()), orderInd)
-        sliceSpec = copy.deepcopy(Spectrum(hc.HComplexData(sliceData.getHyperData(0)),
-                                           self.filePath,
-                                           [self.freq[axis] for axis in axes],
-                                           [self.sw[axis] for axis in axes],
-                                           [self.spec[axis] for axis in axes],
-                                           [self.wholeEcho[axis] for axis in axes],
-                                           [self.ref[axis] for axis in axes],
-                                           [self.xaxArray[axis][stack[i]] for i, axis in enumerate(axes)],
-                                           self.history,
-                                           name=self.name))
-        sliceSpec.noUndo = True
-        return sliceSpec
+        return SpectrumSlice(self.data, tuple(locList), axes,
+                             self.filePath,
+                             [self.freq[axis] for axis in axes],
+                             [self.sw[axis] for axis in axes],
+                             [self.spec[axis] for axis in axes],
+                             [self.wholeEcho[axis] for axis in axes],
+                             [self.ref[axis] for axis in axes],
+                             [self.xaxArray[axis][stack[i]] for i, axis in enumerate(axes)],
+                             self.history,
+                             name=self.name,
+                             singlePrecision=self.singlePrecision)
 
     def restoreData(self, copyData, returnValue):
         """
@@ -2416,24 +3112,131 @@ class Spectrum(object):
 
         Parameters
         ----------
-        copyData : Spectrum
-            The old Spectrum object to restore from.
+        copyData : Spectrum or UndoSnapshot
+            The old Spectrum object or snapshot to restore from.
         returnValue
             A return value that should be appended to the undolist.
         """
         if (not self.noUndo) and returnValue is None:
-            copyData2 = copy.deepcopy(self)
-        self.data = copyData.data
-        self.freq = copyData.freq  # array of center frequency (length is dim, MHz)
-        self.filePath = copyData.filePath
-        self.sw = copyData.sw  # array of sweepwidths
-        self.spec = copyData.spec
-        self.wholeEcho = copyData.wholeEcho
-        self.xaxArray = copyData.xaxArray
-        self.ref = copyData.ref
+            copyData2 = UndoSnapshot(self)
+        if isinstance(copyData, UndoSnapshot):
+            copyData.restore(self)
+        else:
+            self.data = copyData.data
+            self.freq = copyData.freq  # array of center frequency (length is dim, MHz)
+            self.filePath = copyData.filePath
+            self.sw = copyData.sw  # array of sweepwidths
+            self.spec = copyData.spec
+            self.wholeEcho = copyData.wholeEcho
+            self.xaxArray = copyData.xaxArray
+            self.ref = copyData.ref
         self.addHistory("Data was restored to a previous state ")
         self.redoList = []
         if (not self.noUndo) and returnValue is None:
             self.undoList.append(lambda self: self.restoreData(copyData2, None))
         else:
             self.undoList.append(returnValue)
+
+
+class SpectrumSlice(Spectrum):
+    """
+    A part of a Spectrum as returned by Spectrum.getSlice, used for displaying the data.
+    The data is a read-only view on the data of the original Spectrum, so no data is copied to create a slice.
+    Reordering of hypercomplex data is postponed until the data is first used.
+    The data and metadata are copied before the first method that can change them, so processing a slice never changes the original Spectrum.
+    """
+
+    READMETHODS = ('ndim', 'shape', 'dtype', 'getData', 'getHyperData', 'isComplex', 'getHistory', 'checkAxis', 'getSlice')
+
+    def __init__(self, source, locList, axes, *args, **kwargs):
+        """
+        Initializes the slice.
+
+        Parameters
+        ----------
+        source : HComplexData
+            The data of the original Spectrum.
+        locList : tuple
+            The indices or slices per dimension of source that select the data of the slice.
+        axes : array_like
+            The axes of source that are kept in the slice, in the order of the slice.
+        *args
+            The remaining arguments of Spectrum, starting with filePath.
+        **kwargs
+            The keyword arguments of Spectrum.
+        """
+        self.detached = False
+        super(SpectrumSlice, self).__init__(hc.HComplexData(), *args, **kwargs)
+        self.__source = (source, locList, list(axes))
+        self.__data = None
+        self.noUndo = True
+
+    @property
+    def data(self):
+        """
+        The data of the slice as HComplexData.
+        """
+        if self.__data is None:
+            source, locList, axes = self.__source
+            self.__source = None
+            sliceData = hc.HComplexData()
+            sliceData.data = source.data[(slice(None), ) + locList]
+            sliceData.hyper = source.hyper
+            reorder = sliceData.isHyperComplex(axes[-1])
+            if reorder:
+                sliceData = sliceData.complexReorder(axes[-1])
+            tmpData = sliceData.data[np.nonzero(sliceData.hyper == 0)[0][0]]
+            tmpData = np.asarray(np.moveaxis(tmpData, np.arange(tmpData.ndim), np.argsort(axes))) # Data on disk is only read where it is used
+            if not reorder: # The data is a view on the original data
+                tmpData.flags.writeable = False
+            self.__data = hc.HComplexData()
+            self.__data.data = tmpData[np.newaxis]
+            self.__data.hyper = np.array([0])
+        return self.__data
+
+    @data.setter
+    def data(self, value):
+        self.__source = None
+        self.__data = value
+
+    def detach(self):
+        """
+        Copies the data and metadata of the slice, so that they no longer share memory with the original Spectrum.
+        Called automatically before every method that can change the slice.
+        """
+        if self.detached:
+            return
+        self.detached = True
+        self.data = self.data.copy()
+        self.xaxArray = [np.array(xax, copy=True) for xax in self.xaxArray]
+        self.history = list(self.history)
+        self.metaData = dict(self.metaData)
+
+
+def copyOnWrite(method):
+    """
+    Wraps a Spectrum method, such that a SpectrumSlice is detached before the method is run.
+
+    Parameters
+    ----------
+    method : function
+        The method.
+
+    Returns
+    -------
+    function
+        The wrapped method.
+    """
+    def wrapper(self, *args, **kwargs):
+        self.detach()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = method.__name__
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
+for methodName, methodFunc in list(vars(Spectrum).items()):
+    if not callable(methodFunc) or methodName in SpectrumSlice.READMETHODS:
+        continue
+    if methodName.startswith('__') and methodName not in ('__iadd__', '__isub__', '__imul__', '__idiv__'):
+        continue
+    setattr(SpectrumSlice, methodName, copyOnWrite(methodFunc))
@@ -91,6 +91,9 @@ importList = [['matplotlib.figure', 'Figure', 'Figure'],
               ['specIO', 'io', None],
               ['views', 'views', None],
               ['simFunctions', 'sim', None],
+              ['workerPool', 'wp', None],
+              ['fftEngine', 'fe', None],
+              ['externalBridge', 'eb', None],
               ['loadIsotopes', 'loadIsotopes', None],
               ['scipy', 'optimize', 'optimize']]
 
@@ -261,6 +264,17 @@ class MainProgram(QtWidgets.QMainWindow):
         self.defaultStartupBool = False
         self.defaultStartupDir = '~'
         self.defaultTooltips = True
+        self.defaultPowderCacheSize = 256
+        self.defaultPowderCacheDisk = False
+        self.defaultLinearBinning = False
+        self.defaultLibraryDisk = False
+        self.defaultNumProc = multiprocessing.cpu_count()
+        self.defaultUndoMemory = 1024
+        self.defaultScratchSize = 4096
+        self.defaultFftBackend = 'scipy'
+        self.defaultFftThreads = multiprocessing.cpu_count()
+        self.defaultDeferMacros = False
+        self.defaultSinglePrecision = False
         self.defaultToolbarActionList = ['File --> Open',
                                          'File -- > Save --> Matlab',
                                          'File --> Export --> Figure',
@@ -357,6 +371,33 @@ class MainProgram(QtWidgets.QMainWindow):
             self.defaultHeightRatio = settings.value("contour/height_ratio", self.defaultHeightRatio, float)
         except TypeError:
             self.dispMsg("Incorrect value in the config file for the contour/height_ratio")
+        try:
+            self.defaultPowderCacheSize = settings.value("computation/powdercachesize", self.defaultPowderCacheSize, int)
+        except TypeError:
+            self.dispMsg("Incorrect value in the config file for the computation/powdercachesize")
+        self.defaultPowderCacheDisk = settings.value("computation/powdercachedisk", self.defaultPowderCacheDisk, bool)
+        self.defaultLinearBinning = settings.value("computation/linearbinning", self.defaultLinearBinning, bool)
+        self.defaultLibraryDisk = settings.value("computation/librarydisk", self.defaultLibraryDisk, bool)
+        try:
+            self.defaultNumProc = settings.value("computation/numproc", self.defaultNumProc, int)
+        except TypeError:
+            self.dispMsg("Incorrect value in the config file for the computation/numproc")
+        try:
+            self.defaultUndoMemory = settings.value("computation/undomemory", self.defaultUndoMemory, int)
+        except TypeError:
+            self.dispMsg("Incorrect value in the config file for the computation/undomemory")
+        try:
+            self.defaultScratchSize = settings.value("computation/scratchsize", self.defaultScratchSize, int)
+        except TypeError:
+            self.dispMsg("Incorrect value in the config file for the computation/scratchsize")
+        self.defaultFftBackend = settings.value("computation/fftbackend", self.defaultFftBackend, str)
+        try:
+            self.defaultFftThreads = settings.value("computation/fftthreads", self.defaultFftThreads, int)
+        except TypeError:
+            self.dispMsg("Incorrect value in the config file for the computation/fftthreads")
+        self.defaultDeferMacros = settings.value("computation/defermacros", self.defaultDeferMacros, bool)
+        self.defaultSinglePrecision = settings.value("computation/singleprecision", self.defaultSinglePrecision, bool)
+        self.setComputationDefaults()
 
     def saveDefaults(self):
         QtCore.QSettings.setDefaultFormat(QtCore.QSettings.IniFormat)
@@ -392,6 +433,38 @@ class MainProgram(QtWidgets.QMainWindow):
         settings.setValue("contour/height_ratio", self.defaultHeightRatio)
         settings.setValue("contour/diagonalbool", self.defaultDiagonalBool)
         settings.setValue("contour/diagonalmult", self.defaultDiagonalMult)
+        settings.setValue("computation/powdercachesize", self.defaultPowderCacheSize)
+        settings.setValue("computation/powdercachedisk", self.defaultPowderCacheDisk)
+        settings.setValue("computation/linearbinning", self.defaultLinearBinning)
+        settings.setValue("computation/librarydisk", self.defaultLibraryDisk)
+        settings.setValue("computation/numproc", self.defaultNumProc)
+        settings.setValue("computation/undomemory", self.defaultUndoMemory)
+        settings.setValue("computation/scratchsize", self.defaultScratchSize)
+        settings.setValue("computation/fftbackend", self.defaultFftBackend)
+        settings.setValue("computation/fftthreads", self.defaultFftThreads)
+        settings.setValue("computation/defermacros", self.defaultDeferMacros)
+        settings.setValue("computation/singleprecision", self.defaultSinglePrecision)
+        self.setComputationDefaults()
+
+    def setComputationDefaults(self):
+        settings = QtCore.QSettings()
+        sim.POWDERCACHE.setMaxSize(self.defaultPowderCacheSize * 1024**2)
+        if self.defaultPowderCacheDisk:
+            sim.POWDERCACHE.setDirectory(os.path.join(os.path.dirname(settings.fileName()), 'PowderCache'))
+        else:
+            sim.POWDERCACHE.setDirectory(None)
+        if self.defaultLibraryDisk:
+            sim.LIBRARYSTORE.setDirectory(os.path.join(os.path.dirname(settings.fileName()), 'CzjzekLibraries'))
+        else:
+            sim.LIBRARYSTORE.setDirectory(None)
+        sim.LINEARBINNING = self.defaultLinearBinning
+        wp.POOL.setNumProc(self.defaultNumProc)
+        eb.BRIDGE.setNumProc(self.defaultNumProc)
+        sc.JOURNAL.setMaxSize(self.defaultUndoMemory * 1024**2)
+        hc.SCRATCH.setMaxSize(self.defaultScratchSize * 1024**2)
+        fe.ENGINE.setBackend(self.defaultFftBackend)
+        fe.ENGINE.setNumThreads(self.defaultFftThreads)
+        fe.ENGINE.setWisdomFile(os.path.join(os.path.dirname(settings.fileName()), 'fftWisdom'))
 
     def dispMsg(self, msg, color='black'):
         if color == 'red':
@@ -618,13 +691,16 @@ class MainProgram(QtWidgets.QMainWindow):
         self.noUndoAct = QtWidgets.QAction("&No Undo Mode", self.editmenu, checkable=True)
         self.noUndoAct.toggled.connect(self.noUndoMode)
         self.editmenu.addAction(self.noUndoAct)
+        self.singlePrecisionAct = QtWidgets.QAction("&Single Precision", self.editmenu, checkable=True)
+        self.singlePrecisionAct.toggled.connect(self.singlePrecisionMode)
+        self.editmenu.addAction(self.singlePrecisionAct)
         self.clearundoAct = self.editmenu.addAction(QtGui.QIcon(IconDirectory + 'delete.png'), "&Clear Undo/Redo List", lambda: self.mainWindowCheck(lambda mainWindow: mainWindow.clearUndo()))
         self.clearundoAct.setToolTip('Clear Undo/Redo List')
         self.reloadAct = self.editmenu.addAction(QtGui.QIcon(IconDirectory + 'reload.png'), "Re&load", lambda: self.mainWindowCheck(lambda mainWindow: mainWindow.reloadLast()), QtGui.QKeySequence.Refresh)
         self.reloadAct.setToolTip('Reload Current Data')
         self.monitorAct = self.editmenu.addAction(QtGui.QIcon(IconDirectory + 'monitor.png'), "&Monitor", lambda: self.mainWindowCheck(lambda mainWindow: MonitorWindow(mainWindow)))
         self.monitorAct.setToolTip('Monitor Current Data')
-        self.editActList = [self.undoAction, self.redoAction, self.clearundoAct, self.noUndoAct, self.reloadAct, self.monitorAct]
+        self.editActList = [self.undoAction, self.redoAction, self.clearundoAct, self.noUndoAct, self.singlePrecisionAct, self.reloadAct, self.monitorAct]
         # the tool drop down menu
         self.toolMenu = QtWidgets.QMenu("&Tools", self)
         self.menubar.addMenu(self.toolMenu)
@@ -977,6 +1053,9 @@ class MainProgram(QtWidgets.QMainWindow):
                     self.noUndoAct.setChecked(True)
                 else:
                     self.noUndoAct.setChecked(False)
+                self.singlePrecisionAct.blockSignals(True)
+                self.singlePrecisionAct.setChecked(self.mainWindow.masterData.singlePrecision)
+                self.singlePrecisionAct.blockSignals(False)
                 if len(self.mainWindow.masterData.shape()) < 2:
                     for i in self.multiDActions:
                         i.setEnabled(False)
@@ -1326,6 +1405,10 @@ class MainProgram(QtWidgets.QMainWindow):
         self.mainWindow.current.setNoUndo(val)
         self.menuCheck()
 
+    def singlePrecisionMode(self, val):
+        self.mainWindow.current.setSinglePrecision(val)
+        self.menuCheck()
+
     def changeMainWindow(self, var):
         if not self.allowChange:
             return
@@ -1479,7 +1562,7 @@ class MainProgram(QtWidgets.QMainWindow):
                 self.lastLocation = os.path.dirname(filePath)  # Save used path
             if not filePath:
                 return
-            masterData = io.autoLoad(filePath)
+            masterData = io.autoLoad(filePath, singlePrecision=self.defaultSinglePrecision)
             if masterData is None:
                 return
             if masterData == -1:
@@ -1488,7 +1571,7 @@ class MainProgram(QtWidgets.QMainWindow):
                     if dialog.closed:
                         return
                 asciiInfo = (dialog.dataDimension, dialog.dataOrder, dialog.dataSpec, dialog.delim, dialog.sw)
-                masterData = io.autoLoad(filePath, [asciiInfo])
+                masterData = io.autoLoad(filePath, [asciiInfo], self.defaultSinglePrecision)
             if self.defaultAskName:
                 name = self.askName(filePath, masterData.name)
                 if name is None:
@@ -1520,7 +1603,7 @@ class MainProgram(QtWidgets.QMainWindow):
         return fileName
 
     def loadAndCombine(self, filePathList):
-        masterData = io.autoLoad(filePathList)
+        masterData = io.autoLoad(filePathList, singlePrecision=self.defaultSinglePrecision)
         wsname = self.askName()
         if wsname is None:
             return
@@ -1648,6 +1731,7 @@ class MainProgram(QtWidgets.QMainWindow):
         if reply == QtWidgets.QMessageBox.Yes:
             for item in fit.stopDict.keys():  # Send stop commands to all threads
                 fit.stopDict[item] = True
+            wp.POOL.close(terminate=True)
             event.accept()
         else:
             event.ignore()
@@ -1747,13 +1831,17 @@ class Main1DWindow(QtWidgets.QWidget):
         self.father.menuCheck()
 
     def runMacro(self, macro, display=True):
-        for i, _ in enumerate(macro):
-            iter1 = macro[i] # Do not loop over the macro list itself to prevent recursion if the running macro is also the one being recorded
-            self.addMacro(iter1)
-            try:
-                getattr(self.masterData, iter1[0])(*iter1[1])
-            except AttributeError:
-                raise SsnakeException('unknown macro command: ' + iter1[0])
+        self.masterData.setDeferred(self.father.defaultDeferMacros)
+        try:
+            for i, _ in enumerate(macro):
+                iter1 = macro[i] # Do not loop over the macro list itself to prevent recursion if the running macro is also the one being recorded
+                self.addMacro(iter1)
+                try:
+                    getattr(self.masterData, iter1[0])(*iter1[1])
+                except AttributeError:
+                    raise SsnakeException('unknown macro command: ' + iter1[0])
+        finally:
+            self.masterData.setDeferred(False)
         if display:
             self.current.upd()  # get the first slice of data
             self.current.showFid()  # plot the data
@@ -1830,7 +1918,7 @@ class Main1DWindow(QtWidgets.QWidget):
         if not os.path.exists(filePath):
             self.stopMonitor()
             return
-        loadData = io.autoLoad(*self.masterData.filePath)
+        loadData = io.autoLoad(*self.masterData.filePath, singlePrecision=self.masterData.singlePrecision)
         self.masterData.restoreData(loadData, None)
         for name in self.monitorMacros:
             self.runMacro(self.father.macros[name], display=False)
@@ -4244,31 +4332,72 @@ class BaselineWindow(wc.ToolWindow):
 
     NAME = "Baseline correction"
     SINGLESLICE = True
+    METHODS = ['poly', 'spline', 'als']
 
     def __init__(self, parent):
         super(BaselineWindow, self).__init__(parent)
-        self.grid.addWidget(wc.QLabel("Polynomial Degree:"), 0, 0, 1, 2)
+        self.grid.addWidget(wc.QLabel("Method:"), 0, 0, 1, 2)
+        self.methodDrop = QtWidgets.QComboBox()
+        self.methodDrop.addItems(['Polynomial', 'Spline', 'Asymmetric least squares'])
+        self.methodDrop.currentIndexChanged.connect(self.changeMethod)
+        self.grid.addWidget(self.methodDrop, 1, 0, 1, 2)
+        self.degreeLabel = wc.QLabel("Polynomial Degree:")
+        self.grid.addWidget(self.degreeLabel, 2, 0, 1, 2)
         self.removeList = []
         self.degreeEntry = wc.SsnakeSpinBox()
         self.degreeEntry.setMaximum(100)
         self.degreeEntry.setMinimum(1)
         self.degreeEntry.setValue(3)
         self.degreeEntry.setAlignment(QtCore.Qt.AlignCenter)
-        self.grid.addWidget(self.degreeEntry, 1, 0, 1, 2)
+        self.grid.addWidget(self.degreeEntry, 3, 0, 1, 2)
+        self.lamLabel = wc.QLabel("Smoothness:")
+        self.grid.addWidget(self.lamLabel, 4, 0)
+        self.lamEntry = wc.QLineEdit("1e5", self.preview)
+        self.grid.addWidget(self.lamEntry, 5, 0)
+        self.asymLabel = wc.QLabel("Asymmetry:")
+        self.grid.addWidget(self.asymLabel, 4, 1)
+        self.asymEntry = wc.QLineEdit("0.01", self.preview)
+        self.grid.addWidget(self.asymEntry, 5, 1)
         self.invertButton = QtWidgets.QCheckBox("Invert selection")
         self.invertButton.stateChanged.connect(self.preview)
-        self.grid.addWidget(self.invertButton, 2, 0, 1, 2)
+        self.grid.addWidget(self.invertButton, 6, 0, 1, 2)
         self.allFitButton = QtWidgets.QCheckBox("Fit traces separately")
-        self.grid.addWidget(self.allFitButton, 3, 0, 1, 2)
+        self.grid.addWidget(self.allFitButton, 7, 0, 1, 2)
         resetButton = QtWidgets.QPushButton("&Reset")
         resetButton.clicked.connect(self.reset)
-        self.grid.addWidget(resetButton, 4, 0)
+        self.grid.addWidget(resetButton, 8, 0)
         fitButton = QtWidgets.QPushButton("&Fit")
         fitButton.clicked.connect(self.preview)
-        self.grid.addWidget(fitButton, 4, 1)
+        self.grid.addWidget(fitButton, 8, 1)
+        self.changeMethod()
         self.father.current.peakPickFunc = lambda pos, self=self: self.picked(pos)
         self.father.current.peakPick = True
 
+    def changeMethod(self, *args):
+        method = self.METHODS[self.methodDrop.currentIndex()]
+        self.degreeLabel.setVisible(method != 'als')
+        self.degreeEntry.setVisible(method != 'als')
+        if method == 'spline':
+            self.degreeLabel.setText("Number of segments:")
+        else:
+            self.degreeLabel.setText("Polynomial Degree:")
+        for widget in [self.lamLabel, self.lamEntry, self.asymLabel, self.asymEntry]:
+            widget.setVisible(method == 'als')
+
+    def getSettings(self):
+        method = self.METHODS[self.methodDrop.currentIndex()]
+        settings = {'method': method, 'numKnots': self.degreeEntry.value()}
+        if method == 'als':
+            lam = safeEval(self.lamEntry.text(), length=self.father.current.len(), Type='FI')
+            if lam is None or lam <= 0:
+                raise SsnakeException('Baseline: smoothness value is not valid!')
+            asym = safeEval(self.asymEntry.text(), length=self.father.current.len(), Type='FI')
+            if asym is None or not 0 < asym < 1:
+                raise SsnakeException('Baseline: asymmetry value is not valid!')
+            settings['lam'] = float(lam)
+            settings['asym'] = float(asym)
+        return settings
+
     def picked(self, pos):
         self.removeList.append(pos[0])
         self.father.current.previewRemoveList(self.removeList, invert=self.invertButton.isChecked())
@@ -4278,7 +4407,7 @@ class BaselineWindow(wc.ToolWindow):
     def preview(self, *args):
         inp = self.degreeEntry.value()
         self.father.current.previewRemoveList(self.removeList, invert=self.invertButton.isChecked())
-        self.father.current.previewBaselineCorrection(inp, self.removeList, invert=self.invertButton.isChecked())
+        self.father.current.previewBaselineCorrection(inp, self.removeList, invert=self.invertButton.isChecked(), **self.getSettings())
         self.father.current.peakPickFunc = lambda pos, self=self: self.picked(pos)
         self.father.current.peakPick = True
 
@@ -4294,10 +4423,11 @@ class BaselineWindow(wc.ToolWindow):
 
     def applyFunc(self):
         inp = self.degreeEntry.value()
+        settings = self.getSettings()
         if self.allFitButton.isChecked():
-            self.father.current.baselineCorrectionAll(inp, self.removeList, invert=self.invertButton.isChecked())
+            self.father.current.baselineCorrectionAll(inp, self.removeList, invert=self.invertButton.isChecked(), **settings)
         else:
-            self.father.current.baselineCorrection(inp, self.removeList, self.singleSlice.isChecked(), invert=self.invertButton.isChecked())
+            self.father.current.baselineCorrection(inp, self.removeList, self.singleSlice.isChecked(), invert=self.invertButton.isChecked(), **settings)
         self.father.current.peakPickReset()
         self.father.current.resetPreviewRemoveList()
 
@@ -5579,7 +5709,17 @@ class FFMWindow(wc.ToolWindow):
         self.typeDrop = QtWidgets.QComboBox(parent=self)
         self.typeDrop.addItems(["Complex", "States/States-TPPI", "TPPI"])
         self.grid.addWidget(self.typeDrop, 4, 0)
-        self.grid.addWidget(wc.QLabel("Reconstruction may take a while"), 5, 0)
+        self.grid.addWidget(wc.QLabel("Tolerance (optional):"), 5, 0)
+        self.tolEntry = wc.QLineEdit()
+        self.tolEntry.setToolTip('Empty uses the default tolerance of the minimizer.\nA larger tolerance (e.g. 1e-6) is faster, but less accurate.')
+        self.grid.addWidget(self.tolEntry, 6, 0)
+        self.grid.addWidget(wc.QLabel("Max. iterations:"), 7, 0)
+        self.maxIterEntry = wc.QLineEdit("15000")
+        self.grid.addWidget(self.maxIterEntry, 8, 0)
+        self.warmCheck = QtWidgets.QCheckBox("Start from neighbouring trace")
+        self.warmCheck.setChecked(True)
+        self.grid.addWidget(self.warmCheck, 9, 0)
+        self.grid.addWidget(wc.QLabel("Reconstruction may take a while"), 10, 0)
 
     def preview(self, *args):
         pass
@@ -5599,7 +5739,17 @@ class FFMWindow(wc.ToolWindow):
         if not isinstance(val, (list, np.ndarray)):
             raise SsnakeException("FFM: 'Positions' is not a list or array")
         val = np.array(val, dtype=int)
-        check = self.father.current.ffm(val, self.typeDrop.currentIndex())
+        tol = None
+        if self.tolEntry.text().strip():
+            tol = safeEval(self.tolEntry.text(), length=self.father.current.len(), Type='FI')
+            if tol is None or tol <= 0:
+                raise SsnakeException("FFM: 'Tolerance' input is not valid")
+            tol = float(tol)
+        maxIter = safeEval(self.maxIterEntry.text(), length=self.father.current.len(), Type='FI')
+        if maxIter is None or maxIter < 1:
+            raise SsnakeException("FFM: 'Max. iterations' input is not valid")
+        maxIter = int(maxIter)
+        check = self.father.current.ffm(val, self.typeDrop.currentIndex(), tol, maxIter, self.warmCheck.isChecked())
         if check is False:
             raise SsnakeException("FFM: error")
 
@@ -5693,6 +5843,13 @@ class ISTWindow(wc.ToolWindow):
         self.grid.addWidget(wc.QLabel("Stop when residual below (% of ND max):"), 9, 0)
         self.tracelimitEntry = wc.QLineEdit("2.0")
         self.grid.addWidget(self.tracelimitEntry, 10, 0)
+        self.jointAxes = [axis for axis in range(self.father.masterData.ndim()) if axis != self.father.current.axes[-1]]
+        self.jointChecks = []
+        if self.jointAxes:
+            self.grid.addWidget(wc.QLabel("Sampled jointly with:"), 11, 0)
+        for i, axis in enumerate(self.jointAxes):
+            self.jointChecks.append(QtWidgets.QCheckBox("D" + str(axis + 1)))
+            self.grid.addWidget(self.jointChecks[-1], 12 + i, 0)
 
     def preview(self, *args):
         pass
@@ -5705,13 +5862,26 @@ class ISTWindow(wc.ToolWindow):
             self.father.father.lastLocation = os.path.dirname(filename)  # Save used path
         if not filename:
             return
-        self.valEntry.setText(repr(np.loadtxt(filename, dtype=int)))
+        try:
+            pos = io.loadNusList(filename)
+        except ValueError:
+            raise SsnakeException("IST: the sampling schedule could not be read")
+        if pos.shape[1] == 1:
+            self.valEntry.setText(repr(pos[:, 0]))
+        else:
+            self.valEntry.setText(str(pos.tolist()))
+        # A schedule with several columns selects as many joint dimensions
+        for i, check in enumerate(self.jointChecks):
+            check.setChecked(i < pos.shape[1] - 1)
 
     def applyFunc(self):
         val = safeEval(self.valEntry.text(), length=self.father.current.len())
         if not isinstance(val, (list, np.ndarray)):
             raise SsnakeException("IST: 'Positions' input is not a list or array")
         val = np.array(val, dtype=int)
+        jointAxes = [axis for axis, check in zip(self.jointAxes, self.jointChecks) if check.isChecked()]
+        if jointAxes and (val.ndim != 2 or val.shape[1] != len(jointAxes) + 1):
+            raise SsnakeException("IST: 'Positions' should have one column per sampled dimension")
         tracelimit = safeEval(self.tracelimitEntry.text(), length=self.father.current.len(), Type='FI')
         if tracelimit is None:
             raise SsnakeException("IST: 'Residual' input is not valid")
@@ -5723,7 +5893,7 @@ class ISTWindow(wc.ToolWindow):
         if maxIter is None:
             raise SsnakeException("IST: 'Max. iter.' input is not valid")
         maxIter = int(maxIter)
-        check = self.father.current.ist(val, self.typeDrop.currentIndex(), threshold, maxIter, tracelimit)
+        check = self.father.current.ist(val, self.typeDrop.currentIndex(), threshold, maxIter, tracelimit, jointAxes)
         if check is False:
             raise SsnakeException("IST: error")
 
@@ -6539,21 +6709,27 @@ class PreferenceWindow(QtWidgets.QWidget):
         tab1 = QtWidgets.QWidget()
         tab2 = QtWidgets.QWidget()
         tab3 = QtWidgets.QWidget()
+        tab4 = QtWidgets.QWidget()
         tabWidget.addTab(tab1, "Window")
         tabWidget.addTab(tab2, "Plot")
         tabWidget.addTab(tab3, "Contour")
+        tabWidget.addTab(tab4, "Computation")
         grid1 = QtWidgets.QGridLayout()
         grid2 = QtWidgets.QGridLayout()
         grid3 = QtWidgets.QGridLayout()
+        grid4 = QtWidgets.QGridLayout()
         tab1.setLayout(grid1)
         tab2.setLayout(grid2)
         tab3.setLayout(grid3)
+        tab4.setLayout(grid4)
         grid1.setColumnStretch(10, 1)
         grid1.setRowStretch(10, 1)
         grid2.setColumnStretch(10, 1)
         grid2.setRowStretch(10, 1)
         grid3.setColumnStretch(10, 1)
         grid3.setRowStretch(10, 1)
+        grid4.setColumnStretch(10, 1)
+        grid4.setRowStretch(10, 1)
         # grid1.addWidget(wc.QLabel("Window size:"), 0, 0, 1, 2)
         grid1.addWidget(wc.QLabel("Width:"), 1, 0)
         self.widthSpinBox = wc.SsnakeSpinBox()
@@ -6677,6 +6853,54 @@ class PreferenceWindow(QtWidgets.QWidget):
         self.HRSpinBox.setSingleStep(0.1)
         self.HRSpinBox.setValue(self.father.defaultHeightRatio)
         grid3.addWidget(self.HRSpinBox, 5, 1)
+        # grid4 definitions
+        grid4.addWidget(QtWidgets.QLabel("Powder cache size [MB]:"), 0, 0)
+        self.powderCacheSpinBox = wc.SsnakeSpinBox()
+        self.powderCacheSpinBox.setMaximum(100000)
+        self.powderCacheSpinBox.setValue(self.father.defaultPowderCacheSize)
+        grid4.addWidget(self.powderCacheSpinBox, 0, 1)
+        self.powderCacheDiskCheck = QtWidgets.QCheckBox("Store powder cache on disk")
+        self.powderCacheDiskCheck.setChecked(self.father.defaultPowderCacheDisk)
+        grid4.addWidget(self.powderCacheDiskCheck, 1, 0, 1, 2)
+        self.linearBinningCheck = QtWidgets.QCheckBox("Interpolate simulated frequencies between points")
+        self.linearBinningCheck.setChecked(self.father.defaultLinearBinning)
+        grid4.addWidget(self.linearBinningCheck, 2, 0, 1, 2)
+        self.libraryDiskCheck = QtWidgets.QCheckBox("Store generated Czjzek libraries on disk")
+        self.libraryDiskCheck.setChecked(self.father.defaultLibraryDisk)
+        grid4.addWidget(self.libraryDiskCheck, 3, 0, 1, 2)
+        grid4.addWidget(QtWidgets.QLabel("Number of worker processes:"), 4, 0)
+        self.numProcSpinBox = wc.SsnakeSpinBox()
+        self.numProcSpinBox.setMinimum(1)
+        self.numProcSpinBox.setMaximum(multiprocessing.cpu_count())
+        self.numProcSpinBox.setValue(self.father.defaultNumProc)
+        grid4.addWidget(self.numProcSpinBox, 4, 1)
+        grid4.addWidget(QtWidgets.QLabel("Undo memory [MB]:"), 5, 0)
+        self.undoMemorySpinBox = wc.SsnakeSpinBox()
+        self.undoMemorySpinBox.setMaximum(100000)
+        self.undoMemorySpinBox.setValue(self.father.defaultUndoMemory)
+        grid4.addWidget(self.undoMemorySpinBox, 5, 1)
+        self.deferMacrosCheck = QtWidgets.QCheckBox("Combine processing steps when running macros")
+        self.deferMacrosCheck.setChecked(self.father.defaultDeferMacros)
+        grid4.addWidget(self.deferMacrosCheck, 6, 0, 1, 2)
+        self.singlePrecisionCheck = QtWidgets.QCheckBox("Load data in single precision")
+        self.singlePrecisionCheck.setChecked(self.father.defaultSinglePrecision)
+        grid4.addWidget(self.singlePrecisionCheck, 7, 0, 1, 2)
+        grid4.addWidget(QtWidgets.QLabel("Keep data larger than [MB] on disk:"), 8, 0)
+        self.scratchSizeSpinBox = wc.SsnakeSpinBox()
+        self.scratchSizeSpinBox.setMaximum(1000000)
+        self.scratchSizeSpinBox.setValue(self.father.defaultScratchSize)
+        grid4.addWidget(self.scratchSizeSpinBox, 8, 1)
+        grid4.addWidget(QtWidgets.QLabel("FFT library:"), 9, 0)
+        self.fftBackendEntry = QtWidgets.QComboBox(self)
+        self.fftBackendEntry.addItems(fe.ENGINE.availableBackends())
+        self.fftBackendEntry.setCurrentIndex(max(0, self.fftBackendEntry.findText(fe.ENGINE.backend)))
+        grid4.addWidget(self.fftBackendEntry, 9, 1)
+        grid4.addWidget(QtWidgets.QLabel("Number of FFT threads:"), 10, 0)
+        self.fftThreadsSpinBox = wc.SsnakeSpinBox()
+        self.fftThreadsSpinBox.setMinimum(1)
+        self.fftThreadsSpinBox.setMaximum(multiprocessing.cpu_count())
+        self.fftThreadsSpinBox.setValue(self.father.defaultFftThreads)
+        grid4.addWidget(self.fftThreadsSpinBox, 10, 1)
         layout = QtWidgets.QGridLayout(self)
         layout.addWidget(tabWidget, 0, 0, 1, 4)
         cancelButton = QtWidgets.QPushButton("&Cancel")
@@ -6741,6 +6965,17 @@ class PreferenceWindow(QtWidgets.QWidget):
         self.father.defaultNegColor = self.negColor
         self.father.defaultWidthRatio = self.WRSpinBox.value()
         self.father.defaultHeightRatio = self.HRSpinBox.value()
+        self.father.defaultPowderCacheSize = self.powderCacheSpinBox.value()
+        self.father.defaultPowderCacheDisk = self.powderCacheDiskCheck.isChecked()
+        self.father.defaultLinearBinning = self.linearBinningCheck.isChecked()
+        self.father.defaultLibraryDisk = self.libraryDiskCheck.isChecked()
+        self.father.defaultNumProc = self.numProcSpinBox.value()
+        self.father.defaultUndoMemory = self.undoMemorySpinBox.value()
+        self.father.defaultScratchSize = self.scratchSizeSpinBox.value()
+        self.father.defaultFftBackend = self.fftBackendEntry.currentText()
+        self.father.defaultFftThreads = self.fftThreadsSpinBox.value()
+        self.father.defaultDeferMacros = self.deferMacrosCheck.isChecked()
+        self.father.defaultSinglePrecision = self.singlePrecisionCheck.isChecked()
         self.father.saveDefaults()
         self.closeEvent()
 
@@ -23,6 +23,7 @@ from matplotlib.pyplot import get_cmap, colormaps
 import matplotlib
 import matplotlib.ticker as ticker
 import spectrum as sc
+import functions as func
 from spectrumFrame import PlotFrame
 import reimplement as reim
 
@@ -559,6 +560,21 @@ class Current1D(PlotFrame):
         self.root.addMacro(['setNoUndo', (val,)])
         self.data.setNoUndo(val)
 
+    def setSinglePrecision(self, val):
+        """
+        Sets the precision of the data. In single precision
+        the data uses half the memory, at the cost of accuracy.
+
+        Parameters
+        ----------
+        val: bool
+           If True, the data is stored in single precision
+        """
+        self.root.addMacro(['setSinglePrecision', (val,)])
+        self.data.setSinglePrecision(val)
+        self.upd()
+        self.showFid()
+
     def real(self, *args):
         """
         Takes the real value along the current axis.
@@ -1329,57 +1345,65 @@ class Current1D(PlotFrame):
         self.showFid()
         self.upd()
 
-    def baselinePolyFit(self, x, data, bArray, degree):
+    def baselineFit(self, data, degree, removeList, invert=False, method='poly', numKnots=8, lam=1e5, asym=0.01):
         """
-        Fit a polynomial through the selected data.
+        Fit a baseline through the selected data, in the current representation.
 
         Parameters
         ----------
-        x: ndarray
-            The x-axis
         data: ndarray
             The data along this slice
-        bArray: ndarray, boolian
-            The points that should be used
         degree: int
-            Number of polynomial orders
+            Polynomial degree
+        removeList: list
+            Indexes of points not include in the fit
+        invert (optional = False): boolean
+            If True, the removeList is treated as an include list (i.e. inverting the selection)
+        method (optional = 'poly'): {'poly', 'spline', 'als'}
+            Polynomial, cubic spline or asymmetric least squares baseline
+        numKnots (optional = 8): int
+            Number of segments of the spline
+        lam (optional = 1e5): float
+            Smoothness of the asymmetric least squares baseline
+        asym (optional = 0.01): float
+            Asymmetry of the asymmetric least squares baseline
 
         Returns
         -------
         ndarray:
-            The fitted polynomial
+            The fitted baseline
         """
-        import numpy.polynomial.polynomial as poly
-        polyCoeff = poly.polyfit(x[bArray], data[bArray], degree)
-        return poly.polyval(x, polyCoeff)
+        bArray = func.baselineSelection(self.len(), removeList, invert)
+        return func.baselineFit(self.xax(), np.real(self.getDataType(data)), bArray, degree, method, numKnots, lam, asym)
 
-    def baselineCorrectionAll(self, degree, removeList, invert=False):
+    def baselineCorrectionAll(self, degree, removeList, invert=False, method='poly', numKnots=8, lam=1e5, asym=0.01):
         """
-        Correct baseline of a series of data
+        Correct baseline of a series of data, fitting every trace separately.
 
         Parameters
         ----------
         degree: int
             Polynomial degree
         removeList: list
-            Indexes of points not include in polyfit
+            Indexes of points not include in the fit
         invert (optional = False): boolean
-            If True, the removeList is treated as an include list (i.e. inverting the selection)           
-        """
-        tmpAx = np.arange(self.len())
-        bArray = np.array([True] * self.len())
-        for i in range(int(np.floor(len(removeList) / 2.0))):
-            minVal = min(removeList[2 * i], removeList[2 * i + 1])
-            maxVal = max(removeList[2 * i], removeList[2 * i + 1])
-            bArray = np.logical_and(bArray, np.logical_or((tmpAx < minVal), (tmpAx > maxVal)))
-        if invert:
-            bArray = np.logical_not(bArray)
-        y = np.apply_along_axis(lambda data: self.baselinePolyFit(self.xax(), data, bArray, degree), self.axes[-1], self.data.getHyperData(0))
-        y = np.real(self.getDataType(y))
-        self.root.addMacro(['subtract', (y,)])
-        self.data.subtract(y)
-
-    def baselineCorrection(self, degree, removeList, select=False, invert=False):
+            If True, the removeList is treated as an include list (i.e. inverting the selection)
+        method (optional = 'poly'): {'poly', 'spline', 'als'}
+            Polynomial, cubic spline or asymmetric least squares baseline
+        numKnots (optional = 8): int
+            Number of segments of the spline
+        lam (optional = 1e5): float
+            Smoothness of the asymmetric least squares baseline
+        asym (optional = 0.01): float
+            Asymmetry of the asymmetric least squares baseline
+        """
+        part = ['real', 'imag', 'real', 'abs'][self.viewSettings["plotType"]]
+        removeList = [int(i) for i in removeList]
+        axis = self.axes[-1] - self.data.ndim()
+        self.root.addMacro(['baselineCorrectionAll', (degree, removeList, axis, invert, part, method, numKnots, lam, asym)])
+        self.data.baselineCorrectionAll(degree, removeList, axis, invert, part, method, numKnots, lam, asym)
+
+    def baselineCorrection(self, degree, removeList, select=False, invert=False, method='poly', numKnots=8, lam=1e5, asym=0.01):
         """
         Correct baseline of spectrum/fid.
 
@@ -1388,11 +1412,19 @@ class Current1D(PlotFrame):
         degree: int
             Polynomial degree
         removeList: list
-            Indexes of points not include in polyfit
+            Indexes of points not include in the fit
         select (optional = False): boolean
             If True, apply only to the current slice.
         invert (optional = False): boolean
-            If True, the removeList is treated as an include list (i.e. inverting the selection)           
+            If True, the removeList is treated as an include list (i.e. inverting the selection)
+        method (optional = 'poly'): {'poly', 'spline', 'als'}
+            Polynomial, cubic spline or asymmetric least squares baseline
+        numKnots (optional = 8): int
+            Number of segments of the spline
+        lam (optional = 1e5): float
+            Smoothness of the asymmetric least squares baseline
+        asym (optional = 0.01): float
+            Asymmetry of the asymmetric least squares baseline
         """
         if select:
             selectSlice = self.getSelect()
@@ -1400,20 +1432,11 @@ class Current1D(PlotFrame):
             selectSlice = slice(None)
         tmpData = self.data1D.getHyperData(0)
         tmpData = tmpData[(0,)*(self.ndim()-1) + (slice(None), )]
-        tmpAx = np.arange(self.len())
-        bArray = np.array([True] * self.len())
-        for i in range(int(np.floor(len(removeList) / 2.0))):
-            minVal = min(removeList[2 * i], removeList[2 * i + 1])
-            maxVal = max(removeList[2 * i], removeList[2 * i + 1])
-            bArray = np.logical_and(bArray, np.logical_or((tmpAx < minVal), (tmpAx > maxVal)))
-        if invert:
-            bArray = np.logical_not(bArray)
-        y = self.baselinePolyFit(self.xax(), tmpData, bArray, degree)
-        y = np.real(self.getDataType(y))
+        y = self.baselineFit(tmpData, degree, removeList, invert, method, numKnots, lam, asym)
         self.root.addMacro(['baselineCorrection', (y, self.axes[-1] - self.data.ndim(), selectSlice)])
         self.data.baselineCorrection(y, self.axes[-1], select=selectSlice)
 
-    def previewBaselineCorrection(self, degree, removeList, invert=False):
+    def previewBaselineCorrection(self, degree, removeList, invert=False, method='poly', numKnots=8, lam=1e5, asym=0.01):
         """
         Preview the baseline correction of a spectrum/fid.
 
@@ -1422,22 +1445,21 @@ class Current1D(PlotFrame):
         degree: int
             Polynomial degree
         removeList: list
-            Indexes of points not include in polyfit
+            Indexes of points not include in the fit
         invert (optional = False): boolean
-            If True, the removeList is treated as an include list (i.e. inverting the selection)           
+            If True, the removeList is treated as an include list (i.e. inverting the selection)
+        method (optional = 'poly'): {'poly', 'spline', 'als'}
+            Polynomial, cubic spline or asymmetric least squares baseline
+        numKnots (optional = 8): int
+            Number of segments of the spline
+        lam (optional = 1e5): float
+            Smoothness of the asymmetric least squares baseline
+        asym (optional = 0.01): float
+            Asymmetry of the asymmetric least squares baseline
         """
         tmpData = self.data1D.getHyperData(0)
         tmpData = tmpData[(0,)*(self.ndim()-1) + (slice(None), )]
-        tmpAx = np.arange(self.len())
-        bArray = np.array([True] * self.len())
-        for i in range(int(np.floor(len(removeList) / 2.0))):
-            minVal = min(removeList[2 * i], removeList[2 * i + 1])
-            maxVal = max(removeList[2 * i], removeList[2 * i + 1])
-            bArray = np.logical_and(bArray, np.logical_or((tmpAx < minVal), (tmpAx > maxVal)))
-        if invert:
-            bArray = np.logical_not(bArray)
-        y = self.baselinePolyFit(self.xax(), tmpData, bArray, degree)
-        y = np.real(self.getDataType(y))
+        y = self.baselineFit(tmpData, degree, removeList, invert, method, numKnots, lam, asym)
         self.resetPreviewRemoveList()
         if self.NDIM_PLOT > 1:
             if isinstance(self, CurrentContour):
@@ -2011,7 +2033,7 @@ class Current1D(PlotFrame):
         self.upd()
         self.showFid()
 
-    def ffm(self, posList, typeVal):
+    def ffm(self, posList, typeVal, tol=None, maxIter=None, warmStart=True):
         """
         Apply the Fast Forward Maximum Entropy reconstruction method (for NUS data).
 
@@ -2022,9 +2044,18 @@ class Current1D(PlotFrame):
         typeVal : {0, 1, 2}
             The type of data to be reconstructed.
             0=complex, 1=States or States-TPPI, 2=TPPI.
+        tol : float, optional
+            The relative change of the entropy at which the optimization of a trace stops.
+            By default the default of L-BFGS-B is used.
+        maxIter : int, optional
+            The maximum number of iterations per trace.
+            By default the default of L-BFGS-B is used.
+        warmStart : bool, optional
+            If True, the optimization of every trace starts from the solution of the neighbouring trace.
+            True by default.
         """
-        self.root.addMacro(['ffm', (posList, typeVal, self.axes[-1] - self.data.ndim())])
-        self.data.ffm(posList, typeVal, self.axes[-1])
+        self.root.addMacro(['ffm', (posList, typeVal, self.axes[-1] - self.data.ndim(), tol, maxIter, warmStart)])
+        self.data.ffm(posList, typeVal, self.axes[-1], tol, maxIter, warmStart)
         self.upd()
         self.showFid()
 
@@ -2052,7 +2083,7 @@ class Current1D(PlotFrame):
         self.upd()
         self.showFid()
 
-    def ist(self, posList, typeVal, threshold, maxIter, tracelimit):
+    def ist(self, posList, typeVal, threshold, maxIter, tracelimit, jointAxes=None):
         """
         Apply the IST (Iterative Soft Thresholding) reconstruction method (for NUS data).
 
@@ -2061,6 +2092,7 @@ class Current1D(PlotFrame):
         posList : array_like
             A list of indices that are recorded datapoints.
             All other datapoints will be reconstructed.
+            With joint axes, a list with the coordinates of every recorded datapoint, with one column per axis.
         typeVal : {0, 1, 2}
             The type of data to be reconstructed.
             0=complex, 1=States or States-TPPI, 2=TPPI.
@@ -2070,9 +2102,18 @@ class Current1D(PlotFrame):
             Maximum number of iterations.
         tracelimit : float
             Stopping limit (0 < x < 1) (stop if residual intensity below this point).
-        """
-        self.root.addMacro(['ist', (posList, typeVal, self.axes[-1] - self.data.ndim(), threshold, maxIter, tracelimit)])
-        self.data.ist(posList, typeVal, self.axes[-1], threshold, maxIter, tracelimit)
+        jointAxes : list of ints, optional
+            The other axes that are reconstructed jointly with the current axis.
+            The columns of posList are the reconstructed axes in increasing order.
+            By default only the current axis is reconstructed.
+        """
+        if jointAxes:
+            axes = sorted([self.axes[-1]] + list(jointAxes))
+            self.root.addMacro(['ist', (posList, typeVal, [axis - self.data.ndim() for axis in axes], threshold, maxIter, tracelimit)])
+            self.data.ist(posList, typeVal, axes, threshold, maxIter, tracelimit)
+        else:
+            self.root.addMacro(['ist', (posList, typeVal, self.axes[-1] - self.data.ndim(), threshold, maxIter, tracelimit)])
+            self.data.ist(posList, typeVal, self.axes[-1], threshold, maxIter, tracelimit)
         self.upd()
         self.showFid()
 
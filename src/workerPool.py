@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2016 - 2019 Bas van Meerten and Wouter Franssen
+
+# This file is part of ssNake.
+#
+# ssNake is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ssNake is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ssNake. If not, see <http://www.gnu.org/licenses/>.
+
+import multiprocessing
+
+
+class WorkerPool(object):
+    """
+    A pool of worker processes that is shared by the whole program.
+    The processes are started on first use and are kept alive between calls.
+    Workloads that are too small to benefit from the workers are run in the calling process.
+    """
+
+    def __init__(self, numProc=None, minJobs=2):
+        """
+        Initializes the pool without starting the processes.
+
+        Parameters
+        ----------
+        numProc : int, optional
+            The number of worker processes.
+            By default the number of CPUs.
+        minJobs : int, optional
+            The minimum number of jobs for which the workers are used by map.
+            By default 2.
+        """
+        if numProc is None:
+            numProc = multiprocessing.cpu_count()
+        self.numProc = max(1, numProc)
+        self.minJobs = minJobs
+        self.initializer = None
+        self.initargs = ()
+        self.pool = None
+        self.poolSettings = None
+
+    def setNumProc(self, numProc):
+        """
+        Sets the number of worker processes.
+        A running pool is restarted on its next use.
+
+        Parameters
+        ----------
+        numProc : int
+            The number of worker processes.
+        """
+        self.numProc = max(1, numProc)
+
+    def setInitializer(self, initializer, initargs=()):
+        """
+        Sets the function that is run at the start of every worker process, for example to copy settings of the main process.
+        A running pool is restarted on its next use when the function or its arguments change.
+
+        Parameters
+        ----------
+        initializer : function or None
+            The function.
+        initargs : tuple, optional
+            The arguments of the function.
+        """
+        self.initializer = initializer
+        self.initargs = tuple(initargs)
+
+    def getPool(self):
+        """
+        Returns the multiprocessing pool, starting it when needed.
+
+        Returns
+        -------
+        Pool
+            The pool.
+        """
+        settings = (self.numProc, self.initializer, self.initargs)
+        if self.pool is not None and self.poolSettings != settings:
+            self.close()
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.numProc, self.initializer, self.initargs)
+            self.poolSettings = settings
+        return self.pool
+
+    def useWorkers(self, numJobs, minJobs=None):
+        """
+        Checks whether a number of jobs should be run on the worker processes.
+
+        Parameters
+        ----------
+        numJobs : int
+            The number of jobs.
+        minJobs : int, optional
+            The minimum number of jobs for which the workers are used.
+            By default the minJobs of the pool.
+
+        Returns
+        -------
+        bool
+            True if the workers should be used, False if the jobs should be run in the calling process.
+        """
+        if minJobs is None:
+            minJobs = self.minJobs
+        return self.numProc > 1 and numJobs >= max(2, minJobs)
+
+    def map(self, func, jobs, minJobs=None):
+        """
+        Runs a function for every job and waits for the results.
+
+        Parameters
+        ----------
+        func : function
+            The function, which should be defined at module level.
+        jobs : iterable
+            The inputs of the function.
+        minJobs : int, optional
+            The minimum number of jobs for which the workers are used.
+            Smaller workloads are run serially in the calling process.
+            By default the minJobs of the pool.
+
+        Returns
+        -------
+        list
+            The results of the function in the order of the jobs.
+        """
+        jobs = list(jobs)
+        if not self.useWorkers(len(jobs), minJobs):
+            return [func(job) for job in jobs]
+        return self.getPool().map(func, jobs)
+
+    def close(self, terminate=False):
+        """
+        Stops the worker processes.
+        The pool is started again on its next use.
+
+        Parameters
+        ----------
+        terminate : bool, optional
+            If True, running jobs are killed instead of waiting for them to finish.
+            By default False.
+        """
+        if self.pool is None:
+            return
+        if terminate:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+        self.pool = None
+        self.poolSettings = None
+
+POOL = WorkerPool()